@@ -0,0 +1,930 @@
+"""
+A module for caching (large) data sources in a binary format that is much faster to (re)load than the original.
+
+      .. moduleauthor:: Daniela Remenska <remenska@gmail.com>
+
+"""
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import threading
+import timeit
+import numpy as np
+import pandas as pd
+from geopandas import GeoDataFrame
+from shapely.geometry import box
+from iSDM.geometry import geometries_to_wkb, geometries_from_wkb, hilbert_index
+
+logger = logging.getLogger('iSDM.cache')
+logger.setLevel(logging.DEBUG)
+
+# bump when the layout of the cache files changes, so that older caches are rebuilt
+CACHE_VERSION = 2
+# the files making up a shapefile; a change in any of them invalidates the cache
+SHAPEFILE_EXTENSIONS = ('.shp', '.shx', '.dbf', '.prj', '.cpg')
+# the bounding box of every geometry, stored next to the geometries
+BOUNDS_COLUMNS = ['_minx', '_miny', '_maxx', '_maxy']
+# the position of every record in the source data, as the cache stores the records in a spatial order
+ROW_COLUMN = '_row'
+# the extension of the (JSON) sidecar file describing a memory-mapped raster file
+MEMMAP_METADATA_EXTENSION = ".json"
+# the (JSON) file describing a GridStore, in its folder
+GRID_STORE_METADATA_FILE = "grid.json"
+
+
+class VectorCache(object):
+    """
+    VectorCache
+    A class for caching a vector data source (typically an ESRI shapefile, or a folder of shapefiles) in a columnar Parquet file.
+    The geometries are stored in Well-Known Binary (WKB) format, together with all the attributes (with lower-case column names),
+    and the bounding box of every geometry. The bounding boxes are a coarse spatial index: the records are stored sorted along a
+    Hilbert curve through the centers of their bounding boxes, so every row group covers a compact area, and as the Parquet file
+    keeps the minimum and maximum of every column per row group, the row groups outside a bounding box of interest are skipped
+    without decoding their geometries. The records are read back in their original order. Attribute filters and column projection
+    are pushed down to the Parquet reader too.
+
+    The cache records the size and modification time of every source file it was built from. It is rebuilt automatically by
+    :func:`load` when any of these change, or when the cache was built by another version of this class.
+
+    :ivar file_path: Location of the source data (a shapefile, or a folder containing a shapefile).
+    :vartype file_path: string
+
+    :ivar cache_file: Location of the cache file.
+    :vartype cache_file: string
+
+    :ivar cache_prefix: Location and base name of the cache file, without extension. Other files derived from the same \
+    source data (such as the species catalog of ``IUCNSpecies``) are stored under this name as well.
+    :vartype cache_prefix: string
+    """
+    ROW_GROUP_SIZE = 10000
+
+    def __init__(self, file_path, cache_location=None):
+        if not file_path:
+            raise AttributeError("Please provide the location of the data to cache.")
+        self.file_path = file_path
+        source_name = os.path.basename(os.path.normpath(file_path))
+        if os.path.isdir(file_path):
+            cache_location = cache_location or file_path
+        else:
+            source_name = os.path.splitext(source_name)[0]
+            cache_location = cache_location or os.path.dirname(os.path.abspath(file_path))
+        self.cache_prefix = os.path.join(cache_location, source_name)
+        self.cache_file = self.cache_prefix + ".cache.parquet"
+
+    def source_files(self):
+        """
+        Returns the source files the cache is built from: all files belonging to the shapefile, or to the shapefiles in the folder.
+
+        :rtype: list(string)
+
+        """
+        if os.path.isdir(self.file_path):
+            return sorted(os.path.join(self.file_path, file_name) for file_name in os.listdir(self.file_path)
+                          if os.path.splitext(file_name)[1].lower() in SHAPEFILE_EXTENSIONS)
+        base_name = os.path.splitext(self.file_path)[0]
+        source_files = [self.file_path] + [base_name + extension for extension in SHAPEFILE_EXTENSIONS]
+        return sorted(set(file_name for file_name in source_files if os.path.exists(file_name)))
+
+    def source_signature(self):
+        """
+        Returns the size and modification time of every source file, by file name.
+
+        :rtype: dict
+
+        """
+        signature = {}
+        for file_name in self.source_files():
+            stat = os.stat(file_name)
+            signature[os.path.basename(file_name)] = [stat.st_size, stat.st_mtime]
+        return signature
+
+    def metadata(self):
+        """
+        Returns the metadata stored in the cache file (the signature of the source files, the geometry column name, and the
+        coordinate reference system), or None if there is no (readable) cache file.
+
+        :rtype: dict
+
+        """
+        import pyarrow.parquet as pq
+        if not os.path.exists(self.cache_file):
+            return None
+        try:
+            schema = pq.read_schema(self.cache_file)
+        except Exception as e:
+            logger.error("Could not read the cache file %s: %s " % (self.cache_file, str(e)))
+            return None
+        if not schema.metadata or b'isdm' not in schema.metadata:
+            return None
+        return json.loads(schema.metadata[b'isdm'].decode("utf-8"))
+
+    def is_valid(self):
+        """
+        Whether the cache file exists, and was built (by this version) from the current source files.
+
+        :rtype: bool
+
+        """
+        metadata = self.metadata()
+        return metadata is not None and metadata.get('version') == CACHE_VERSION and \
+            metadata.get('signature') == self.source_signature()
+
+    def build(self):
+        """
+        (Re)builds the cache file from the source data, which is loaded entirely. The cache file is written to a temporary
+        file first, and only then moved in place, so an interrupted build never leaves a broken cache behind.
+
+        :returns: The data loaded from the source.
+
+        :rtype: geopandas.GeoDataFrame
+
+        """
+        import pyarrow
+        import pyarrow.parquet as pq
+        start_time = timeit.default_timer()
+        signature = self.source_signature()
+        logger.info("Building the cache %s from %s " % (self.cache_file, self.file_path))
+        data = GeoDataFrame.from_file(self.file_path)
+        data.columns = [x.lower() for x in data.columns]
+        geometry_column = getattr(data, '_geometry_column_name', 'geometry')
+        frame = pd.DataFrame(data.drop(geometry_column, axis=1))
+        bounds = data.geometry.bounds
+        for column, bound in zip(BOUNDS_COLUMNS, ['minx', 'miny', 'maxx', 'maxy']):
+            frame[column] = bounds[bound].values
+        frame[geometry_column] = geometries_to_wkb(data.geometry)
+        frame[ROW_COLUMN] = np.arange(frame.shape[0], dtype=np.int64)
+        # spatially close records end up in the same row groups, whose bounds statistics then allow skipping them
+        distances = hilbert_index((bounds.minx.values + bounds.maxx.values) / 2, (bounds.miny.values + bounds.maxy.values) / 2)
+        frame = frame.iloc[np.argsort(distances, kind='mergesort')]
+        table = pyarrow.Table.from_pandas(frame, preserve_index=False)
+        metadata = dict(table.schema.metadata or {})
+        metadata[b'isdm'] = json.dumps({'version': CACHE_VERSION,
+                                        'signature': signature,
+                                        'geometry_column': geometry_column,
+                                        'crs': _crs_to_string(data.crs)}).encode("utf-8")
+        table = table.replace_schema_metadata(metadata)
+        temporary_file_name = "%s.%s.tmp" % (self.cache_file, threading.current_thread().ident)
+        try:
+            pq.write_table(table, temporary_file_name, row_group_size=self.ROW_GROUP_SIZE)
+            os.replace(temporary_file_name, self.cache_file)
+        finally:
+            if os.path.exists(temporary_file_name):
+                os.remove(temporary_file_name)
+        logger.info("Cached %s geometries in %.2f seconds." % (data.shape[0], timeit.default_timer() - start_time))
+        return data
+
+    def read(self, bbox=None, filters=None, columns=None):
+        """
+        Reads the data from the cache file.
+
+        :param tuple bbox: Only read the geometries intersecting this (minx, miny, maxx, maxy) bounding box.
+
+        :param list filters: Only read the records matching these filters, in the same form as for ``Species.load_data()``: \
+        a list of (column, operator, value) tuples which must all hold, or a list of such lists, of which at least one must hold. \
+        For example, ``[('binomial', 'in', ['Acrocheilus alutaceus']), ('presence', '<', 4)]``. Column names are lower-case.
+
+        :param list columns: Only read these (attribute) columns. The geometry column is always read.
+
+        :returns: The data, with the geometries restored.
+
+        :rtype: geopandas.GeoDataFrame
+
+        """
+        import pyarrow.parquet as pq
+        from iSDM.species import Species
+        metadata = self.metadata()
+        if metadata is None:
+            raise IOError("There is no valid cache file at %s " % self.cache_file)
+        geometry_column = metadata['geometry_column']
+        schema = pq.read_schema(self.cache_file)
+        attribute_columns = [name for name in schema.names if name not in BOUNDS_COLUMNS + [ROW_COLUMN, geometry_column]]
+        if columns is not None:
+            missing_columns = [column for column in columns if column not in attribute_columns]
+            if missing_columns:
+                logger.debug("Columns not available in %s: %s " % (self.file_path, missing_columns))
+            attribute_columns = [name for name in attribute_columns if name in columns]
+        conjunctions = Species._disjunctive_filters(filters) or [[]]
+        if bbox is not None:
+            minx, miny, maxx, maxy = bbox
+            bbox_filter = [('_maxx', '>=', minx), ('_minx', '<=', maxx), ('_maxy', '>=', miny), ('_miny', '<=', maxy)]
+            conjunctions = [list(conjunction) + bbox_filter for conjunction in conjunctions]
+        parquet_filters = conjunctions if any(conjunctions) else None
+        table = pq.read_table(self.cache_file, columns=attribute_columns + [geometry_column, ROW_COLUMN], filters=parquet_filters)
+        # back to the order of the source data
+        frame = table.to_pandas().sort_values(ROW_COLUMN, kind='mergesort')
+        frame = frame.drop(ROW_COLUMN, axis=1).reset_index(drop=True)
+        frame[geometry_column] = geometries_from_wkb(frame[geometry_column].values)
+        data = GeoDataFrame(frame, geometry=geometry_column, crs=_crs_from_string(metadata['crs']))
+        if bbox is not None:
+            # the bounding boxes overlap, the geometries themselves may not
+            data = data[data.intersects(box(*bbox))]
+            data.reset_index(drop=True, inplace=True)
+        return data
+
+    def load(self, bbox=None, filters=None, columns=None):
+        """
+        Reads the data from the cache file (see :func:`read`), after (re)building it from the source data if needed.
+
+        :returns: The data, with the geometries restored.
+
+        :rtype: geopandas.GeoDataFrame
+
+        """
+        if not self.is_valid():
+            self.build()
+        start_time = timeit.default_timer()
+        data = self.read(bbox=bbox, filters=filters, columns=columns)
+        logger.info("Loaded %s geometries from the cache in %.2f seconds." % (data.shape[0], timeit.default_timer() - start_time))
+        return data
+
+
+class MemmapRasterReader(object):
+    """
+    MemmapRasterReader
+    A read-only stand-in for a rasterio dataset reader, on an uncompressed raster file which is memory-mapped instead of read.
+    The file contains the raw pixel values of all bands, in (band, row, column) order. It is described by a JSON sidecar file
+    (see :func:`write_memmap_metadata`) with the dtype, the shape, the affine transformation, the "nodata" value and the coordinate
+    reference system, or alternatively by the :attr:`metadata` given directly.
+    Reading a band or a window does not copy (or decompress) any data: the pixels are paged in by the operating system when
+    they are accessed, and the page cache is shared among all processes mapping the same file. With the default ``mode='c'``
+    (copy-on-write), the returned arrays can be modified, without changing the file.
+
+    :ivar name: Location of the memory-mapped raster file.
+    :vartype name: string
+    """
+    # the number of pixels in the (virtual) blocks used by block_windows()
+    BLOCK_PIXELS = 2 ** 20
+
+    def __init__(self, file_path, metadata=None, mode='c'):
+        if metadata is None:
+            metadata = read_memmap_metadata(file_path)
+        self.name = file_path
+        self.mode = mode
+        self.driver = "memmap"
+        self.count, self.height, self.width = _memmap_shape(metadata['shape'])
+        self.dtype = np.dtype(metadata['dtype'])
+        self.dtypes = [self.dtype.name] * self.count
+        self.nodata = metadata.get('nodata')
+        self.crs = _crs_from_string(metadata.get('crs'))
+        from rasterio.transform import Affine
+        if metadata.get('transform') is not None:
+            self.affine = Affine.from_gdal(*metadata['transform'])
+        else:
+            # a global-scale (-180, -90, 180, 90) raster
+            self.affine = Affine(360.0 / self.width, 0.0, -180.0, 0.0, -180.0 / self.height, 90.0)
+        self.transform = self.affine
+        self.res = (abs(self.affine.a), abs(self.affine.e))
+        from rasterio.coords import BoundingBox
+        left, top = self.affine * (0, 0)
+        right, bottom = self.affine * (self.width, self.height)
+        self.bounds = BoundingBox(min(left, right), min(top, bottom), max(left, right), max(top, bottom))
+        self.meta = {'driver': self.driver, 'dtype': self.dtype.name, 'nodata': self.nodata, 'width': self.width,
+                     'height': self.height, 'count': self.count, 'crs': self.crs, 'transform': self.affine}
+        block_rows = max(1, min(self.height, self.BLOCK_PIXELS // max(self.width, 1)))
+        self.block_shapes = [(block_rows, self.width)] * self.count
+        self.closed = False
+
+    def read(self, indexes=None, window=None):
+        """
+        Reads one band (a 2-dimensional array) or, without :attr:`indexes`, all bands (a 3-dimensional array), or only a
+        window of them. The entire band is returned as a ``numpy.memmap``, windows as views of it.
+
+        :param int indexes: The index of the band to read (starting with 1).
+
+        :param window: Only read this ((row_start, row_stop), (col_start, col_stop)) window, or rasterio ``Window``.
+
+        :rtype: np.ndarray
+
+        """
+        if self.closed:
+            raise ValueError("The dataset %s is closed." % self.name)
+        if indexes is None:
+            data = np.memmap(self.name, dtype=self.dtype, mode=self.mode, shape=(self.count, self.height, self.width))
+        else:
+            if not 1 <= indexes <= self.count:
+                raise IndexError("band index %s out of range (not in %s)" % (indexes, tuple(range(1, self.count + 1))))
+            # a separate mapping per band, so its offset (and file name) can be used to map it again, see iSDM.pipeline.SharedLayers
+            data = np.memmap(self.name, dtype=self.dtype, mode=self.mode, shape=(self.height, self.width),
+                             offset=(indexes - 1) * self.height * self.width * self.dtype.itemsize)
+        if window is None:
+            return data
+        if hasattr(window, 'toranges'):
+            window = window.toranges()
+        (row_start, row_stop), (col_start, col_stop) = window
+        return np.asarray(data[..., row_start:row_stop, col_start:col_stop])
+
+    def block_windows(self, bidx=0):
+        """
+        Iterates over the (virtual) blocks of the raster: full-width strips of ``block_shapes`` rows.
+
+        :returns: A generator of ((block_row, 0), ((row_start, row_stop), (0, width))) tuples, as in rasterio.
+
+        :rtype: generator
+
+        """
+        block_rows = self.block_shapes[0][0]
+        for block_row, row_start in enumerate(range(0, self.height, block_rows)):
+            yield (block_row, 0), ((row_start, min(row_start + block_rows, self.height)), (0, self.width))
+
+    def close(self):
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def write_memmap_metadata(file_path, dtype, shape, transform=None, nodata=None, crs=None, **kwargs):
+    """
+    Writes the JSON sidecar file describing an uncompressed (memory-mapped) raster file, so it can be opened with a
+    :class:`MemmapRasterReader`. This also makes a raw binary file (for example, a ``numpy.memmap`` dumped to disk) usable
+    as a raster layer.
+
+    :param string file_path: The location of the raster file (the sidecar file is stored next to it).
+
+    :param dtype: The data type of the pixels.
+
+    :param tuple shape: The (height, width) or (bands, height, width) of the raster.
+
+    :param rasterio.transform.Affine transform: The affine transformation of the raster. Default is a global-scale raster.
+
+    :param nodata: The "nodata" value of the raster, if any.
+
+    :param crs: The coordinate reference system of the raster.
+
+    :param dict kwargs: Any other information to store (for example, the signature of the source data).
+
+    :returns: None
+
+    """
+    metadata = dict(kwargs)
+    metadata.update({'dtype': np.dtype(dtype).str,
+                     'shape': [int(size) for size in shape],
+                     'transform': list(transform.to_gdal()) if transform is not None else None,
+                     'nodata': nodata.item() if hasattr(nodata, 'item') else nodata,
+                     'crs': _crs_to_string(crs)})
+    temporary_file_name = "%s%s.%s.tmp" % (file_path, MEMMAP_METADATA_EXTENSION, threading.current_thread().ident)
+    with open(temporary_file_name, "w") as metadata_file:
+        json.dump(metadata, metadata_file)
+    os.replace(temporary_file_name, file_path + MEMMAP_METADATA_EXTENSION)
+
+
+def read_memmap_metadata(file_path):
+    """
+    Reads the JSON sidecar file written by :func:`write_memmap_metadata`.
+
+    :param string file_path: The location of the raster file.
+
+    :returns: The metadata, or None if there is no sidecar file.
+
+    :rtype: dict
+
+    """
+    if not os.path.exists(file_path + MEMMAP_METADATA_EXTENSION):
+        return None
+    with open(file_path + MEMMAP_METADATA_EXTENSION) as metadata_file:
+        return json.load(metadata_file)
+
+
+class RasterCache(object):
+    """
+    RasterCache
+    A class for caching a (compressed) raster file, for example a GeoTIFF or an ArcGrid, as an uncompressed file of raw
+    pixel values, which is memory-mapped instead of read (see :class:`MemmapRasterReader`). Repeated runs, and parallel
+    worker processes, then page in the pixels they need directly from the cache, instead of decompressing entire bands.
+    The sidecar file of the cache stores the dtype, shape, affine transformation, "nodata" value and coordinate reference
+    system of the raster, together with a checksum (SHA-256) of the source file. The cache is rebuilt by :func:`load` when
+    the size or modification time of the source file changes, or when the cache was built by another version of this class.
+
+    :ivar file_path: Location of the source raster file.
+    :vartype file_path: string
+
+    :ivar cache_file: Location of the cache file.
+    :vartype cache_file: string
+    """
+    def __init__(self, file_path, cache_location=None):
+        if not file_path:
+            raise AttributeError("Please provide the location of the raster data to cache.")
+        self.file_path = file_path
+        cache_location = cache_location or os.path.dirname(os.path.abspath(file_path))
+        # ArcGrid rasters are folders of w001001.adf-like files, so the name of the folder is used as well
+        source_name = "_".join(os.path.normpath(os.path.abspath(file_path)).split(os.sep)[-2:])
+        self.cache_file = os.path.join(cache_location, os.path.splitext(source_name)[0] + ".cache.dat")
+
+    def source_signature(self):
+        """
+        Returns the size and modification time of the source file.
+
+        :rtype: list
+
+        """
+        stat = os.stat(self.file_path)
+        return [stat.st_size, stat.st_mtime]
+
+    def source_checksum(self, chunk_size=2 ** 24):
+        """
+        Computes the SHA-256 checksum of the (entire) source file.
+
+        :rtype: string
+
+        """
+        checksum = hashlib.sha256()
+        with open(self.file_path, "rb") as source_file:
+            for chunk in iter(lambda: source_file.read(chunk_size), b""):
+                checksum.update(chunk)
+        return checksum.hexdigest()
+
+    def metadata(self):
+        """
+        Returns the metadata stored in the sidecar file of the cache, or None if there is no (complete) cache.
+
+        :rtype: dict
+
+        """
+        if not os.path.exists(self.cache_file):
+            return None
+        try:
+            return read_memmap_metadata(self.cache_file)
+        except ValueError as e:
+            logger.error("Could not read the metadata of the cache file %s: %s " % (self.cache_file, str(e)))
+            return None
+
+    def is_valid(self):
+        """
+        Whether the cache file exists, and was built (by this version) from the current source file.
+
+        :rtype: bool
+
+        """
+        metadata = self.metadata()
+        return metadata is not None and metadata.get('version') == CACHE_VERSION and \
+            metadata.get('signature') == self.source_signature()
+
+    def build(self):
+        """
+        (Re)builds the cache file from the source raster, block by block, so that no band is ever loaded entirely.
+        The pixels are written to a temporary file first, and only then moved in place (together with the sidecar file),
+        so an interrupted build never leaves a broken cache behind.
+
+        :returns: None
+
+        """
+        import rasterio
+        start_time = timeit.default_timer()
+        signature = self.source_signature()
+        logger.info("Building the raster cache %s from %s " % (self.cache_file, self.file_path))
+        temporary_file_name = "%s.%s.tmp" % (self.cache_file, threading.current_thread().ident)
+        try:
+            with rasterio.open(self.file_path) as src:
+                dtype = np.dtype(src.dtypes[0])
+                cache = np.memmap(temporary_file_name, dtype=dtype, mode='w+', shape=(src.count, src.height, src.width))
+                for band_number in range(1, src.count + 1):
+                    for _, window in src.block_windows(band_number):
+                        data = src.read(band_number, window=window)
+                        (row_start, row_stop), (col_start, col_stop) = window.toranges() if hasattr(window, 'toranges') else window
+                        cache[band_number - 1, row_start:row_stop, col_start:col_stop] = data
+                cache.flush()
+                del cache
+                transform = getattr(src, 'transform', None)
+                if not hasattr(transform, 'to_gdal'):
+                    transform = src.affine
+                shape, nodata, crs = (src.count, src.height, src.width), src.nodata, src.crs
+            os.replace(temporary_file_name, self.cache_file)
+        finally:
+            if os.path.exists(temporary_file_name):
+                os.remove(temporary_file_name)
+        write_memmap_metadata(self.cache_file, dtype, shape, transform=transform, nodata=nodata, crs=crs,
+                              version=CACHE_VERSION, signature=signature, checksum=self.source_checksum(),
+                              source=os.path.abspath(self.file_path))
+        logger.info("Cached raster %s in %.2f seconds." % (self.file_path, timeit.default_timer() - start_time))
+
+    def load(self, mode='c'):
+        """
+        Opens the cache file (see :class:`MemmapRasterReader`), after (re)building it from the source raster if needed.
+
+        :param string mode: The memory-mapping mode: ``'c'`` (copy-on-write, default) or ``'r'`` (read-only).
+
+        :rtype: MemmapRasterReader
+
+        """
+        if not self.is_valid():
+            self.build()
+        return MemmapRasterReader(self.cache_file, metadata=self.metadata(), mode=mode)
+
+
+class GridStore(object):
+    """
+    GridStore
+    A class for storing gridded data in a folder: a stack of layers on the same grid, i.e., a (layer, lat, lon) array, together
+    with the shape, affine transformation and coordinate reference system of the grid, and the data type and "nodata" value of
+    every layer (in a JSON file). Every layer is split into chunks (tiles) of :attr:`chunk_shape` pixels, each in its own file:
+    compressed (zlib, in numpy ``.npz`` format) or uncompressed (``.npy``, memory-mapped when read). Chunks containing only
+    "nodata" values (typically oceans, or land for aquatic layers) are not stored at all.
+
+    Reading is lazy: only the chunks overlapping a window, or containing the requested cells, are decompressed (or paged in).
+    A layer is written to a temporary folder first, and only then moved in place, so (re)writing or removing a layer does not
+    touch the other layers, and an interrupted write never leaves a broken layer behind. Other arrays (such as the cell IDs of a
+    model) and attributes can be stored next to the layers.
+
+    :ivar location: The folder of the store.
+    :vartype location: string
+
+    :ivar shape: The (height, width) of the grid, in pixels.
+    :vartype shape: tuple(int, int)
+
+    :ivar chunk_shape: The (height, width) of the chunks, in pixels.
+    :vartype chunk_shape: tuple(int, int)
+
+    :ivar transform: The affine transformation of the grid.
+    :vartype transform: rasterio.transform.Affine
+
+    :ivar attributes: Any other information stored with the grid.
+    :vartype attributes: dict
+    """
+    _lock = threading.Lock()
+
+    def __init__(self, location, shape=None, transform=None, crs=None, chunk_shape=(1024, 1024), compress=True, **attributes):
+        if not location:
+            raise AttributeError("Please provide the location of the grid store.")
+        self.location = location
+        metadata_file = os.path.join(location, GRID_STORE_METADATA_FILE)
+        if os.path.exists(metadata_file):
+            with open(metadata_file) as grid_file:
+                self.metadata = json.load(grid_file)
+            if self.metadata.get('version') != CACHE_VERSION:
+                raise AttributeError("The grid store %s was written by another version." % location)
+            if shape is not None and tuple(shape) != tuple(self.metadata['shape']):
+                raise AttributeError("The grid store %s has shape %s, instead of %s." % (location, tuple(self.metadata['shape']), tuple(shape)))
+            if transform is not None and not np.allclose(transform.to_gdal(), self.metadata['transform']):
+                raise AttributeError("The grid store %s has another affine transformation." % location)
+            if attributes:
+                self.metadata['attributes'].update(attributes)
+                self._write_metadata()
+        else:
+            if shape is None:
+                raise AttributeError("There is no grid store in %s. Please provide the shape of the grid to create one." % location)
+            if not os.path.exists(location):
+                os.makedirs(location)
+            self.metadata = {'version': CACHE_VERSION,
+                             'shape': [int(size) for size in shape],
+                             'chunk_shape': [int(size) for size in chunk_shape],
+                             'transform': list(transform.to_gdal()) if transform is not None else None,
+                             'crs': _crs_to_string(crs),
+                             'compress': bool(compress),
+                             'layers': [],
+                             'attributes': dict(attributes)}
+            self._write_metadata()
+
+    @property
+    def shape(self):
+        return tuple(self.metadata['shape'])
+
+    @property
+    def chunk_shape(self):
+        return tuple(self.metadata['chunk_shape'])
+
+    @property
+    def transform(self):
+        from rasterio.transform import Affine
+        return Affine.from_gdal(*self.metadata['transform']) if self.metadata['transform'] is not None else None
+
+    @property
+    def crs(self):
+        return _crs_from_string(self.metadata['crs'])
+
+    @property
+    def attributes(self):
+        return self.metadata['attributes']
+
+    @property
+    def layers(self):
+        """
+        The names of the stored layers, in the order they were (first) written.
+
+        :rtype: list(string)
+
+        """
+        return [layer['name'] for layer in self.metadata['layers']]
+
+    def layer_metadata(self, name_layer):
+        """
+        :returns: The (folder) name, data type and "nodata" value of a stored layer.
+
+        :rtype: dict
+
+        """
+        for layer in self.metadata['layers']:
+            if layer['name'] == name_layer:
+                return layer
+        raise KeyError("There is no layer %s in the grid store %s." % (name_layer, self.location))
+
+    def _write_metadata(self):
+        temporary_file_name = os.path.join(self.location, "%s.%s.tmp" % (GRID_STORE_METADATA_FILE, threading.current_thread().ident))
+        with open(temporary_file_name, "w") as metadata_file:
+            json.dump(self.metadata, metadata_file)
+        os.replace(temporary_file_name, os.path.join(self.location, GRID_STORE_METADATA_FILE))
+
+    def chunk_rows(self):
+        """
+        Iterates over the rows of chunks of the grid.
+
+        :returns: A generator of (row_start, row_stop) ranges.
+
+        :rtype: generator
+
+        """
+        height, chunk_height = self.shape[0], self.chunk_shape[0]
+        for row_start in range(0, height, chunk_height):
+            yield row_start, min(row_start + chunk_height, height)
+
+    def write_layer(self, name_layer, data, dtype=None, nodata=None):
+        """
+        Writes (or overwrites) a layer, chunk by chunk.
+
+        :param string name_layer: The name of the layer.
+
+        :param data: The data of the layer: either a 2-dimensional array (which may be memory-mapped) of the grid shape, or \
+        an iterable of full-width strips, one per row of chunks (see :func:`chunk_rows`), in order. The latter allows writing \
+        a layer without ever having all of it in memory.
+
+        :param dtype: The data type of the layer. Default is the data type of the (first strip of) data.
+
+        :param nodata: The value of the missing pixels, which are not stored. Default is NaN for floating-point layers.
+
+        :returns: None
+
+        """
+        start_time = timeit.default_timer()
+        if hasattr(data, 'shape'):
+            if tuple(data.shape) != self.shape:
+                raise AttributeError("The layer %s has shape %s, instead of %s." % (name_layer, tuple(data.shape), self.shape))
+            array = data
+            data = (array[row_start:row_stop] for row_start, row_stop in self.chunk_rows())
+        folder_name = re.sub(r'[^\w.-]', '_', name_layer)
+        with self._lock:
+            taken = [layer['folder'] for layer in self.metadata['layers'] if layer['name'] != name_layer]
+        while folder_name in taken:
+            folder_name += "_"
+        chunk_width = self.chunk_shape[1]
+        temporary_folder = os.path.join(self.location, "%s.%s.tmp" % (folder_name, threading.current_thread().ident))
+        os.makedirs(temporary_folder)
+        try:
+            stored_chunks = 0
+            for chunk_row, ((row_start, row_stop), strip) in enumerate(zip(self.chunk_rows(), data)):
+                strip = np.asarray(strip)
+                if strip.shape != (row_stop - row_start, self.shape[1]):
+                    raise AttributeError("The strip of the layer %s starting at row %s has shape %s, instead of %s."
+                                         % (name_layer, row_start, strip.shape, (row_stop - row_start, self.shape[1])))
+                if dtype is None:
+                    dtype = strip.dtype
+                if nodata is None and np.dtype(dtype).kind == 'f':
+                    nodata = np.nan
+                strip = strip.astype(dtype, copy=False)
+                for chunk_column, col_start in enumerate(range(0, self.shape[1], chunk_width)):
+                    chunk = strip[:, col_start:col_start + chunk_width]
+                    if nodata is not None and (np.isnan(chunk).all() if np.isnan(nodata) else (chunk == nodata).all()):
+                        continue
+                    chunk_file = os.path.join(temporary_folder, "%s_%s" % (chunk_row, chunk_column))
+                    if self.metadata['compress']:
+                        np.savez_compressed(chunk_file, data=chunk)
+                    else:
+                        np.save(chunk_file, np.ascontiguousarray(chunk))
+                    stored_chunks += 1
+            with self._lock:
+                layer_folder = os.path.join(self.location, folder_name)
+                if os.path.exists(layer_folder):
+                    shutil.rmtree(layer_folder)
+                os.replace(temporary_folder, layer_folder)
+                layer = {'name': name_layer, 'folder': folder_name, 'dtype': np.dtype(dtype).str,
+                         'nodata': nodata.item() if hasattr(nodata, 'item') else nodata}
+                layers = self.metadata['layers']
+                names = [stored['name'] for stored in layers]
+                if name_layer in names:
+                    position = names.index(name_layer)
+                    if layers[position]['folder'] != folder_name:
+                        shutil.rmtree(os.path.join(self.location, layers[position]['folder']), ignore_errors=True)
+                    layers[position] = layer
+                else:
+                    layers.append(layer)
+                self._write_metadata()
+        finally:
+            if os.path.exists(temporary_folder):
+                shutil.rmtree(temporary_folder)
+        logger.info("Stored layer %s (%s chunks) in %.2f seconds." % (name_layer, stored_chunks, timeit.default_timer() - start_time))
+
+    def remove_layer(self, name_layer):
+        """
+        Removes a layer from the store.
+
+        :returns: None
+
+        """
+        with self._lock:
+            layer = self.layer_metadata(name_layer)
+            self.metadata['layers'].remove(layer)
+            self._write_metadata()
+            shutil.rmtree(os.path.join(self.location, layer['folder']), ignore_errors=True)
+
+    def read_chunk(self, name_layer, chunk_row, chunk_column):
+        """
+        Reads a single chunk of a layer: decompressed, or memory-mapped (read-only) if the store is not compressed.
+
+        :returns: The pixel values of the chunk, or None if the chunk contains only "nodata" values (and was not stored).
+
+        :rtype: np.ndarray
+
+        """
+        layer = self.layer_metadata(name_layer)
+        chunk_file = os.path.join(self.location, layer['folder'], "%s_%s" % (chunk_row, chunk_column))
+        if self.metadata['compress']:
+            if not os.path.exists(chunk_file + ".npz"):
+                return None
+            with np.load(chunk_file + ".npz") as chunk:
+                return chunk['data']
+        if not os.path.exists(chunk_file + ".npy"):
+            return None
+        return np.load(chunk_file + ".npy", mmap_mode='r')
+
+    def read(self, name_layer, window=None):
+        """
+        Reads a layer, or only a window of it, from the chunks overlapping the window.
+
+        :param string name_layer: The name of the layer.
+
+        :param tuple window: Only read this ((row_start, row_stop), (col_start, col_stop)) window. Default is the entire layer.
+
+        :rtype: np.ndarray
+
+        """
+        layer = self.layer_metadata(name_layer)
+        (row_start, row_stop), (col_start, col_stop) = window if window is not None else ((0, self.shape[0]), (0, self.shape[1]))
+        nodata = layer['nodata']
+        data = np.full((row_stop - row_start, col_stop - col_start), nodata if nodata is not None else 0, dtype=np.dtype(layer['dtype']))
+        chunk_height, chunk_width = self.chunk_shape
+        for chunk_row in range(row_start // chunk_height, (row_stop - 1) // chunk_height + 1):
+            for chunk_column in range(col_start // chunk_width, (col_stop - 1) // chunk_width + 1):
+                chunk = self.read_chunk(name_layer, chunk_row, chunk_column)
+                if chunk is None:
+                    continue
+                top, left = chunk_row * chunk_height, chunk_column * chunk_width
+                rows = slice(max(row_start, top), min(row_stop, top + chunk.shape[0]))
+                columns = slice(max(col_start, left), min(col_stop, left + chunk.shape[1]))
+                data[rows.start - row_start:rows.stop - row_start, columns.start - col_start:columns.stop - col_start] = \
+                    chunk[rows.start - top:rows.stop - top, columns.start - left:columns.stop - left]
+        return data
+
+    def strips(self, name_layer):
+        """
+        Iterates over a layer in full-width strips, one per row of chunks, so that the layer never needs to be loaded entirely.
+
+        :returns: A generator of (window, data) tuples, with the ((row_start, row_stop), (0, width)) window in the grid, \
+        and the pixel values in it (as ``RasterEnvironmentalLayer.blocks()``).
+
+        :rtype: generator
+
+        """
+        for row_start, row_stop in self.chunk_rows():
+            window = ((row_start, row_stop), (0, self.shape[1]))
+            yield window, self.read(name_layer, window=window)
+
+    def read_cells(self, name_layer, cell_ids=None):
+        """
+        Reads the values of a layer at some cells (pixels) only, reading only the chunks containing them.
+
+        :param string name_layer: The name of the layer.
+
+        :param np.ndarray cell_ids: The cell IDs (``row * width + col``) of the pixels. Default is all pixels, in row-major order.
+
+        :returns: The pixel values, in the order of the cell IDs.
+
+        :rtype: np.ndarray
+
+        """
+        layer = self.layer_metadata(name_layer)
+        height, width = self.shape
+        if cell_ids is None:
+            values = np.empty(height * width, dtype=np.dtype(layer['dtype']))
+            for ((row_start, row_stop), _), strip in self.strips(name_layer):
+                values[row_start * width:row_stop * width] = strip.reshape(-1)
+            return values
+        nodata = layer['nodata']
+        values = np.full(cell_ids.shape[0], nodata if nodata is not None else 0, dtype=np.dtype(layer['dtype']))
+        chunk_height, chunk_width = self.chunk_shape
+        rows, columns = cell_ids // width, cell_ids % width
+        chunk_ids = (rows // chunk_height) * ((width - 1) // chunk_width + 1) + columns // chunk_width
+        order = np.argsort(chunk_ids, kind='mergesort')
+        boundaries = np.flatnonzero(np.diff(chunk_ids[order])) + 1
+        for positions in np.split(order, boundaries):
+            if positions.shape[0] == 0:
+                continue
+            chunk_row, chunk_column = rows[positions[0]] // chunk_height, columns[positions[0]] // chunk_width
+            chunk = self.read_chunk(name_layer, chunk_row, chunk_column)
+            if chunk is not None:
+                values[positions] = chunk[rows[positions] - chunk_row * chunk_height, columns[positions] - chunk_column * chunk_width]
+        return values
+
+    def write_array(self, name, array):
+        """
+        Stores any other (1-dimensional) array next to the layers, uncompressed.
+
+        :returns: None
+
+        """
+        temporary_file_name = os.path.join(self.location, "%s.%s.tmp.npy" % (name, threading.current_thread().ident))
+        np.save(temporary_file_name, array)
+        os.replace(temporary_file_name, os.path.join(self.location, name + ".npy"))
+
+    def read_array(self, name):
+        """
+        Reads (memory-maps) an array stored with :func:`write_array`.
+
+        :returns: The array, or None if there is no such array.
+
+        :rtype: np.ndarray
+
+        """
+        file_name = os.path.join(self.location, name + ".npy")
+        return np.load(file_name, mmap_mode='r') if os.path.exists(file_name) else None
+
+    def remove_array(self, name):
+        file_name = os.path.join(self.location, name + ".npy")
+        if os.path.exists(file_name):
+            os.remove(file_name)
+
+
+def load_vector(file_path, bbox=None, filters=None, columns=None, cache=False, cache_location=None):
+    """
+    Loads vector data (typically an ESRI shapefile) into a ``geopandas.GeoDataFrame``, with lower-case column names.
+    Optionally, only the geometries intersecting a bounding box, the records matching attribute filters, and a subset of the
+    (attribute) columns are loaded. With :attr:`cache`, the data is loaded through a :class:`VectorCache`, which is built from
+    the source data on first use, and reloads much faster afterwards. If the cache cannot be used (for example, if ``pyarrow``
+    is not installed, or the cache location is not writable), the data is loaded from the source directly.
+
+    :param string file_path: The full path to the shapefile (or the folder containing it).
+
+    :param tuple bbox: Only load the geometries intersecting this (minx, miny, maxx, maxy) bounding box.
+
+    :param list filters: Only load the records matching these filters, see :func:`VectorCache.read`.
+
+    :param list columns: Only load these (attribute) columns. The geometry column is always loaded.
+
+    :param bool cache: Whether to load the data through a (binary) cache. Default is False.
+
+    :param string cache_location: The folder where the cache file is stored. Default is next to the source data.
+
+    :returns: The data.
+
+    :rtype: geopandas.GeoDataFrame
+
+    """
+    if cache:
+        try:
+            return VectorCache(file_path, cache_location=cache_location).load(bbox=bbox, filters=filters, columns=columns)
+        except ImportError:
+            logger.error("Please install pyarrow for caching the data. Loading %s without a cache." % file_path)
+        except (IOError, OSError) as e:
+            logger.error("Problem using the cache for %s: %s. Loading without a cache." % (file_path, str(e)))
+    from iSDM.species import Species
+    if bbox is not None:
+        data = GeoDataFrame.from_file(file_path, bbox=tuple(bbox))
+    else:
+        data = GeoDataFrame.from_file(file_path)
+    data.columns = [x.lower() for x in data.columns]
+    if filters:
+        data = data[Species._filters_mask(data, filters)]
+        data.reset_index(drop=True, inplace=True)
+    if columns is not None:
+        geometry_column = getattr(data, '_geometry_column_name', 'geometry')
+        data = data[[column for column in data.columns if column in columns or column == geometry_column]]
+    return data
+
+
+def _memmap_shape(shape):
+    # (height, width) for a single band, or (bands, height, width)
+    shape = tuple(int(size) for size in shape)
+    return shape if len(shape) == 3 else (1,) + shape
+
+
+def _crs_to_string(crs):
+    # older geopandas versions keep the crs as a dictionary (e.g., {'init': 'epsg:4326'}), newer ones as a pyproj.CRS
+    if crs is None or isinstance(crs, str):
+        return crs
+    if isinstance(crs, dict):
+        return json.dumps(crs)
+    if hasattr(crs, 'to_wkt'):
+        return crs.to_wkt()
+    return str(crs)
+
+
+def _crs_from_string(crs):
+    if crs is None:
+        return None
+    try:
+        return json.loads(crs)
+    except ValueError:
+        return crs
@@ -8,6 +8,7 @@ A module for all environmental layers functionality.
 
 import logging
 from enum import Enum
+from collections import OrderedDict
 import pprint
 from rasterio.warp import calculate_default_transform, RESAMPLING
 # from iSDM.species import IUCNSpecies
@@ -24,7 +25,14 @@ from descartes import PolygonPatch
 import shapely
 from rasterio import features
 from shapely.geometry import Polygon
-import gc
+import hashlib
+import json
+import os
+import threading
+import timeit
+from concurrent.futures import ThreadPoolExecutor
+from iSDM.geometry import points_from_xy, grid_transform
+from iSDM.cache import load_vector, MemmapRasterReader, RasterCache, read_memmap_metadata, write_memmap_metadata, CACHE_VERSION
 
 logger = logging.getLogger('iSDM.environment')
 logger.setLevel(logging.DEBUG)
@@ -186,13 +194,63 @@ class RasterEnvironmentalLayer(EnvironmentalLayer):
         if raster_data is None:
             logger.info("No raster data provided, attempting to load default...")
             try:
-                raster_data = self.load_data(self.file_path).read(band_number)  # we work on one layer, the first
-                logger.info("Succesfully loaded existing raster data from %s." % self.file_path)
+                self.load_data(self.file_path)
+                logger.info("Succesfully opened existing raster data from %s." % self.file_path)
             except AttributeError as e:
                 logger.error("Could not open raster file. %s " % str(e))
                 raise AttributeError(e)
+            # the band is read (and transformed) strip by strip, it is never loaded entirely
+            return self._blocks_to_world_coordinates(band_number, filter_no_data_value, no_data_value)
 
         logger.info("Transforming to world coordinates...")
+        transform = self._grid_transform(raster_data.shape)
+        if transform is None:
+            return
+        logger.debug("Raster data shape: %s " % (raster_data.shape,))
+        # the selected pixels are looked up in the (cached) latitudes of the rows and longitudes of the columns,
+        # without a floating-point copy of the raster
+        if filter_no_data_value:
+            logger.info("Filtering out no_data pixels.")
+            selected = raster_data != no_data_value
+            if np.issubdtype(raster_data.dtype, np.floating):
+                selected &= ~np.isnan(raster_data)
+        else:
+            selected = raster_data != 0
+        coordinates = transform.mask_to_world(selected)
+        logger.info("Transformation to world coordinates completed.")
+        return coordinates
+
+    def _blocks_to_world_coordinates(self, band_number, filter_no_data_value, no_data_value):
+        logger.info("Transforming to world coordinates block by block...")
+        transform = self._grid_transform((self.raster_reader.height, self.raster_reader.width))
+        if transform is None:
+            return
+        latitudes, longitudes = [], []
+        for ((row_start, _), (col_start, _)), block in self.blocks(band_number, window_rows=self.strip_rows(band_number)):
+            # the same pixels as with the entire band in memory: data pixels, or (without filtering) all nonzero pixels
+            if filter_no_data_value:
+                selected = block != no_data_value
+                if np.issubdtype(block.dtype, np.floating):
+                    selected &= ~np.isnan(block)
+            else:
+                selected = block != 0
+            block_latitudes, block_longitudes = transform.mask_to_world(selected, row_start, col_start)
+            del selected
+            latitudes.append(block_latitudes)
+            longitudes.append(block_longitudes)
+        logger.info("Transformation to world coordinates completed.")
+        if not latitudes:
+            return (np.array([]), np.array([]))
+        return (np.concatenate(latitudes), np.concatenate(longitudes))
+
+    def _grid_transform(self, shape):
+        # the (cached, separable) transformation from the pixels of a raster map of this shape to world coordinates
+        T0 = self._raster_affine(shape)
+        if T0 is None:
+            return
+        return grid_transform(T0, shape)
+
+    def _raster_affine(self, shape):
         # first get the original Affine transformation matrix
         if hasattr(self, "raster_affine"):
             T0 = self.raster_affine
@@ -200,27 +258,12 @@ class RasterEnvironmentalLayer(EnvironmentalLayer):
             # try to deduce it
             logger.info("No Affine translation defined for this layer, trying to deduce it.")
             x_min, y_min, x_max, y_max = -180, -90, 180, 90
-            pixel_size = (x_max - x_min) / raster_data.shape[1]
-            if pixel_size != (y_max - y_min) / raster_data.shape[0]:
+            pixel_size = (x_max - x_min) / shape[1]
+            if pixel_size != (y_max - y_min) / shape[0]:
                 logger.error("Could not deduce Affine transformation...possibly the pixel is not a square.")
                 return
             T0 = Affine(pixel_size, 0.0, x_min, 0.0, -pixel_size, y_max)
-        # convert it to gdal format (it is otherwise flipped)
-        T0 = Affine(*reversed(T0.to_gdal()))
-        logger.debug("Affine transformation T0:\n %s " % (T0,))
-        # shift by 50% to get the pixel center
-        T1 = T0 * Affine.translation(0.5, 0.5)
-        # apply the shift, filtering out no_data_value values
-        logger.debug("Raster data shape: %s " % (raster_data.shape,))
-        logger.debug("Affine transformation T1:\n %s " % (T1,))
-        if filter_no_data_value:
-            logger.info("Filtering out no_data pixels.")
-            raster_data = np.where(raster_data != no_data_value, raster_data, np.nan)
-            coordinates = (T1 * np.where(~np.isnan(raster_data)))
-        else:
-            coordinates = (T1 * np.where(raster_data))
-        logger.info("Transformation to world coordinates completed.")
-        return coordinates
+        return T0
 
     @classmethod
     def __geometrize__(cls,
@@ -250,34 +293,23 @@ class RasterEnvironmentalLayer(EnvironmentalLayer):
         :returns: geopandas.GeoDataFrame
 
         """
-        if not isinstance(data, pd.DataFrame) or not data:
+        if not isinstance(data, pd.DataFrame) or data.empty:
             logger.info("Please provide the data parameter as a pandas.DataFrame.")
             return
 
+        data_geo = None
         try:
             if crs is None:
                 crs = {'init': "EPSG:4326"}
-            # exclude those points with NaN in plot_world_coordinates
+            # exclude those points with NaN in plot_world_coordinates (in either of them, so the geometries stay aligned)
+            if dropna:
+                data = data.dropna(subset=[latitude_col_name, longitude_col_name])
+            geometry = points_from_xy(data[longitude_col_name], data[latitude_col_name])
+            data_geo = GeoDataFrame(data, crs=crs, geometry=geometry)
+            logger.info("Data geometrized: converted into GeoPandas dataframe.")
             if dropna:
-                geometry = [Point(xy) for xy in zip(
-                    data[longitude_col_name].dropna(),
-                    data[latitude_col_name].dropna()
-                )]
-                data_geo = GeoDataFrame(
-                    data.dropna(
-                        subset=[latitude_col_name, longitude_col_name]),
-                    crs=crs,
-                    geometry=geometry)
-                logger.info("Data geometrized: converted into GeoPandas dataframe.")
                 logger.info("Points with NaN coordinates ignored. ")
-            else:
-                geometry = [Point(xy) for xy in zip(
-                    data[longitude_col_name],
-                    data[latitude_col_name]
-                )]
-                data_geo = GeoDataFrame(data, crs=crs, geometry=geometry)
-                logger.info("Data geometrized: converted into GeoPandas dataframe.")
-        except AttributeError:
+        except (AttributeError, KeyError):
             logger.error("No latitude/longitude data to convert into a geometry. Please load the data first.")
         return data_geo
 
@@ -428,13 +460,115 @@ class RasterEnvironmentalLayer(EnvironmentalLayer):
             return
         return self.raster_reader
 
-    def read(self, band_number=1):
+    def read(self, band_number=1, window=None):
+        """
+        Read a particular band from the raster data array, or only a window of it.
+
+        :param int band_number: The index of the band to read.
+
+        :param tuple window: Only read the pixels in this ((row_start, row_stop), (col_start, col_stop)) window. \
+        Default is the entire band.
+
+        :returns: A 2-dimensional Numpy array containing the pixel values of that particular band (window).
+
+        """
+        if not hasattr(self, 'raster_reader'):
+            raise AttributeError("Please load the data first, using .load_data()")
+        if not self.raster_reader or self.raster_reader.closed:
+            logger.info("The dataset is closed. Please load it first using .load_data()")
+            return
+        if window is None:
+            return self.raster_reader.read(band_number)
+        return self.raster_reader.read(band_number, window=self._rasterio_window(window))
+
+    @classmethod
+    def _rasterio_window(cls, window):
+        # rasterio 1.0+ windows are Window objects, older versions take the ((row_start, row_stop), (col_start, col_stop)) tuple
+        try:
+            from rasterio.windows import Window
+        except ImportError:
+            return window
+        return Window.from_slices(*window)
+
+    @classmethod
+    def _window_ranges(cls, window):
+        if hasattr(window, 'toranges'):
+            window = window.toranges()
+        (row_start, row_stop), (col_start, col_stop) = window
+        return ((int(row_start), int(row_stop)), (int(col_start), int(col_stop)))
+
+    def window_from_bounds(self, bounds):
+        """
+        Computes the smallest window of pixels of the (loaded) raster map, which covers the given :attr:`bounds`.
+        The window is clipped to the raster map.
+
+        :param tuple bounds: The (x_min, y_min, x_max, y_max) boundaries to cover, in the coordinates of the raster map.
+
+        :returns: The ((row_start, row_stop), (col_start, col_stop)) window.
+
+        :rtype: tuple
+
+        """
+        if not hasattr(self, 'raster_reader'):
+            raise AttributeError("Please load the data first, using .load_data()")
+        columns, rows = ~self.raster_reader.affine * (np.array([bounds[0], bounds[2]], dtype=np.float64),
+                                                      np.array([bounds[3], bounds[1]], dtype=np.float64))
+        height, width = self.raster_reader.height, self.raster_reader.width
+        row_start = int(min(max(np.floor(rows.min()), 0), height))
+        row_stop = int(min(max(np.ceil(rows.max()), row_start), height))
+        col_start = int(min(max(np.floor(columns.min()), 0), width))
+        col_stop = int(min(max(np.ceil(columns.max()), col_start), width))
+        return ((row_start, row_stop), (col_start, col_stop))
+
+    def read_bounds(self, bounds, band_number=1):
+        """
+        Reads only the pixels of a band covering the given :attr:`bounds` (see :func:`window_from_bounds`), instead of
+        the entire band.
+
+        :param tuple bounds: The (x_min, y_min, x_max, y_max) boundaries to read, in the coordinates of the raster map.
+
+        :param int band_number: The index of the band to read.
+
+        :returns: A tuple of the pixel values (2-dimensional array) and the (row_offset, column_offset) of the window in the raster map.
+
+        :rtype: tuple(np.ndarray, tuple(int, int))
+
+        """
+        window = self.window_from_bounds(bounds)
+        return self.read(band_number, window=window), (window[0][0], window[1][0])
+
+    def strip_rows(self, band_number=1, pixels=2 ** 22):
+        """
+        Computes the number of rows of the (full-width) strips of the raster map which are read together by the block-wise
+        methods, such that a strip contains about :attr:`pixels` pixels. The strips are aligned with the internal blocks
+        (tiles or strips) of the file, so that no block is read (and decompressed) more than once.
+
+        :param int band_number: The index of the band.
+
+        :param int pixels: The (approximate) number of pixels per strip. Default is 4M pixels.
+
+        :rtype: int
+
         """
-        Read a particular band from the raster data array.
+        if not hasattr(self, 'raster_reader'):
+            raise AttributeError("Please load the data first, using .load_data()")
+        block_rows = self.raster_reader.block_shapes[band_number - 1][0]
+        return max(block_rows, (pixels // self.raster_reader.width) // block_rows * block_rows)
+
+    def blocks(self, band_number=1, window_rows=None):
+        """
+        Iterates over a band of the raster map block by block, so that the band never needs to be loaded entirely.
+        By default, the internal blocks (tiles or strips) of the file are followed. With :attr:`window_rows`, the band is
+        read in full-width strips of that many rows instead (see :func:`strip_rows`), in row-major (top to bottom) order.
 
         :param int band_number: The index of the band to read.
 
-        :returns: A 2-dimensional Numpy array containing the pixel values of that particular band.
+        :param int window_rows: The number of rows of every strip. Default is to follow the blocks of the file.
+
+        :returns: A generator of (window, data) tuples, with the ((row_start, row_stop), (col_start, col_stop)) window \
+        in the raster map, and the pixel values (2-dimensional array) in it.
+
+        :rtype: generator
 
         """
         if not hasattr(self, 'raster_reader'):
@@ -442,7 +576,13 @@ class RasterEnvironmentalLayer(EnvironmentalLayer):
         if not self.raster_reader or self.raster_reader.closed:
             logger.info("The dataset is closed. Please load it first using .load_data()")
             return
-        return self.raster_reader.read(band_number)
+        if window_rows is None:
+            windows = (self._window_ranges(window) for _, window in self.raster_reader.block_windows(band_number))
+        else:
+            height, width = self.raster_reader.height, self.raster_reader.width
+            windows = (((row_start, min(row_start + window_rows, height)), (0, width)) for row_start in range(0, height, window_rows))
+        for window in windows:
+            yield window, self.read(band_number, window=window)
 
     def reproject(self, destination_file, source_file=None, resampling=RESAMPLING.nearest, **kwargs):
         """
@@ -502,6 +642,253 @@ class RasterEnvironmentalLayer(EnvironmentalLayer):
                                             )
             logger.info("Reprojected data in %s " % destination_file)
 
+    # the resampling methods of align_to(), and the corresponding (GDAL) warping methods
+    ALIGN_RESAMPLING = OrderedDict([('nearest', 'nearest'), ('mean', 'average'), ('mode', 'mode'), ('sum', 'sum')])
+
+    def align_to(self, grid, resampling='nearest', band_number=1, cache_location=None, max_workers=8, tile_pixels=2 ** 22):
+        """
+        Aligns a band of the raster map to another grid, typically the grid of a ``Model``, so that a layer of a different
+        resolution or extent (an ArcGrid, a GeoTIFF, ...) can be added to the model directly. Unlike :func:`reproject`, no
+        raster file is written band by band: the aligned band is computed in tiles (strips of rows of the target grid),
+        on a pool of threads, directly into a memory-mapped cache file.
+
+        If the target pixels are made of whole source pixels (the pixel size of the target grid is an integer multiple of the
+        source pixel size, and the grids are aligned, in the same coordinate reference system), every target pixel is computed
+        from the block of source pixels it covers (block aggregation), with plain array operations. Otherwise, the tiles are
+        warped with `Rasterio <https://github.com/mapbox/rasterio/blob/master/docs/reproject.rst>`_ reproject(), each from the
+        window of the source raster it covers. Missing ("nodata") source pixels are left out in both cases.
+
+        The result is cached next to the raster file (or in :attr:`cache_location`), and reused as long as the raster file does
+        not change.
+
+        :param grid: The target grid: a ``Model`` (global scale, at the resolution of the model), another (loaded) \
+        ``RasterEnvironmentalLayer``, or an (affine transformation, (height, width)) tuple.
+
+        :param string resampling: How a target pixel is computed from the source pixels it covers: ``'nearest'`` (the \
+        source pixel at its center, default), ``'mean'``, ``'mode'`` (the most frequent value, for categorical data such as \
+        biomes or realms) or ``'sum'``.
+
+        :param int band_number: The index of the band to align.
+
+        :param string cache_location: The folder where the aligned raster is stored. Default is the ``cache_location`` of the \
+        layer, if any (see :class:`MemmapEnvironmentalLayer`), otherwise next to the raster file.
+
+        :param int max_workers: The maximum number of tiles computed at the same time. Default is 8.
+
+        :param int tile_pixels: The (approximate) number of source pixels per tile. Default is 4M pixels.
+
+        :returns: A layer with the aligned band, memory-mapped from the cache file.
+
+        :rtype: MemmapEnvironmentalLayer
+
+        """
+        if resampling not in self.ALIGN_RESAMPLING:
+            raise AttributeError("The resampling can only be one of the following: %s " % list(self.ALIGN_RESAMPLING))
+        if not getattr(self, 'file_path', None):
+            raise AttributeError("Please provide the location of the raster file to align.")
+        if not hasattr(self, 'raster_reader') or self.raster_reader.closed:
+            self.load_data(self.file_path)
+        if cache_location is None:
+            cache_location = getattr(self, 'cache_location', None)
+        dst_transform, dst_shape, dst_crs = self._target_grid(grid)
+        src = self.raster_reader
+        src_dtype, nodata = np.dtype(src.dtypes[band_number - 1]), src.nodata
+        if resampling in ('mean', 'sum'):
+            dtype = np.dtype(np.float64) if resampling == 'sum' else np.result_type(src_dtype, np.float32)
+        else:
+            dtype = src_dtype
+        # the "nodata" value of the aligned band; pixels not covered by any (data) source pixel get this value too
+        if dtype.kind == 'f':
+            dst_nodata = np.nan if nodata is None or resampling in ('mean', 'sum') else nodata
+        else:
+            dst_nodata = nodata if nodata is not None else 0
+
+        aligned_file = self._aligned_cache_file(dst_transform, dst_shape, resampling, band_number, cache_location)
+        stat = os.stat(self.file_path)
+        signature = [stat.st_size, stat.st_mtime]
+        metadata = read_memmap_metadata(aligned_file) if os.path.exists(aligned_file) else None
+        if metadata is not None and metadata.get('version') == CACHE_VERSION and metadata.get('signature') == signature:
+            logger.info("Using the aligned raster %s " % aligned_file)
+            return MemmapEnvironmentalLayer(source=self.source, file_path=aligned_file, name_layer=self.name_layer)
+
+        start_time = timeit.default_timer()
+        factors = self._aggregation_factors(self.raster_affine, dst_transform) if self._same_crs(src.crs, dst_crs) else None
+        if factors is not None:
+            logger.info("Aligning %s by block aggregation (%s x %s source pixels per pixel)." % (self.file_path, factors[0], factors[1]))
+            method = None
+        else:
+            method = getattr(RESAMPLING, self.ALIGN_RESAMPLING[resampling], None)
+            if method is None:
+                raise AttributeError("Resampling with '%s' is not supported by this version of rasterio/GDAL, for a grid which is "
+                                     "not aligned with the raster." % resampling)
+            logger.info("Aligning %s by warping." % self.file_path)
+        source_row_pixels = dst_shape[1] * (factors[0] * factors[1] if factors is not None else 1)
+        tile_rows = max(1, tile_pixels // max(source_row_pixels, 1))
+        tiles = [(row_start, min(row_start + tile_rows, dst_shape[0])) for row_start in range(0, dst_shape[0], tile_rows)]
+
+        if cache_location and not os.path.exists(cache_location):
+            os.makedirs(cache_location)
+        temporary_file_name = "%s.%s.tmp" % (aligned_file, threading.current_thread().ident)
+        try:
+            aligned = np.memmap(temporary_file_name, dtype=dtype, mode='w+', shape=dst_shape)
+
+            def align_tile(target, tile):
+                if factors is not None:
+                    data = self._aggregate_tile(tile, factors, dst_shape, resampling, band_number, dtype, dst_nodata)
+                else:
+                    data = self._warp_tile(tile, dst_transform, dst_shape, dst_crs, method, band_number, dtype, dst_nodata)
+                # the tiles are disjoint strips of rows, written by one thread each
+                target[tile[0]:tile[1]] = data
+
+            with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(tiles)))) as executor:
+                for done, _ in enumerate(executor.map(align_tile, [aligned] * len(tiles), tiles), start=1):
+                    logger.debug("Aligned tile %s/%s " % (done, len(tiles)))
+            aligned.flush()
+            del aligned
+            os.replace(temporary_file_name, aligned_file)
+        finally:
+            if os.path.exists(temporary_file_name):
+                os.remove(temporary_file_name)
+        write_memmap_metadata(aligned_file, dtype, dst_shape, transform=dst_transform, nodata=dst_nodata, crs=dst_crs,
+                              version=CACHE_VERSION, signature=signature, source=os.path.abspath(self.file_path),
+                              resampling=resampling, band=band_number)
+        logger.info("Aligned %s to a grid of shape %s in %.2f seconds." % (self.file_path, dst_shape, timeit.default_timer() - start_time))
+        return MemmapEnvironmentalLayer(source=self.source, file_path=aligned_file, name_layer=self.name_layer)
+
+    @classmethod
+    def _target_grid(cls, grid):
+        # the (affine transformation, (height, width), crs) of a target grid for align_to()
+        if hasattr(grid, 'base_layer') and hasattr(grid, 'x_res'):
+            # a (global-scale) Model
+            return grid.base_layer.raster_affine, (grid.y_res, grid.x_res), {'init': "EPSG:4326"}
+        if isinstance(grid, RasterEnvironmentalLayer):
+            if not hasattr(grid, 'raster_reader'):
+                raise AttributeError("Please load the data of the target layer first, using .load_data()")
+            return grid.raster_affine, (grid.raster_reader.height, grid.raster_reader.width), grid.raster_reader.crs
+        if isinstance(grid, (tuple, list)) and len(grid) in (2, 3):
+            return grid[0], (int(grid[1][0]), int(grid[1][1])), grid[2] if len(grid) == 3 else None
+        raise AttributeError("Please provide a Model, a RasterEnvironmentalLayer, or an (affine, shape) tuple as the target grid.")
+
+    def _aligned_cache_file(self, dst_transform, dst_shape, resampling, band_number, cache_location):
+        # the name of the cache file of the raster (see iSDM.cache.RasterCache), with the target grid and resampling method
+        cache_file = RasterCache(self.file_path, cache_location=cache_location).cache_file
+        key = hashlib.sha1(json.dumps([list(dst_transform.to_gdal()), list(dst_shape), band_number]).encode('utf-8')).hexdigest()
+        return "%s.%s.%s.aligned.dat" % (cache_file[:-len(".cache.dat")], resampling, key[:12])
+
+    @classmethod
+    def _same_crs(cls, crs, other_crs):
+        # an unknown crs is taken to be the same; older rasterio versions keep the crs as a dictionary (e.g., {'init': 'epsg:4326'})
+        if crs is None or other_crs is None or crs == other_crs:
+            return True
+
+        def normalized(value):
+            return json.dumps(value, sort_keys=True).lower() if isinstance(value, dict) else str(value).lower()
+        return normalized(crs) == normalized(other_crs)
+
+    @classmethod
+    def _aggregation_factors(cls, src_transform, dst_transform, tolerance=1e-6):
+        # (rows, columns) of source pixels per target pixel, and the (row, column) of the target grid origin in the source
+        # raster, if the target pixels are made of whole source pixels; None otherwise
+        if src_transform.b != 0 or src_transform.d != 0 or dst_transform.b != 0 or dst_transform.d != 0:
+            return None
+        values = [dst_transform.e / src_transform.e, dst_transform.a / src_transform.a,
+                  (dst_transform.f - src_transform.f) / src_transform.e, (dst_transform.c - src_transform.c) / src_transform.a]
+        rounded = [int(round(value)) for value in values]
+        if any(abs(value - integer) > tolerance for value, integer in zip(values, rounded)) or rounded[0] < 1 or rounded[1] < 1:
+            return None
+        return tuple(rounded)
+
+    def _read_window_threadsafe(self, band_number, window):
+        # a rasterio dataset is not to be shared among threads: every call opens its own (memory-mapped readers can be shared)
+        if isinstance(self.raster_reader, MemmapRasterReader):
+            return self.raster_reader.read(band_number, window=window)
+        with rasterio.open(self.raster_reader.name) as src:
+            return src.read(band_number, window=self._rasterio_window(window))
+
+    def _aggregate_tile(self, tile, factors, dst_shape, resampling, band_number, dtype, dst_nodata):
+        # computes the target rows [tile[0], tile[1]) from the blocks of source pixels they cover
+        (row_start, row_stop), (block_rows, block_columns, row_offset, column_offset) = tile, factors
+        height, width = self.raster_reader.height, self.raster_reader.width
+        tile_rows, tile_columns = row_stop - row_start, dst_shape[1]
+        top, left = row_start * block_rows + row_offset, column_offset
+        bottom, right = top + tile_rows * block_rows, left + tile_columns * block_columns
+        source = np.zeros((tile_rows * block_rows, tile_columns * block_columns), dtype=self.raster_reader.dtypes[band_number - 1])
+        valid = np.zeros(source.shape, dtype=bool)
+        rows = (max(top, 0), min(bottom, height))
+        columns = (max(left, 0), min(right, width))
+        if rows[0] < rows[1] and columns[0] < columns[1]:
+            data = self._read_window_threadsafe(band_number, (rows, columns))
+            covered = (slice(rows[0] - top, rows[1] - top), slice(columns[0] - left, columns[1] - left))
+            source[covered] = data
+            valid[covered] = True
+            if self.raster_reader.nodata is not None:
+                valid[covered] &= data != self.raster_reader.nodata
+            if np.issubdtype(data.dtype, np.floating):
+                valid[covered] &= ~np.isnan(data)
+            del data
+        # (tile_rows, tile_columns, source pixels per target pixel)
+        shape = (tile_rows, tile_columns, block_rows * block_columns)
+        source = source.reshape(tile_rows, block_rows, tile_columns, block_columns).transpose(0, 2, 1, 3).reshape(shape)
+        valid = valid.reshape(tile_rows, block_rows, tile_columns, block_columns).transpose(0, 2, 1, 3).reshape(shape)
+        if resampling == 'nearest':
+            center = (block_rows // 2) * block_columns + block_columns // 2
+            return np.where(valid[..., center], source[..., center], dst_nodata).astype(dtype)
+        if resampling in ('mean', 'sum'):
+            counts = valid.sum(axis=-1)
+            totals = np.where(valid, source, 0).sum(axis=-1, dtype=np.float64)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                values = totals if resampling == 'sum' else totals / counts
+            return np.where(counts > 0, values, dst_nodata).astype(dtype)
+        return self._block_mode(source, valid, dst_nodata).astype(dtype)
+
+    @classmethod
+    def _block_mode(cls, source, valid, nodata):
+        # the most frequent valid value along the last axis (the smallest one in case of a tie), nodata without any valid value
+        positions = np.arange(source.shape[-1])
+        # valid values first, in ascending order
+        order = np.lexsort((source, ~valid), axis=-1)
+        values = np.take_along_axis(source, order, axis=-1)
+        kept = np.take_along_axis(valid, order, axis=-1)
+        starts = np.ones(values.shape, dtype=bool)
+        starts[..., 1:] = values[..., 1:] != values[..., :-1]
+        # the length of the run of equal values up to every position
+        run_starts = np.maximum.accumulate(np.where(starts, positions, 0), axis=-1)
+        lengths = np.where(kept, positions - run_starts + 1, 0)
+        longest = np.argmax(lengths, axis=-1)[..., np.newaxis]
+        mode = np.take_along_axis(values, longest, axis=-1)[..., 0]
+        return np.where(np.take_along_axis(lengths, longest, axis=-1)[..., 0] > 0, mode, nodata)
+
+    def _warp_tile(self, tile, dst_transform, dst_shape, dst_crs, method, band_number, dtype, dst_nodata):
+        # warps the target rows [tile[0], tile[1]) from the window of the source raster they cover
+        from rasterio.warp import reproject, transform_bounds
+        row_start, row_stop = tile
+        tile_transform = dst_transform * Affine.translation(0, row_start)
+        destination = np.full((row_stop - row_start, dst_shape[1]), dst_nodata, dtype=dtype)
+        left, top = tile_transform * (0, 0)
+        right, bottom = tile_transform * (dst_shape[1], row_stop - row_start)
+        bounds = (min(left, right), min(top, bottom), max(left, right), max(top, bottom))
+        src_crs = self.raster_reader.crs
+        if not self._same_crs(src_crs, dst_crs):
+            bounds = transform_bounds(dst_crs, src_crs, *bounds)
+        (src_row_start, src_row_stop), (src_col_start, src_col_stop) = self.window_from_bounds(bounds)
+        # a margin of source pixels around the window, for the resampling kernels
+        src_row_start, src_col_start = max(src_row_start - 2, 0), max(src_col_start - 2, 0)
+        src_row_stop = min(src_row_stop + 2, self.raster_reader.height)
+        src_col_stop = min(src_col_stop + 2, self.raster_reader.width)
+        if src_row_start >= src_row_stop or src_col_start >= src_col_stop:
+            return destination
+        source = self._read_window_threadsafe(band_number, ((src_row_start, src_row_stop), (src_col_start, src_col_stop)))
+        reproject(source=source,
+                  destination=destination,
+                  src_transform=self.raster_affine * Affine.translation(src_col_start, src_row_start),
+                  src_crs=src_crs,
+                  src_nodata=self.raster_reader.nodata,
+                  dst_transform=tile_transform,
+                  dst_crs=dst_crs if dst_crs is not None else src_crs,
+                  dst_nodata=dst_nodata,
+                  resampling=method)
+        return destination
+
     # def overlay(self, range_map):
     #     """
     #     Extract mask from a raster map, where it intersects with a vector feature, like a polygon.
@@ -547,144 +934,220 @@ class RasterEnvironmentalLayer(EnvironmentalLayer):
     #     logger.info("Overlayed raster climate data with the given range map.")
     #     logger.info("Use the .masked_data attribute to access it.")
 
-    def sample_pseudo_absences(self,
-                               species_raster_data,
-                               suitable_habitat=None,
-                               bias_grid=None,
-                               band_number=1,
-                               number_of_pseudopoints=1000):
+    def _load_env_raster_data(self, band_number=1):
+        # the environment raster data is read only once, and kept in the layer for any further sampling
+        if getattr(self, 'env_raster_data', None) is None:
+            try:
+                self.env_raster_data = self.read(band_number)
+                logger.info("Succesfully loaded existing raster data from %s." % self.file_path)
+            except AttributeError as e:
+                logger.error("Could not open raster file. %s " % str(e))
+        return self.env_raster_data
+
+    @classmethod
+    def _region_lookup(cls, dtype, regions):
+        # A boolean lookup table indexed directly by the pixel values, for (up to 16-bit) integer rasters.
+        # Signed values are looked up through their unsigned view, so negative region values work as well.
+        dtype = np.dtype(dtype)
+        if dtype.kind not in 'iu' or dtype.itemsize > 2:
+            return None, None
+        unsigned = np.dtype('u%s' % dtype.itemsize)
+        lookup = np.zeros(2 ** (8 * dtype.itemsize), dtype=bool)
+        lookup[np.asarray(regions).astype(dtype).view(unsigned)] = True
+        return lookup, unsigned
+
+    def _select_region_cells(self, env_flattened, regions, block_size=2 ** 22):
         """
-        Samples a :attr:`number_of_pseudopoints` points from the ``RasterEnvironmentalLayer`` data (raster map),
-        based on a given species raster map which is assumed to contain species presence points (or potential presence).
-        The :attr:`species_raster_data` is used to determine which distinct regions (cell values) from the entire
-        environmental raster map, should be taken into account for potential pseudo-absence sampling regions. In other words,
-        which realms or ecoregions should be taken into account.
-        Optionally, suitable habitat raster (with binary, 0/1s values) can be provided to further limit the area of sampling.
-        Finally, presence pixels are removed from this map, and the resulting pixels are used as a base for sampling
-        pseudo-absences. Optionally, a bias grid can be provided to bias the "random" sampling of pseudo absences.
-        If the number of such resulting pixels left is smaller than the number of requested pseudo-absence
-        points, all pixels are automatically taken as pseudo-absence points, and no random sampling is done.
+        Finds all pixels (flat cell indices) of the environmental raster whose value is one of :attr:`regions`, in a
+        single pass over the raster, instead of one full pass per region. The raster is scanned in blocks of
+        :attr:`block_size` pixels, so the temporary boolean masks stay small even for 30 arcsec global rasters.
+        Integer rasters of up to 16 bits use a lookup table, all others ``np.isin``.
 
-        Otherwise, :attr:`number_of_pseudopoints` pixels positions (indices) are randomly chosen at once (for speed),
-        rather than randomly sampling one by one until the desired number of pseudo-absences is reached.
+        :param np.ndarray env_flattened: The (flattened) environmental raster data.
 
-        :param np.ndarray species_raster_data: A raster map containing the species presence pixels. If not provided, \
-        by default the one loaded previously (if available, otherwise .load_data() should be used before) is used.
+        :param np.ndarray regions: The region values (pixel values) to select.
 
-        :param np.ndarray suitable_habitat: A raster map containing the species suitable habitat. It should contain only \
-        values of 0 and 1, 1s depicting a suitable areas, while 0s unsuitable.
+        :param int block_size: Number of pixels scanned at once.
 
-        :param np.ndarray bias_grid: A raster map containing the sampling bias grid. It should contain integer values depicting \
-        a sampling intensity at every pixel location.
+        :returns: The sorted flat cell indices of the pixels in the selected regions.
 
-        :param int band_number: The index of the band from the :attr:`species_raster_data` to use as input. Default is 1.
+        :rtype: np.ndarray
+
+        """
+        blocks = ((block_start, env_flattened[block_start:block_start + block_size])
+                  for block_start in range(0, env_flattened.shape[0], block_size))
+        return self._select_region_cells_in_blocks(blocks, env_flattened.dtype, regions)
+
+    def _select_region_cells_in_blocks(self, blocks, dtype, regions):
+        # blocks: (first flat cell index, flattened pixel values) of consecutive parts of the raster, in row-major order
+        lookup, unsigned = self._region_lookup(dtype, regions)
+        selected_cells = []
+        for block_start, block in blocks:
+            if lookup is not None:
+                in_regions = lookup[block.view(unsigned)]
+            else:
+                in_regions = np.isin(block, regions)
+            selected_cells.append(np.flatnonzero(in_regions) + block_start)
+        if not selected_cells:
+            return np.array([], dtype=np.int64)
+        return np.concatenate(selected_cells).astype(np.int64)
+
+    def _read_cells(self, cells, band_number, window_rows):
+        # the pixel values at the (sorted) flat cell indices, reading only the strips of the band that contain any of them
+        height, width = self.raster_reader.height, self.raster_reader.width
+        values = np.empty(cells.shape[0], dtype=self.raster_reader.dtypes[band_number - 1])
+        strips = (cells // width) // window_rows
+        boundaries = np.concatenate([[0], np.flatnonzero(np.diff(strips)) + 1, [cells.shape[0]]])
+        for start, stop in zip(boundaries[:-1], boundaries[1:]):
+            row_start = int(strips[start]) * window_rows
+            strip = self.read(band_number, window=((row_start, min(row_start + window_rows, height)), (0, width)))
+            values[start:stop] = strip.reshape(-1)[cells[start:stop] - row_start * width]
+        return values
+
+    def _select_region_cells_streamed(self, regions, band_number, window_rows):
+        width = self.raster_reader.width
+        blocks = ((row_start * width, block.reshape(-1))
+                  for ((row_start, _), _), block in self.blocks(band_number, window_rows=window_rows))
+        return self._select_region_cells_in_blocks(blocks, self.raster_reader.dtypes[band_number - 1], regions)
+
+    def sample_pseudo_absences_sparse(self,
+                                      presence_cells=None,
+                                      species_raster_window=None,
+                                      window_offset=(0, 0),
+                                      suitable_habitat=None,
+                                      bias_grid=None,
+                                      band_number=1,
+                                      number_of_pseudopoints=1000,
+                                      window_rows=None):
+        """
+        Sparse version of :func:`sample_pseudo_absences`. Instead of global-scale raster maps, the species presences and the
+        results are flat cell indices (``row * width + col``) in the (global-scale) environmental raster. The sampling logic is
+        the same: all distinct regions (cell values) of the environmental raster which overlap with the presences are candidate
+        regions, the presence pixels are removed from them, optionally they are limited to the suitable habitat, and finally
+        :attr:`number_of_pseudopoints` pixels are sampled, giving priority to the bias grid (if provided).
+        No global-scale temporary maps are created, so the memory needed depends on the size of the species range and the
+        candidate regions, not on the size of the global raster. For a fixed random seed, the sampled pixels are the same as
+        with :func:`sample_pseudo_absences`.
+
+        :param np.ndarray presence_cells: Flat cell indices of the species presence pixels.
+
+        :param np.ndarray species_raster_window: Alternatively, the presences as a (window) raster map with pixel values 1 and 0, \
+        for example the output of ``rasterize_window()`` of a species.
+
+        :param tuple window_offset: The (row_offset, column_offset) of the :attr:`species_raster_window` in the global raster.
+
+        :param np.ndarray suitable_habitat: A (global-scale) raster map containing the species suitable habitat. It should contain \
+        only values of 0 and 1, 1s depicting a suitable areas, while 0s unsuitable. Only the candidate pixels are looked up, so \
+        a memory-mapped array is not loaded entirely.
+
+        :param np.ndarray bias_grid: A (global-scale) raster map containing the sampling bias grid. It should contain integer \
+        values depicting a sampling intensity at every pixel location. Only the candidate pixels are looked up.
+
+        :param int band_number: The index of the band from the environmental raster to use. Default is 1.
 
         :param int number_of_pseudopoints: Number of pseudo-absence points to sample from the raster environmental layer data.
 
-        :returns: A tuple containing two raster maps, one with all potential background pixels chosen to sample from, \
-        and second with all the actual sampled pixels.
+        :param int window_rows: If the environmental raster data is not loaded yet, read it from the file in (full-width) strips \
+        of this many rows (see :func:`blocks` and :func:`strip_rows`), instead of loading the entire band. Only the strips \
+        are kept in memory, at the cost of reading the file again for every species. Default is to load the entire band once.
+
+        :returns: A tuple containing two arrays of sorted flat cell indices: all potential background pixels chosen to sample \
+        from, and the actual sampled pixels.
 
         :rtype: tuple(np.ndarray, np.ndarray)
 
         """
-        if not (isinstance(species_raster_data, np.ndarray)) or not (set(np.unique(species_raster_data)) == set({0, 1})):
-            logger.error("Please provide the species raster data as a numpy array with pixel values 1 and 0 (presence/absence).")
+        streamed = window_rows is not None and getattr(self, 'env_raster_data', None) is None
+        if streamed:
+            if not hasattr(self, 'raster_reader'):
+                raise AttributeError("Please load the data first, using .load_data()")
+            env_shape = (self.raster_reader.height, self.raster_reader.width)
+        else:
+            env_raster_data = self._load_env_raster_data(band_number)
+            env_shape = env_raster_data.shape
+        if species_raster_window is not None:
+            rows, cols = np.nonzero(species_raster_window)
+            presence_cells = (rows + window_offset[0]).astype(np.int64) * env_shape[1] + (cols + window_offset[1])
+            del rows, cols
+        if presence_cells is None:
+            logger.error("Please provide the species presences as flat cell indices, or as a raster window.")
             return
-        if self.raster_reader.closed or not hasattr(self, 'env_raster_data'):
-            try:
-                self.env_raster_data = self.read(band_number)
-                logger.info("Succesfully loaded existing raster data from %s." % self.file_path)
-            except AttributeError as e:
-                logger.error("Could not open raster file. %s " % str(e))
-        if species_raster_data.shape != self.env_raster_data.shape:
-            logger.error("Please provide (global) species raster data at the same resolution as the environment")
-            logger.error("Environment data has the following shape %s " % (self.env_raster_data.shape, ))
+        presence_cells = np.unique(np.asarray(presence_cells, dtype=np.int64))
+        empty_cells = np.array([], dtype=np.int64)
+        if presence_cells.shape[0] == 0:
+            logger.error("There are no species presences to sample pseudo-absences for.")
+            return (empty_cells, empty_cells)
+        if presence_cells[0] < 0 or presence_cells[-1] >= env_shape[0] * env_shape[1]:
+            logger.error("Please provide (global) species presences at the same resolution as the environment")
+            logger.error("Environment data has the following shape %s " % (env_shape, ))
             return
 
         logger.info("Sampling %s pseudo-absence points from environmental layer." % number_of_pseudopoints)
-        # first set to zero all pixels that have "nodata" values in the environmental raster
-        self.env_raster_data[self.env_raster_data == self.raster_reader.nodata] = 0
-        # next get all the overlapping pixels between the species raster and the environment data
-        presences_pixels = self.env_raster_data * species_raster_data
-        # what are the unique values left? (these are the distinct "regions" that need to be taken into account)
-        # Do NOT take into account the 0-value pixel, which we assigned to all "nodata" pixels
-        unique_regions = np.unique(presences_pixels[presences_pixels != 0])
+        if streamed:
+            presence_values = self._read_cells(presence_cells, band_number, window_rows)
+        else:
+            env_flattened = env_raster_data.reshape(-1)
+            presence_values = env_flattened[presence_cells]
+        # the distinct "regions" overlapping with the species presences. Do NOT take into account the 0-value
+        # pixels, nor the "nodata" pixels of the environmental raster.
+        valid_values = presence_values != 0
+        if hasattr(self, 'raster_reader') and self.raster_reader.nodata is not None:
+            valid_values &= presence_values != self.raster_reader.nodata
+        unique_regions = np.unique(presence_values[valid_values])
+        del presence_values, valid_values
         if len(unique_regions) == 0:
             logger.info("There are no environmental layers to sample pseudo-absences from. ")
-            return (np.zeros_like(presences_pixels), np.zeros_like(presences_pixels))
+            return (empty_cells, empty_cells)
         logger.debug("The following unique (region ID) values will be taken into account for sampling pseudo-absences")
         logger.debug(unique_regions)
-        # add the pixels of all these regions to a layer array
-        regions = []
-        for region in unique_regions:
-            regions.append(np.where(self.env_raster_data == region))
-        # now "regions" contains a list of tuples, each tuple with separate x/y indexes (arrays thereof) of the pixels
-        # make an empty "base" matrix and fill it with the selected regions pixel values
-        selected_pixels = np.zeros_like(self.env_raster_data)
-        # pick out only those layers that have been selected and fill in the matrix
-        for layer in regions:
-            selected_pixels[layer] = self.env_raster_data[layer]
-
-        del regions
-        gc.collect()
+        # only pixels with a positive region value are sampled from
+        unique_regions = unique_regions[unique_regions > 0]
+        # the pixels of all these regions, in row-major order (same order as np.where() on the raster map)
+        if streamed:
+            selected_cells = self._select_region_cells_streamed(unique_regions, band_number, window_rows)
+        else:
+            selected_cells = self._select_region_cells(env_flattened, unique_regions)
         # sample from those pixels which are in the selected raster regions, minus those of the species presences
-        pixels_to_sample_from = selected_pixels - presences_pixels
-        del presences_pixels
-        sampled_pixels = np.zeros_like(selected_pixels)
-        del selected_pixels
-        gc.collect()
+        cells_to_sample_from = np.setdiff1d(selected_cells, presence_cells, assume_unique=True)
+        del selected_cells
 
         # next: narrow the area to sample from, to the suitable habitat, if raster data is provided
         if suitable_habitat is not None:
             logger.info("Will limit sampling area to suitable habitat.")
-            # Multiplying the suitable habitat layer (with 1s and 0s) with the
-            # previously selected pixels, will narrow to those common for both.
-            pixels_to_sample_from = pixels_to_sample_from * suitable_habitat
+            cells_to_sample_from = cells_to_sample_from[suitable_habitat.reshape(-1)[cells_to_sample_from] > 0]
 
-        # magic, don't touch :P
+        sampled_cells = empty_cells
         if bias_grid is not None:
             logger.info("Will use the provided bias_grid for sampling.")
-            # common x/y coordinates where bias_grid overlaps with pixels_to_sample_from
-            (x, y) = np.where(pixels_to_sample_from * bias_grid > 0)
-            # how many we have?
-            number_pixels_to_sample_from_bias_grid = x.shape[0]
+            bias_values = bias_grid.reshape(-1)[cells_to_sample_from]
+            # positions (in cells_to_sample_from) where the bias grid is nonzero
+            bias_positions = np.flatnonzero(bias_values > 0)
+            number_pixels_to_sample_from_bias_grid = bias_positions.shape[0]
             logger.info("There are %s nonzero pixels from bias grid to use for sampling." % number_pixels_to_sample_from_bias_grid)
             if number_pixels_to_sample_from_bias_grid == 0:
                 logger.info("No non-zero pixels from bias grid to sample.")
-            if number_pixels_to_sample_from_bias_grid < number_of_pseudopoints:
+            if number_pixels_to_sample_from_bias_grid <= number_of_pseudopoints:
                 logger.info("Will sample all %s nonzero pixels from bias grid." % number_pixels_to_sample_from_bias_grid)
-                # "random" here is not so random as we will select all of them, i.e., the entire range
-                random_indices = np.arange(0, number_pixels_to_sample_from_bias_grid)
-                for position in random_indices:
-                    sampled_pixels[x[position]][y[position]] = pixels_to_sample_from[x[position], y[position]]
+                sampled_cells = cells_to_sample_from[bias_positions]
                 # remove already sampled pixels
-                pixels_to_sample_from = pixels_to_sample_from - sampled_pixels
+                cells_to_sample_from = np.delete(cells_to_sample_from, bias_positions)
                 # Subtract from number of pseudo-points left to sample
                 number_of_pseudopoints = number_of_pseudopoints - number_pixels_to_sample_from_bias_grid
                 logger.info("Number of pseudo-points left to sample after bias_grid sampling: %s " % number_of_pseudopoints)
-            elif number_pixels_to_sample_from_bias_grid > number_of_pseudopoints:
-                # hopefully this will rarely happen, as it is very compute-intensive and memory-hungry
+            else:
                 logger.info("More pixels available to sample from bias grid, than necessary. Selecting top %s" % number_of_pseudopoints)
-                # make a grid of all pixels from bias_grid that overlap with the pixels_to_sample_from
-                pixels_to_sample_from_bias_grid = np.where(pixels_to_sample_from * bias_grid > 0, bias_grid, 0)
                 # find the top number_of_pseudopoints (heighest values)
-                flat_indices = np.argpartition(pixels_to_sample_from_bias_grid.ravel(), -number_of_pseudopoints - 1)[-number_of_pseudopoints:]
-                # some logic to get the indices of the matrix ...
-                row_indices, col_indices = np.unravel_index(flat_indices, pixels_to_sample_from_bias_grid.shape)
-                sampled_pixels[row_indices, col_indices] = pixels_to_sample_from[row_indices, col_indices]
-                del pixels_to_sample_from_bias_grid
-                del row_indices, col_indices, flat_indices
-                gc.collect()
-                return (pixels_to_sample_from, sampled_pixels)
-        # These are x/y positions of pixels to sample from. Tuple of arrays.
-        (x, y) = np.where(pixels_to_sample_from > 0)
-        number_pixels_to_sample_from = x.shape[0]  # == y.shape[0], since every pixel has (x,y) position.
+                top_positions = np.argpartition(bias_values[bias_positions], -number_of_pseudopoints)[-number_of_pseudopoints:]
+                sampled_cells = np.sort(cells_to_sample_from[bias_positions[top_positions]])
+                return (cells_to_sample_from, sampled_cells)
+
+        number_pixels_to_sample_from = cells_to_sample_from.shape[0]
         logger.info("There are %s pixels left to sample from..." % (number_pixels_to_sample_from))
 
         if number_pixels_to_sample_from == 0:
             logger.error("There are no pixels left to sample from. Perhaps the species raster data")
             logger.error("covers the entire range from which it was intended to sample further.")
-            return (pixels_to_sample_from, sampled_pixels)
+            return (cells_to_sample_from, sampled_cells)
 
         if number_pixels_to_sample_from < number_of_pseudopoints:
             logger.warning("There are less pixels to sample from, than the desired number of pseudo-absences")
@@ -702,15 +1165,229 @@ class RasterEnvironmentalLayer(EnvironmentalLayer):
                                               replace=False)
             logger.info("Filling %s random pixel positions..." % (len(random_indices)))
 
-        # fill in those indices with the pixel values of the environment layer
-        for position in random_indices:
-            sampled_pixels[x[position]][y[position]] = pixels_to_sample_from[x[position], y[position]]
+        sampled_cells = np.sort(np.concatenate([sampled_cells, cells_to_sample_from[random_indices]]))
+        logger.info("Sampled %s unique pixels as pseudo-absences." % sampled_cells.shape[0])
+        return (cells_to_sample_from, sampled_cells)
+
+    def sample_pseudo_absences(self,
+                               species_raster_data,
+                               suitable_habitat=None,
+                               bias_grid=None,
+                               band_number=1,
+                               number_of_pseudopoints=1000):
+        """
+        Samples a :attr:`number_of_pseudopoints` points from the ``RasterEnvironmentalLayer`` data (raster map),
+        based on a given species raster map which is assumed to contain species presence points (or potential presence).
+        The :attr:`species_raster_data` is used to determine which distinct regions (cell values) from the entire
+        environmental raster map, should be taken into account for potential pseudo-absence sampling regions. In other words,
+        which realms or ecoregions should be taken into account.
+        Optionally, suitable habitat raster (with binary, 0/1s values) can be provided to further limit the area of sampling.
+        Finally, presence pixels are removed from this map, and the resulting pixels are used as a base for sampling
+        pseudo-absences. Optionally, a bias grid can be provided to bias the "random" sampling of pseudo absences.
+        If the number of such resulting pixels left is smaller than the number of requested pseudo-absence
+        points, all pixels are automatically taken as pseudo-absence points, and no random sampling is done.
+
+        Otherwise, :attr:`number_of_pseudopoints` pixels positions (indices) are randomly chosen at once (for speed),
+        rather than randomly sampling one by one until the desired number of pseudo-absences is reached.
+
+        This is a thin wrapper around :func:`sample_pseudo_absences_sparse`, which converts the flat cell indices back into
+        global-scale raster maps. Prefer the sparse version when the global maps are not needed.
+
+        :param np.ndarray species_raster_data: A raster map containing the species presence pixels. If not provided, \
+        by default the one loaded previously (if available, otherwise .load_data() should be used before) is used.
+
+        :param np.ndarray suitable_habitat: A raster map containing the species suitable habitat. It should contain only \
+        values of 0 and 1, 1s depicting a suitable areas, while 0s unsuitable.
+
+        :param np.ndarray bias_grid: A raster map containing the sampling bias grid. It should contain integer values depicting \
+        a sampling intensity at every pixel location.
+
+        :param int band_number: The index of the band from the :attr:`species_raster_data` to use as input. Default is 1.
+
+        :param int number_of_pseudopoints: Number of pseudo-absence points to sample from the raster environmental layer data.
+
+        :returns: A tuple containing two raster maps, one with all potential background pixels chosen to sample from, \
+        and second with all the actual sampled pixels.
+
+        :rtype: tuple(np.ndarray, np.ndarray)
+
+        """
+        if not (isinstance(species_raster_data, np.ndarray)) or not (set(np.unique(species_raster_data)) == set({0, 1})):
+            logger.error("Please provide the species raster data as a numpy array with pixel values 1 and 0 (presence/absence).")
+            return
+        env_raster_data = self._load_env_raster_data(band_number)
+        if species_raster_data.shape != env_raster_data.shape:
+            logger.error("Please provide (global) species raster data at the same resolution as the environment")
+            logger.error("Environment data has the following shape %s " % (env_raster_data.shape, ))
+            return
 
-        logger.info("Sampled %s unique pixels as pseudo-absences." % sampled_pixels.nonzero()[0].shape[0])
-        del random_indices
-        gc.collect()
+        cells_to_sample_from, sampled_cells = self.sample_pseudo_absences_sparse(presence_cells=np.flatnonzero(species_raster_data),
+                                                                                 suitable_habitat=suitable_habitat,
+                                                                                 bias_grid=bias_grid,
+                                                                                 band_number=band_number,
+                                                                                 number_of_pseudopoints=number_of_pseudopoints)
+        # fill in the cells with the pixel values of the environment layer
+        env_flattened = env_raster_data.reshape(-1)
+        pixels_to_sample_from = np.zeros_like(env_raster_data)
+        pixels_to_sample_from.reshape(-1)[cells_to_sample_from] = env_flattened[cells_to_sample_from]
+        sampled_pixels = np.zeros_like(env_raster_data)
+        sampled_pixels.reshape(-1)[sampled_cells] = env_flattened[sampled_cells]
         return (pixels_to_sample_from, sampled_pixels)
 
+    def cells_to_world_coordinates(self, cell_ids, shape=None):
+        """
+        Map flat cell indices (``row * width + col``) of the raster map to world coordinates (of the pixel centers),
+        with the same conventions as :func:`pixel_to_world_coordinates`.
+
+        :param np.ndarray cell_ids: The flat cell indices, for example as returned by :func:`sample_pseudo_absences_sparse`.
+
+        :param tuple shape: The (height, width) of the raster map. By default, the shape of the loaded environment raster data.
+
+        :returns: A tuple of numpy ndarrays. The first array contains the latitude values for each \
+        cell, the second array contains the longitude values for each cell.
+
+        :rtype: tuple(np.ndarray, np.ndarray)
+
+        """
+        if shape is None:
+            shape = self._load_env_raster_data().shape
+        transform = self._grid_transform(shape)
+        if transform is None:
+            return
+        return transform.cells_to_world(cell_ids)
+
+
+class RasterStack(object):
+    """
+    RasterStack
+
+    A class for loading many co-registered raster layers (for example, the minimum, maximum, mean and monthly temperatures)
+    into a single contiguous (band, y, x) array, a "data cube". The grid of the files is validated once: all files need to
+    have the same size, affine transformation and coordinate reference system. The files are then read concurrently by a pool
+    of threads (rasterio releases the GIL while decoding the data), each directly into its own band of the cube, which can
+    also be a memory-mapped file. The "nodata" pixels of every file are replaced by a single :attr:`nodata` value, shared by
+    all bands (NaN for floating-point cubes), so missing data is handled the same way across all bands.
+    A stack is added to a model as a whole, with ``Model.add_raster_stack()``.
+
+    :ivar file_paths: The locations of the raster files, one per band of the cube.
+    :vartype file_paths: list(string)
+
+    :ivar names_layers: The name of every layer (band) in the stack.
+    :vartype names_layers: list(string)
+
+    :ivar raster_affine: Affine transformation shared by all the layers.
+    :vartype raster_affine: rasterio.transform.Affine
+
+    :ivar shape: The (height, width) of the layers, in pixels.
+    :vartype shape: tuple(int, int)
+
+    :ivar nodata: The value of the missing pixels in the cube, in all bands.
+
+    :ivar data: The (band, y, x) data cube, after :func:`load_data`.
+    :vartype data: np.ndarray
+    """
+    def __init__(self, file_paths=None, names_layers=None, source=None, band_number=1):
+        if not file_paths:
+            raise AttributeError("Please provide the locations of the raster files to stack.")
+        self.file_paths = list(file_paths)
+        if names_layers is None:
+            names_layers = [os.path.splitext(os.path.basename(file_path))[0] for file_path in self.file_paths]
+        if len(names_layers) != len(self.file_paths):
+            raise AttributeError("Please provide one layer name per raster file.")
+        self.names_layers = list(names_layers)
+        self.source = source if source is not None else Source.UNKNOWN
+        self.band_number = band_number
+
+    def validate(self):
+        """
+        Checks that all raster files are on the same grid (size, affine transformation and coordinate reference system),
+        reading only their metadata.
+
+        :returns: None
+
+        """
+        self.dtypes, self.nodata_values = [], []
+        for file_path in self.file_paths:
+            with rasterio.open(file_path) as src:
+                affine = getattr(src, 'affine', src.transform)
+                if not hasattr(self, 'shape'):
+                    self.shape, self.raster_affine, self.crs = (src.height, src.width), affine, src.crs
+                elif (src.height, src.width) != self.shape:
+                    raise AttributeError("The raster %s has shape %s, instead of %s." % (file_path, (src.height, src.width), self.shape))
+                elif not affine.almost_equals(self.raster_affine) or src.crs != self.crs:
+                    raise AttributeError("The raster %s is not on the same grid (affine transformation or crs) as %s."
+                                         % (file_path, self.file_paths[0]))
+                self.dtypes.append(np.dtype(src.dtypes[self.band_number - 1]))
+                self.nodata_values.append(src.nodata)
+        logger.info("Validated a stack of %s layers with shape %s." % (len(self.file_paths), self.shape))
+
+    def load_data(self, memmap_file=None, dtype=None, nodata=None, max_workers=8):
+        """
+        Reads all raster files concurrently into a (band, y, x) data cube, validating their grid first.
+
+        :param string memmap_file: Optionally, the location of a file in which the cube is stored (memory-mapped), \
+        instead of in memory.
+
+        :param dtype: The data type of the cube. Default is the smallest type all layers fit in; if any layer has "nodata" \
+        pixels, at least ``float32``, so that missing pixels can be NaN.
+
+        :param nodata: The value used for the "nodata" pixels of all layers. Default is NaN for floating-point cubes, \
+        otherwise the "nodata" value of the first layer that has one.
+
+        :param int max_workers: The maximum number of files read at the same time. Default is 8.
+
+        :returns: The data cube.
+
+        :rtype: np.ndarray
+
+        """
+        self.validate()
+        has_nodata = any(value is not None for value in self.nodata_values)
+        if dtype is None:
+            dtype = np.result_type(*self.dtypes)
+            if has_nodata and nodata is None:
+                dtype = np.result_type(dtype, np.float32)
+        dtype = np.dtype(dtype)
+        if nodata is None and has_nodata:
+            nodata = np.nan if dtype.kind == 'f' else next(value for value in self.nodata_values if value is not None)
+        self.nodata = nodata
+        shape = (len(self.file_paths),) + self.shape
+        if memmap_file:
+            self.data = np.memmap(memmap_file, dtype=dtype, mode='w+', shape=shape)
+        else:
+            self.data = np.empty(shape, dtype=dtype)
+
+        def read_band(position):
+            start_time = timeit.default_timer()
+            # every thread opens its own dataset: a file handle is not to be shared among threads
+            with rasterio.open(self.file_paths[position]) as src:
+                band = src.read(self.band_number)
+            layer_data = self.data[position]
+            layer_data[:] = band
+            band_nodata = self.nodata_values[position]
+            if band_nodata is not None and not (band_nodata == nodata or (np.isnan(band_nodata) and np.isnan(nodata))):
+                layer_data[band == band_nodata] = nodata
+            return timeit.default_timer() - start_time
+
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(self.file_paths)))) as executor:
+            for name_layer, elapsed in zip(self.names_layers, executor.map(read_band, range(len(self.file_paths)))):
+                logger.info("Loaded layer %s in %.2f seconds." % (name_layer, elapsed))
+        if memmap_file:
+            self.data.flush()
+        logger.info("Loaded a stack of %s layers into a cube of shape %s." % (len(self.file_paths), self.data.shape))
+        return self.data
+
+    def read(self, band_number=1):
+        """
+        :returns: A band (layer) of the (loaded) data cube, starting with 1.
+
+        :rtype: np.ndarray
+
+        """
+        if not hasattr(self, 'data'):
+            raise AttributeError("Please load the data first, using .load_data()")
+        return self.data[band_number - 1]
+
 
 class VectorEnvironmentalLayer(EnvironmentalLayer):
     """
@@ -737,7 +1414,7 @@ class VectorEnvironmentalLayer(EnvironmentalLayer):
     def __init__(self, source=None, file_path=None, name_layer=None, **kwargs):
         EnvironmentalLayer.__init__(self, source, file_path, name_layer, **kwargs)
 
-    def load_data(self, file_path=None):
+    def load_data(self, file_path=None, bbox=None, filters=None, columns=None, cache=False, cache_location=None):
         """
         Loads the environmental data from the provided :attr:`file_path` shapefile into a ``geopandas.GeoDataFrame``.
         A GeoDataFrame is a tablular data structure that contains a column called ``geometry`` which contains a GeoSeries of
@@ -746,6 +1423,16 @@ class VectorEnvironmentalLayer(EnvironmentalLayer):
 
         :param string file_path: The full path to the shapefile file (including the directory and filename in one string).
 
+        :param tuple bbox: Only load the geometries intersecting this (minx, miny, maxx, maxy) bounding box.
+
+        :param list filters: Only load the records matching these (attribute) filters. See ``iSDM.cache.VectorCache.read()``.
+
+        :param list columns: Only load these (lower-case) attribute columns. The geometry column is always loaded.
+
+        :param bool cache: Whether to load the data through a binary cache (see ``iSDM.cache.VectorCache``). Default is False.
+
+        :param string cache_location: The folder where the cache is stored. Default is next to the shapefile.
+
         :returns: None
 
         """
@@ -756,8 +1443,7 @@ class VectorEnvironmentalLayer(EnvironmentalLayer):
             raise AttributeError("Please provide a file_path argument to load the data from.")
 
         logger.info("Loading data from %s " % self.file_path)
-        self.data_full = GeoDataFrame.from_file(self.file_path)
-        self.data_full.columns = [x.lower() for x in self.data_full.columns]
+        self.data_full = load_vector(self.file_path, bbox=bbox, filters=filters, columns=columns, cache=cache, cache_location=cache_location)
         logger.info("The shapefile contains data on %d environmental regions." % self.data_full.shape[0])
 
     def save_data(self, full_name=None, driver='ESRI Shapefile', overwrite=False):
@@ -989,3 +1675,82 @@ class ClimateLayer(RasterEnvironmentalLayer):
 
 class DEMLayer(RasterEnvironmentalLayer):
     pass
+
+
+class MemmapEnvironmentalLayer(RasterEnvironmentalLayer):
+    """
+    MemmapEnvironmentalLayer
+
+    A raster environmental layer whose data is memory-mapped from an uncompressed file, instead of read (and decompressed)
+    from the raster file. It can be used anywhere a ``RasterEnvironmentalLayer`` is used: the reader returned by :func:`load_data`
+    (a ``iSDM.cache.MemmapRasterReader``) behaves like a rasterio file reader, but reading a band does not copy any data.
+    The pixels are paged in when accessed, and shared (through the page cache) among all processes using the same layer.
+
+    The :attr:`file_path` can be:
+
+    - any raster file readable by rasterio (GeoTIFF, ArcGrid, ...). It is converted once into a cache file (see
+      ``iSDM.cache.RasterCache``), stored next to it or in :attr:`cache_location`, and rebuilt only when the raster file changes;
+    - an uncompressed raster file described by a sidecar file (see ``iSDM.cache.write_memmap_metadata``), such as a cache file;
+    - a raw binary file of pixel values, with the :attr:`dtype` and :attr:`shape` (and optionally the :attr:`transform` and
+      :attr:`nodata` value) given explicitly. Without a transform, a global-scale raster is assumed.
+
+    :ivar cache_location: The folder where the cache file is stored. Default is next to the raster file.
+    :vartype cache_location: string
+
+    :ivar mode: The memory-mapping mode: ``'c'`` (copy-on-write, default), in which case the arrays read can be modified \
+    without changing the file, or ``'r'`` (read-only), in which case they can be shared with worker processes without \
+    copying (see ``iSDM.pipeline.SharedLayers``).
+    :vartype mode: string
+    """
+    def __init__(self, source=None, file_path=None, name_layer=None, cache_location=None, mode='c',
+                 dtype=None, shape=None, transform=None, nodata=None, **kwargs):
+        RasterEnvironmentalLayer.__init__(self, source, file_path, name_layer, **kwargs)
+        if mode not in ('c', 'r'):
+            raise AttributeError("The mode can only be one of the following: 'c', 'r'")
+        self.cache_location = cache_location
+        self.mode = mode
+        self._raw_metadata = None
+        if dtype is not None or shape is not None:
+            if dtype is None or shape is None:
+                raise AttributeError("Please provide both the dtype and the shape of the raw raster file.")
+            self._raw_metadata = {'dtype': np.dtype(dtype).str,
+                                  'shape': list(shape),
+                                  'transform': list(transform.to_gdal()) if transform is not None else None,
+                                  'nodata': nodata}
+
+    def load_data(self, file_path=None):
+        """
+        Memory-maps the raster data, converting the raster file into a cache file first if needed (see the class description).
+        Provides information about the loaded data, and returns a file reader handle, which allows you to read individual
+        raster bands.
+
+        :param string file_path: The full path to the raster file (including the directory and filename in one string).
+
+        :returns: A (memory-mapped) file reader, which can be used to read individual bands from the raster file.
+
+        :rtype: iSDM.cache.MemmapRasterReader
+
+        """
+        if file_path:
+            self.file_path = file_path
+        if not getattr(self, 'file_path', None):
+            raise AttributeError("Please provide a file_path to read raster environment data from.")
+
+        if self._raw_metadata is not None:
+            src = MemmapRasterReader(self.file_path, metadata=self._raw_metadata, mode=self.mode)
+        elif read_memmap_metadata(self.file_path) is not None:
+            src = MemmapRasterReader(self.file_path, mode=self.mode)
+        else:
+            src = RasterCache(self.file_path, cache_location=self.cache_location).load(mode=self.mode)
+        logger.info("Memory-mapped raster data from %s " % src.name)
+        self.metadata = src.meta
+        logger.info("Resolution: x_res={0} y_res={1}.".format(src.width, src.height))
+        logger.info("Bounds: %s " % (src.bounds,))
+        logger.info("Coordinate reference system: %s " % src.crs)
+        logger.info("Affine transformation: %s " % (src.affine.to_gdal(),))
+        logger.info("Number of layers: %s " % src.count)
+        self.raster_affine = src.affine
+        self.resolution = src.res
+        self.bounds = src.bounds
+        self.raster_reader = src
+        return self.raster_reader
@@ -0,0 +1,543 @@
+"""
+A module for fetching (large amounts of) species occurrence records from the `GBIF <http://www.gbif.org/>`_ API.
+
+      .. moduleauthor:: Daniela Remenska <remenska@gmail.com>
+
+"""
+import json
+import logging
+import os
+import threading
+import time
+import timeit
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger('iSDM.gbif')
+logger.setLevel(logging.DEBUG)
+
+GBIF_API_URL = "http://api.gbif.org/v1/"
+# http://www.gbif.org/developer/occurrence
+# "... individual requests for each page, which is limited to a maximum size of 300 records per page. Note that for technical
+# reasons we also have a hard limit for any query of 200,000 records. You will get an error if the offset + limit exceeds 200,000."
+MAX_PAGE_SIZE = 300
+MAX_RECORDS = 200000
+# HTTP status codes worth retrying: too many requests, and (temporary) server-side errors
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+def _atomic_write(file_name, write):
+    # write(temporary_file_name) writes the file under a temporary name, which then replaces file_name at once
+    temporary_file_name = "%s.%s.tmp" % (file_name, threading.current_thread().ident)
+    try:
+        write(temporary_file_name)
+        os.replace(temporary_file_name, file_name)
+    finally:
+        if os.path.exists(temporary_file_name):
+            os.remove(temporary_file_name)
+
+
+class OccurrenceFetcher(object):
+    """
+    OccurrenceFetcher
+    A class for fetching all the occurrence records matching a search (for example of a single species), from the
+    occurrence search API of GBIF. After the first page of results, the total number of records (``count``) is known, so
+    the offsets of all remaining pages are planned at once, and the pages are fetched concurrently by a pool of threads,
+    with at most :attr:`max_workers` requests in flight. All requests share one HTTP session, so the connections to the
+    API are kept alive and reused. Failed requests (connection errors, timeouts, or a "retryable" HTTP status code) are
+    retried with an exponential backoff. Records returned on more than one page are kept only once (by their ``key``).
+
+    :ivar api_url: The base URL of the GBIF API.
+    :vartype api_url: string
+
+    :ivar max_workers: The maximum number of concurrent requests.
+    :vartype max_workers: int
+
+    :ivar page_size: The number of records requested per page. At most 300.
+    :vartype page_size: int
+
+    :ivar session: The (pooled) HTTP session used for all requests.
+    :vartype session: requests.Session
+    """
+    def __init__(self, api_url=GBIF_API_URL, max_workers=8, page_size=MAX_PAGE_SIZE, retries=3, backoff_factor=0.5, timeout=60):
+        if max_workers < 1:
+            raise AttributeError("The number of workers must be at least 1.")
+        if not 0 < page_size <= MAX_PAGE_SIZE:
+            raise AttributeError("The page size must be between 1 and %s." % MAX_PAGE_SIZE)
+        self.api_url = api_url if api_url.endswith("/") else api_url + "/"
+        self.max_workers = max_workers
+        self.page_size = page_size
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def search(self, offset=0, limit=None, **kwargs):
+        """
+        Fetches a single page of occurrence records. It is retried (at most :attr:`retries` times) with an exponential
+        backoff of ``backoff_factor * 2 ** attempt`` seconds, on connection errors, timeouts and HTTP status codes 429 and 5xx.
+
+        :param int offset: The offset of the first record on the page.
+
+        :param int limit: The number of records on the page. Default is :attr:`page_size`.
+
+        :param kwargs: Any other search parameters of the GBIF occurrence search API, for example ``taxonKey``.
+
+        :returns: The (decoded) json response, a dictionary with ``count``, ``endOfRecords`` and ``results`` keys.
+
+        :rtype: dict
+
+        """
+        parameters = dict(kwargs, offset=offset, limit=self.page_size if limit is None else limit)
+        url = self.api_url + "occurrence/search"
+        attempt = 0
+        while True:
+            try:
+                response = self.session.get(url, params=parameters, timeout=self.timeout)
+                if response.status_code not in RETRY_STATUS_CODES:
+                    response.raise_for_status()
+                    return response.json()
+                error = "HTTP status %s" % response.status_code
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = str(e)
+            if attempt >= self.retries:
+                raise IOError("Request for offset %s failed after %s attempts: %s" % (offset, attempt + 1, error))
+            delay = self.backoff_factor * 2 ** attempt
+            logger.warning("Request for offset %s failed (%s), retrying in %.2f seconds." % (offset, error, delay))
+            time.sleep(delay)
+            attempt += 1
+
+    def plan_offsets(self, count, start=0):
+        """
+        Plans the pages needed to fetch :attr:`count` records, respecting the hard limit of the GBIF API (``offset + limit``
+        may not exceed 200000). Every page has :attr:`page_size` records, except for a last, shorter page which ends exactly
+        at the limit, so no records below the limit are skipped.
+
+        :param int count: The total number of records.
+
+        :param int start: The offset of the first page to plan (for example, the number of records already fetched).
+
+        :returns: A list of (offset, limit) tuples.
+
+        :rtype: list
+
+        """
+        return [(offset, min(self.page_size, MAX_RECORDS - offset)) for offset in range(start, min(count, MAX_RECORDS), self.page_size)]
+
+    def fetch_occurrences(self, **kwargs):
+        """
+        Fetches all occurrence records matching the search parameters in :attr:`kwargs`. The first page is fetched
+        on its own, to learn the total number of records. All remaining pages are then fetched concurrently.
+
+        :param kwargs: The search parameters of the GBIF occurrence search API, for example ``taxonKey``.
+
+        :returns: A dictionary with the total ``count`` reported by the API, and the list of (unique) ``results``, \
+        in the order of the pages.
+
+        :rtype: dict
+
+        """
+        first_page = self.search(offset=0, **kwargs)
+        count = first_page['count']
+        logger.info("Number of occurrences in GBIF backbone: %s " % count)
+        if count > MAX_RECORDS:
+            logger.warning("There are more than %s observations, the GBIF API has a limitation of %s." % (MAX_RECORDS, MAX_RECORDS))
+            logger.warning("Will fetch only the first %s results." % MAX_RECORDS)
+        pages = [first_page['results']]
+        if not first_page['endOfRecords']:
+            planned_pages = self.plan_offsets(count, start=len(first_page['results']) or self.page_size)
+            logger.debug("Fetching %s more pages with %s concurrent requests." % (len(planned_pages), self.max_workers))
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                # map() keeps the order of the offsets, and raises the error of any failed page
+                for page in executor.map(lambda planned_page: self.search(offset=planned_page[0], limit=planned_page[1], **kwargs),
+                                         planned_pages):
+                    pages.append(page['results'])
+        results = self.unique_records(record for page in pages for record in page)
+        logger.debug("Full results: %s , got: %s " % (count, len(results)))
+        return {'count': count, 'results': results}
+
+    @classmethod
+    def unique_records(cls, records):
+        """
+        Removes duplicate occurrence records (records with the same ``key``), keeping the first one.
+        Records without a ``key`` are all kept.
+
+        :param records: An iterable of occurrence records (dictionaries).
+
+        :returns: The list of unique records, in their original order.
+
+        :rtype: list
+
+        """
+        seen, unique = set(), []
+        for record in records:
+            key = record.get('key')
+            if key is not None:
+                if key in seen:
+                    continue
+                seen.add(key)
+            unique.append(record)
+        return unique
+
+    def close(self):
+        """
+        Closes the HTTP session (and all its pooled connections).
+        """
+        self.session.close()
+
+
+class OccurrenceHarvester(object):
+    """
+    OccurrenceHarvester
+    A class for harvesting the GBIF occurrence records of many species, and storing them in separate files (one per species)
+    in the same folder. The species are processed by a pool of threads, since the harvesting is dominated by waiting for the
+    GBIF API. The outcome for every species is kept in a persistent manifest (a json file in the output folder), which is
+    updated after every species: ``done`` (with the name of the data file), ``empty`` (no occurrences in GBIF), or ``failed``
+    (with the error). When the harvesting is interrupted, or some species failed, running it again only fetches the species
+    which are not yet done or empty. Every data file is first written under a temporary name, and then renamed, so an
+    interruption never leaves a partially-written data file behind.
+
+    :ivar output_location: The folder where the species data files and the manifest are stored.
+    :vartype output_location: string
+
+    :ivar method: The method of serialization of the data files, ``pickle``, ``msgpack``, ``parquet`` or ``feather``.
+    :vartype method: string
+
+    :ivar manifest: The outcome per species, with ``done``, ``empty`` and ``failed`` entries.
+    :vartype manifest: dict
+    """
+    MANIFEST_FILE = "manifest.json"
+
+    def __init__(self, output_location, method="pickle", max_workers=4, fetch_workers=4):
+        if method not in ("pickle", "msgpack", "parquet", "feather"):
+            raise AttributeError("Incorrect method of serializing: %s " % method)
+        self.output_location = output_location
+        self.method = method
+        self.max_workers = max_workers
+        self.fetch_workers = fetch_workers
+        self.manifest_file = os.path.join(output_location, self.MANIFEST_FILE)
+        self._lock = threading.Lock()
+        if not os.path.isdir(output_location):
+            os.makedirs(output_location)
+        self.manifest = self.load_manifest()
+
+    def load_manifest(self):
+        """
+        Loads the manifest of a previous harvesting run from the output folder, if there is one.
+
+        :returns: The outcome per species, with ``done``, ``empty`` and ``failed`` entries.
+
+        :rtype: dict
+
+        """
+        manifest = {'done': {}, 'empty': [], 'failed': {}}
+        if os.path.exists(self.manifest_file):
+            with open(self.manifest_file) as manifest_file:
+                manifest.update(json.load(manifest_file))
+            logger.info("Loaded manifest %s: %s done, %s empty, %s failed species."
+                        % (self.manifest_file, len(manifest['done']), len(manifest['empty']), len(manifest['failed'])))
+        return manifest
+
+    def save_manifest(self):
+        """
+        Stores the manifest (atomically) in the output folder.
+        """
+        def write(file_name):
+            with open(file_name, "w") as manifest_file:
+                json.dump(self.manifest, manifest_file, indent=1, sort_keys=True)
+        _atomic_write(self.manifest_file, write)
+
+    def file_name(self, name_species):
+        """
+        The (default) name of the data file of a species, as used by ``GBIFSpecies.save_data()``.
+        """
+        from iSDM.species import Species
+        return str(name_species) + Species.FILE_EXTENSIONS[self.method]
+
+    def pending(self, species_names):
+        """
+        Returns the species which still need to be harvested, i.e., which are neither done nor empty. Species whose data file
+        already exists (for example, from a run without a manifest) are recorded as done, without fetching them again.
+
+        :param list species_names: The (binomial) names of the species.
+
+        :returns: The names of the species to harvest, in their original order.
+
+        :rtype: list
+
+        """
+        empty = set(self.manifest['empty'])
+        pending = []
+        for name_species in species_names:
+            if name_species in self.manifest['done'] or name_species in empty:
+                continue
+            if os.path.exists(os.path.join(self.output_location, self.file_name(name_species))):
+                self.manifest['done'][name_species] = self.file_name(name_species)
+                self.manifest['failed'].pop(name_species, None)
+                continue
+            pending.append(name_species)
+        return pending
+
+    def _record(self, name_species, outcome, detail=None):
+        with self._lock:
+            self.manifest['done'].pop(name_species, None)
+            self.manifest['failed'].pop(name_species, None)
+            if name_species in self.manifest['empty']:
+                self.manifest['empty'].remove(name_species)
+            if outcome == 'empty':
+                self.manifest['empty'].append(name_species)
+            else:
+                self.manifest[outcome][name_species] = detail
+            self.save_manifest()
+
+    def harvest_one(self, name_species):
+        """
+        Fetches the GBIF occurrences of a single species, stores them (atomically) in the output folder, and records
+        the outcome in the manifest. Errors are recorded as a failure, and not raised.
+
+        :param string name_species: The (binomial) name of the species.
+
+        :returns: The outcome: ``done``, ``empty``, or ``failed``.
+
+        :rtype: string
+
+        """
+        from iSDM.species import GBIFSpecies
+        start_time = timeit.default_timer()
+        try:
+            species = GBIFSpecies(name_species=name_species)
+            data = species.find_species_occurrences(concurrent=True, max_workers=self.fetch_workers)
+            if data is None or data.empty:
+                logger.info("No data to save on %s " % name_species)
+                self._record(name_species, 'empty')
+                return 'empty'
+            file_name = self.file_name(name_species)
+            _atomic_write(os.path.join(self.output_location, file_name),
+                          lambda temporary_file_name: self._save(species, temporary_file_name))
+            self._record(name_species, 'done', file_name)
+            logger.info("Harvested %s occurrences of %s in %.2f seconds." % (data.shape[0], name_species, timeit.default_timer() - start_time))
+            return 'done'
+        except Exception:
+            error = traceback.format_exc()
+            logger.error("Harvesting species %s failed:\n%s" % (name_species, error))
+            self._record(name_species, 'failed', error)
+            return 'failed'
+
+    def _save(self, species, temporary_file_name):
+        species.save_data(full_name=temporary_file_name, method=self.method)
+        if not os.path.exists(temporary_file_name):
+            raise IOError("Could not save the data of %s." % species.name_species)
+
+    def harvest(self, species_names):
+        """
+        Harvests the GBIF occurrences of all :attr:`species_names` which are not done yet (see :func:`pending`),
+        with :attr:`max_workers` species in parallel.
+
+        :param list species_names: The (binomial) names of the species.
+
+        :returns: The number of species per outcome (``done``, ``empty`` and ``failed``), for this run.
+
+        :rtype: dict
+
+        """
+        pending = self.pending(species_names)
+        with self._lock:
+            self.save_manifest()
+        logger.info("Harvesting %s species (%s were already harvested)." % (len(pending), len(species_names) - len(pending)))
+        outcomes = {'done': 0, 'empty': 0, 'failed': 0}
+        start_time = timeit.default_timer()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for outcome in executor.map(self.harvest_one, pending):
+                outcomes[outcome] += 1
+        logger.info("Harvested %s species in %.2f seconds: %s done, %s empty, %s failed."
+                    % (len(pending), timeit.default_timer() - start_time, outcomes['done'], outcomes['empty'], outcomes['failed']))
+        return outcomes
+
+
+class MergedOccurrences(object):
+    """
+    MergedOccurrences
+    A class for merging the occurrence records of many species (one file per species, as stored by :class:`OccurrenceHarvester`),
+    into one `Parquet <https://parquet.apache.org/>`_ dataset. The species files are merged one by one (streaming), so only
+    one species is in memory at any time. Every species is stored in its own row group (partition), with only the requested
+    columns, normalized to a fixed schema. A small json index maps every species to its row group, so the records of a single
+    species can be read without scanning the whole dataset. Records of a species with the same ``gbifid`` (or ``key``), for example
+    from overlapping re-harvests, are stored only once.
+
+    :ivar location: The folder where the merged dataset (``merged.parquet``) and its index (``merged_index.json``) are stored.
+    :vartype location: string
+
+    :ivar index: For every species, the ``row_group`` and number of ``records``.
+    :vartype index: dict
+    """
+    DATA_FILE = "merged.parquet"
+    INDEX_FILE = "merged_index.json"
+    # columns with a fixed numerical type; all other columns are stored as strings
+    INTEGER_COLUMNS = ('gbifid', 'key', 'taxonkey', 'specieskey', 'genuskey', 'familykey', 'orderkey', 'classkey', 'phylumkey', 'kingdomkey')
+    FLOAT_COLUMNS = ('decimallatitude', 'decimallongitude', 'coordinateuncertaintyinmeters', 'coordinateprecision', 'elevation',
+                     'elevationaccuracy', 'depth', 'depthaccuracy', 'year', 'month', 'day')
+
+    def __init__(self, location):
+        self.location = location
+        self.data_file = os.path.join(location, self.DATA_FILE)
+        self.index_file = os.path.join(location, self.INDEX_FILE)
+        self.index = {}
+        if os.path.exists(self.index_file):
+            with open(self.index_file) as index_file:
+                self.index = json.load(index_file)
+
+    @classmethod
+    def normalized_schema(cls, columns):
+        """
+        The fixed schema of the merged dataset: the (sorted) :attr:`columns`, with integer GBIF identifiers and keys, floating-point
+        coordinates, dates and measurements, and strings for all other columns.
+
+        :param columns: The names of the columns to store.
+
+        :returns: The schema.
+
+        :rtype: pyarrow.Schema
+
+        """
+        import pyarrow
+        fields = []
+        for column in sorted(columns):
+            if column in cls.INTEGER_COLUMNS:
+                fields.append(pyarrow.field(column, pyarrow.int64()))
+            elif column in cls.FLOAT_COLUMNS:
+                fields.append(pyarrow.field(column, pyarrow.float64()))
+            else:
+                fields.append(pyarrow.field(column, pyarrow.string()))
+        return pyarrow.schema(fields)
+
+    @classmethod
+    def _normalize(cls, data, schema):
+        normalized = pd.DataFrame(index=range(data.shape[0]))
+        for field in schema:
+            if field.name not in data.columns:
+                normalized[field.name] = None
+                continue
+            values = data[field.name].reset_index(drop=True)
+            if field.name in cls.INTEGER_COLUMNS:
+                normalized[field.name] = pd.to_numeric(values, errors='coerce').astype('Int64')
+            elif field.name in cls.FLOAT_COLUMNS:
+                normalized[field.name] = pd.to_numeric(values, errors='coerce').astype('float64')
+            else:
+                normalized[field.name] = values.where(values.isnull(), values.astype(str))
+        return normalized
+
+    def merge(self, species_files, columns):
+        """
+        Merges the occurrence records of all :attr:`species_files` into the dataset, replacing any previously merged dataset.
+        The dataset is first written under a temporary name, and renamed at the end.
+
+        :param dict species_files: The (binomial) name of every species, mapped to the full path of its occurrences file, or \
+        to a list of paths if the species has several files (any format supported by ``Species.load_data()``, deduced from \
+        the file extension). The records of all files of a species are merged together.
+
+        :param columns: The names of the columns to keep. Columns missing in a species file are left empty.
+
+        :returns: A summary with the number of merged ``species`` and ``records``, the number of dropped ``duplicates``, \
+        and the list of species without any occurrences (``empty``).
+
+        :rtype: dict
+
+        """
+        import pyarrow
+        import pyarrow.parquet as pq
+        from iSDM.species import GBIFSpecies
+        schema = self.normalized_schema(columns)
+        identifier = 'gbifid' if 'gbifid' in schema.names else 'key' if 'key' in schema.names else None
+        index, empty, duplicates, records = {}, [], 0, 0
+        temporary_file_name = "%s.%s.tmp" % (self.data_file, os.getpid())
+        try:
+            with pq.ParquetWriter(temporary_file_name, schema) as writer:
+                for name_species, file_paths in sorted(species_files.items()):
+                    start_time = timeit.default_timer()
+                    if isinstance(file_paths, str):
+                        file_paths = [file_paths]
+                    species = GBIFSpecies(name_species=name_species)
+                    data = [species.load_data(file_path, columns=list(columns)) for file_path in file_paths]
+                    data = [file_data for file_data in data if file_data is not None and not file_data.empty]
+                    if not data:
+                        logger.info("No occurrences for species %s " % name_species)
+                        empty.append(name_species)
+                        continue
+                    data = self._normalize(pd.concat(data, ignore_index=True), schema)
+                    if identifier is not None:
+                        # only within the species (across all of its files): a record belongs to one species, so the
+                        # memory needed does not grow with the merged dataset
+                        identifiers = data[identifier]
+                        # records without an identifier cannot be duplicates
+                        duplicated = identifiers.duplicated() & identifiers.notnull()
+                        if duplicated.any():
+                            logger.info("Dropping %s duplicate records of species %s " % (duplicated.sum(), name_species))
+                            duplicates += int(duplicated.sum())
+                            data = data[~duplicated.values]
+                    if data.empty:
+                        empty.append(name_species)
+                        continue
+                    writer.write_table(pyarrow.Table.from_pandas(data, schema=schema, preserve_index=False), row_group_size=data.shape[0])
+                    index[name_species] = {'row_group': len(index), 'records': data.shape[0]}
+                    records += data.shape[0]
+                    logger.info("Merged %s records of species %s in %.2f seconds." % (data.shape[0], name_species, timeit.default_timer() - start_time))
+            os.replace(temporary_file_name, self.data_file)
+        finally:
+            if os.path.exists(temporary_file_name):
+                os.remove(temporary_file_name)
+        self.index = index
+        _atomic_write(self.index_file, self._write_index)
+        return {'species': len(index), 'records': records, 'duplicates': duplicates, 'empty': empty}
+
+    def _write_index(self, file_name):
+        with open(file_name, "w") as index_file:
+            json.dump(self.index, index_file, indent=1, sort_keys=True)
+
+    def species(self):
+        """
+        Returns the names of all species in the merged dataset.
+
+        :rtype: list
+
+        """
+        return sorted(self.index.keys())
+
+    def read_species(self, name_species, columns=None):
+        """
+        Reads the occurrence records of a single species from the merged dataset. Only the row group of the species is read.
+
+        :param string name_species: The (binomial) name of the species.
+
+        :param list columns: The names of the columns to read. Default is all columns.
+
+        :returns: The occurrence records of the species.
+
+        :rtype: pandas.DataFrame
+
+        """
+        import pyarrow.parquet as pq
+        if name_species not in self.index:
+            raise AttributeError("Species %s is not in the merged dataset %s " % (name_species, self.data_file))
+        return pq.ParquetFile(self.data_file).read_row_group(self.index[name_species]['row_group'], columns=columns).to_pandas()
+
+    def read(self, columns=None, filters=None):
+        """
+        Reads (some of the columns and rows of) the whole merged dataset.
+
+        :param list columns: The names of the columns to read. Default is all columns.
+
+        :param list filters: Row filters in disjunctive normal form, see ``Species.load_data()``.
+
+        :returns: The occurrence records.
+
+        :rtype: pandas.DataFrame
+
+        """
+        import pyarrow.parquet as pq
+        return pq.read_table(self.data_file, columns=columns, filters=filters).to_pandas()
@@ -0,0 +1,485 @@
+"""
+A module with helper functions for (vectorized) geometrical operations on large numbers of records.
+
+      .. moduleauthor:: Daniela Remenska <remenska@gmail.com>
+
+"""
+import logging
+from functools import lru_cache
+import numpy as np
+from shapely.geometry import Point
+
+logger = logging.getLogger('iSDM.geometry')
+logger.setLevel(logging.DEBUG)
+
+
+def points_from_xy(x, y):
+    """
+    Creates a `Shapely <http://toblerity.org/shapely/shapely.geometry.html>`_ Point geometry for every (x, y) pair of coordinates,
+    without a Python-level loop where possible: with ``geopandas.points_from_xy`` (geopandas 0.5+), or else with
+    ``shapely.points`` (shapely 2). Only if neither is available, the points are created one by one.
+
+    :param np.ndarray x: The x (longitude) values of the coordinates.
+
+    :param np.ndarray y: The y (latitude) values of the coordinates.
+
+    :returns: An array of Point geometries, which can be used directly as the ``geometry`` of a ``geopandas.GeoDataFrame``.
+
+    :rtype: geopandas.array.GeometryArray or np.ndarray
+
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    if x.shape != y.shape:
+        raise AttributeError("Please provide the same number of x and y coordinates.")
+    try:
+        from geopandas import points_from_xy as geopandas_points_from_xy
+        return geopandas_points_from_xy(x, y)
+    except ImportError:
+        pass
+    try:
+        from shapely import points as shapely_points
+        return shapely_points(x, y)
+    except ImportError:
+        logger.debug("Upgrade geopandas or Shapely for vectorized geometry creation.")
+    # an object array is filled element by element, so numpy does not try to unpack the (sequence-like) points
+    geometry = np.empty(x.shape[0], dtype=object)
+    for position, xy in enumerate(zip(x, y)):
+        geometry[position] = Point(xy)
+    return geometry
+
+
+def points_to_pixels(x, y, transform, shape, return_inside=False):
+    """
+    Finds the pixel (row, column) of a raster map containing every (x, y) point, with plain array arithmetic on the
+    coordinates (no geometries needed). A point on the border between two pixels belongs to the pixel to the right (or below),
+    as when burning point geometries with ``rasterio.features.rasterize``. Points outside the raster map are left out.
+
+    :param np.ndarray x: The x (longitude) values of the coordinates.
+
+    :param np.ndarray y: The y (latitude) values of the coordinates.
+
+    :param rasterio.transform.Affine transform: The affine transformation of the raster map (from pixel to world coordinates).
+
+    :param tuple shape: The (height, width) of the raster map.
+
+    :param bool return_inside: Whether to also return the boolean mask of the points inside the raster map.
+
+    :returns: A tuple of two arrays, the rows and the columns of the pixels. NaN coordinates are left out. \
+    With :attr:`return_inside`, the mask of the points inside the raster map is added to the tuple.
+
+    :rtype: tuple(np.ndarray, np.ndarray)
+
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    columns, rows = ~transform * (x, y)
+    with np.errstate(invalid='ignore'):
+        inside = (columns >= 0) & (columns < shape[1]) & (rows >= 0) & (rows < shape[0])
+    rows, columns = np.floor(rows[inside]).astype(np.int64), np.floor(columns[inside]).astype(np.int64)
+    if return_inside:
+        return rows, columns, inside
+    return rows, columns
+
+
+class GridTransform(object):
+    """
+    GridTransform
+
+    The transformation between the pixels of a raster map and the world coordinates (latitude/longitude) of their centers, with
+    the same conventions as ``RasterEnvironmentalLayer.pixel_to_world_coordinates``. For a north-up grid (no rotation), the
+    latitude depends only on the row, and the longitude only on the column: the transformation is separable. The latitudes of
+    all rows and the longitudes of all columns are computed once, and converting pixels is then a lookup in these two (1-dimensional)
+    vectors, instead of applying the affine transformation to every pixel. The results are exactly the same (bit for bit).
+    Use :func:`grid_transform` to get a (cached) instance.
+
+    :ivar transform: The affine transformation of the raster map (from pixel corners to world coordinates).
+    :vartype transform: rasterio.transform.Affine
+
+    :ivar shape: The (height, width) of the raster map.
+    :vartype shape: tuple(int, int)
+
+    :ivar latitudes: The latitude of the pixel centers of every row, for a separable transformation.
+    :vartype latitudes: np.ndarray
+
+    :ivar longitudes: The longitude of the pixel centers of every column, for a separable transformation.
+    :vartype longitudes: np.ndarray
+    """
+    def __init__(self, transform, shape):
+        from rasterio.transform import Affine
+        self.transform = transform
+        self.shape = (int(shape[0]), int(shape[1]))
+        # gdal (flipped) format: (row, column) -> (latitude, longitude), shifted by 50% to get the pixel center
+        self.center_transform = Affine(*reversed(transform.to_gdal())) * Affine.translation(0.5, 0.5)
+        self.separable = transform.b == 0 and transform.d == 0
+        if self.separable:
+            rows, columns = np.arange(self.shape[0]), np.arange(self.shape[1])
+            # the same arithmetic as the entire transformation, so the coordinates are identical
+            self.latitudes = np.asarray((self.center_transform * (rows, np.zeros(self.shape[0], dtype=rows.dtype)))[0])
+            self.longitudes = np.asarray((self.center_transform * (np.zeros(self.shape[1], dtype=columns.dtype), columns))[1])
+            self.latitudes.flags.writeable = False
+            self.longitudes.flags.writeable = False
+
+    def pixels_to_world(self, rows, columns):
+        """
+        :returns: The (latitudes, longitudes) of the centers of the pixels in the given rows and columns.
+
+        :rtype: tuple(np.ndarray, np.ndarray)
+
+        """
+        if self.separable:
+            return self.latitudes[rows], self.longitudes[columns]
+        latitudes, longitudes = self.center_transform * (np.asarray(rows), np.asarray(columns))
+        return np.asarray(latitudes), np.asarray(longitudes)
+
+    def cells_to_world(self, cell_ids):
+        """
+        :returns: The (latitudes, longitudes) of the centers of the pixels with the given flat cell indices (``row * width + col``).
+
+        :rtype: tuple(np.ndarray, np.ndarray)
+
+        """
+        rows, columns = np.divmod(np.asarray(cell_ids, dtype=np.int64), self.shape[1])
+        return self.pixels_to_world(rows, columns)
+
+    def mask_to_world(self, mask, row_offset=0, column_offset=0):
+        """
+        :param np.ndarray mask: A boolean array (of a window of the raster map), selecting the pixels to convert.
+
+        :param int row_offset: The row of the (top-left pixel of the) window in the raster map.
+
+        :param int column_offset: The column of the (top-left pixel of the) window in the raster map.
+
+        :returns: The (latitudes, longitudes) of the centers of the selected pixels, in row-major order.
+
+        :rtype: tuple(np.ndarray, np.ndarray)
+
+        """
+        rows, columns = np.nonzero(mask)
+        if row_offset:
+            rows += row_offset
+        if column_offset:
+            columns += column_offset
+        return self.pixels_to_world(rows, columns)
+
+    def world_to_pixel(self, latitudes, longitudes):
+        """
+        Finds the pixel (row, column) of the raster map containing every (latitude, longitude) point, as :func:`points_to_pixels`,
+        but keeping all points: the pixels of points outside the raster map (or with NaN coordinates) are (-1, -1).
+
+        :rtype: tuple(np.ndarray, np.ndarray)
+
+        """
+        latitudes = np.asarray(latitudes, dtype=np.float64)
+        longitudes = np.asarray(longitudes, dtype=np.float64)
+        columns, rows = ~self.transform * (longitudes, latitudes)
+        with np.errstate(invalid='ignore'):
+            inside = (columns >= 0) & (columns < self.shape[1]) & (rows >= 0) & (rows < self.shape[0])
+        pixel_rows = np.full(latitudes.shape, -1, dtype=np.int64)
+        pixel_columns = np.full(latitudes.shape, -1, dtype=np.int64)
+        pixel_rows[inside] = np.floor(rows[inside])
+        pixel_columns[inside] = np.floor(columns[inside])
+        return pixel_rows, pixel_columns
+
+    def world_to_cells(self, latitudes, longitudes):
+        """
+        :returns: The flat cell indices (``row * width + col``) of the pixels containing the points, -1 outside the raster map.
+
+        :rtype: np.ndarray
+
+        """
+        rows, columns = self.world_to_pixel(latitudes, longitudes)
+        return np.where(rows >= 0, rows * self.shape[1] + columns, -1)
+
+
+@lru_cache(maxsize=32)
+def _cached_grid_transform(transform, shape):
+    return GridTransform(transform, shape)
+
+
+def grid_transform(transform, shape):
+    """
+    Returns the (separable) pixel/world coordinates transformation of a raster map, see :class:`GridTransform`. The lookup vectors
+    are only computed once for every (affine transformation, shape) combination.
+
+    :param rasterio.transform.Affine transform: The affine transformation of the raster map.
+
+    :param tuple shape: The (height, width) of the raster map.
+
+    :rtype: GridTransform
+
+    """
+    from rasterio.transform import Affine
+    return _cached_grid_transform(Affine(*tuple(transform)[:6]), (int(shape[0]), int(shape[1])))
+
+
+def points_within(points, polygons):
+    """
+    Finds which of the :attr:`points` lie within any of the :attr:`polygons`, without building their union. The polygons are
+    stored in an STR-tree (spatial index), which is queried once for all the points, with the ``within`` predicate evaluated
+    in bulk: with shapely 2 directly, and otherwise through the spatial index of geopandas.
+
+    :param geopandas.GeoSeries points: The (point) geometries.
+
+    :param geopandas.GeoSeries polygons: The (polygon) geometries, for example of a species range map.
+
+    :returns: A boolean mask, True for every point within at least one polygon.
+
+    :rtype: np.ndarray
+
+    """
+    within = np.zeros(len(points), dtype=bool)
+    if len(points) == 0 or len(polygons) == 0:
+        return within
+    try:
+        from shapely import STRtree
+        tree = STRtree(np.asarray(polygons))
+        point_indices, _ = tree.query(np.asarray(points), predicate='within')
+    except ImportError:
+        # shapely 1.x: the spatial index of geopandas (0.8+) evaluates the predicate in bulk
+        point_indices, _ = polygons.sindex.query_bulk(points, predicate='within')
+    within[point_indices] = True
+    return within
+
+
+def geometries_to_wkb(geometries):
+    """
+    Converts `Shapely <http://toblerity.org/shapely/shapely.geometry.html>`_ geometries to their Well-Known Binary (WKB)
+    representation, in bulk with shapely 2 where possible. Missing geometries are converted to ``None``.
+
+    :param geopandas.GeoSeries geometries: The geometries.
+
+    :returns: An array of WKB (bytes) values.
+
+    :rtype: np.ndarray
+
+    """
+    try:
+        from shapely import to_wkb
+        return to_wkb(np.asarray(geometries, dtype=object))
+    except ImportError:
+        pass
+    wkb = np.empty(len(geometries), dtype=object)
+    for position, geometry in enumerate(geometries):
+        wkb[position] = geometry.wkb if geometry is not None else None
+    return wkb
+
+
+def geometries_from_wkb(wkb):
+    """
+    Creates `Shapely <http://toblerity.org/shapely/shapely.geometry.html>`_ geometries from their Well-Known Binary (WKB)
+    representation, in bulk with shapely 2 where possible. Missing (``None``) values result in missing geometries.
+
+    :param np.ndarray wkb: The WKB (bytes) values.
+
+    :returns: An array of geometries, which can be used directly as the ``geometry`` of a ``geopandas.GeoDataFrame``.
+
+    :rtype: np.ndarray
+
+    """
+    wkb = np.asarray(wkb, dtype=object)
+    try:
+        from shapely import from_wkb
+        return from_wkb(wkb)
+    except ImportError:
+        from shapely import wkb as shapely_wkb
+    geometries = np.empty(wkb.shape[0], dtype=object)
+    for position, value in enumerate(wkb):
+        geometries[position] = shapely_wkb.loads(bytes(value)) if value is not None else None
+    return geometries
+
+
+def count_vertices(geometries):
+    """
+    Counts the vertices (coordinates) of every geometry, including the holes (interiors) of polygons and all the parts of
+    multi-part geometries. In bulk with shapely 2 where possible.
+
+    :param geopandas.GeoSeries geometries: The geometries.
+
+    :returns: The number of vertices of every geometry (0 for missing or empty geometries).
+
+    :rtype: np.ndarray
+
+    """
+    try:
+        from shapely import get_num_coordinates
+        return get_num_coordinates(np.asarray(geometries, dtype=object))
+    except ImportError:
+        pass
+    return np.array([_count_vertices(geometry) for geometry in geometries], dtype=np.int64)
+
+
+def _count_vertices(geometry):
+    if geometry is None or geometry.is_empty:
+        return 0
+    if hasattr(geometry, 'geoms'):
+        return sum(_count_vertices(part) for part in geometry.geoms)
+    if hasattr(geometry, 'exterior'):
+        return len(geometry.exterior.coords) + sum(len(interior.coords) for interior in geometry.interiors)
+    return len(geometry.coords)
+
+
+def points_in_geometry(x, y, geometry):
+    """
+    Tests which of the (x, y) points lie within a single (polygon) geometry, in bulk on the coordinate arrays, without creating
+    a Point geometry for every pair: with ``shapely.contains_xy`` (shapely 2), or else with ``shapely.vectorized.contains``.
+    Only if neither is available, the points are tested one by one against the "prepared" geometry.
+
+    :param np.ndarray x: The x (longitude) values of the coordinates.
+
+    :param np.ndarray y: The y (latitude) values of the coordinates.
+
+    :param geometry: The geometry to test the points against.
+
+    :returns: A boolean mask, True for every point within the geometry.
+
+    :rtype: np.ndarray
+
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    try:
+        from shapely import contains_xy, prepare
+        prepare(geometry)
+        return contains_xy(geometry, x, y)
+    except ImportError:
+        pass
+    try:
+        from shapely.vectorized import contains
+        return contains(geometry, x, y)
+    except ImportError:
+        logger.debug("Upgrade Shapely for vectorized containment tests.")
+    from shapely.prepared import prep
+    prepared = prep(geometry)
+    return np.fromiter((prepared.contains(Point(xy)) for xy in zip(x, y)), dtype=bool, count=x.shape[0])
+
+
+def make_valid(geometry):
+    """
+    Repairs an invalid geometry (for example, a self-intersecting polygon), keeping all of its area: with ``make_valid``
+    from shapely (1.8+), or else with the "zero-width buffer" trick. Valid geometries are returned as they are.
+
+    :param geometry: The geometry to repair.
+
+    :returns: A valid geometry.
+
+    """
+    if geometry is None or geometry.is_valid:
+        return geometry
+    try:
+        from shapely.validation import make_valid as shapely_make_valid
+        return shapely_make_valid(geometry)
+    except ImportError:
+        return geometry.buffer(0)
+
+
+def unique_grid_points(x, y, cell_size=None):
+    """
+    Collapses (x, y) points onto the cells of a regular grid with the given :attr:`cell_size`, keeping one point per occupied
+    cell, at the center of the cell. Without a :attr:`cell_size`, only the exact duplicate points are collapsed.
+    NaN coordinates are left out.
+
+    :param np.ndarray x: The x (longitude) values of the coordinates.
+
+    :param np.ndarray y: The y (latitude) values of the coordinates.
+
+    :param float cell_size: The size of the grid cells, in the units of the coordinates.
+
+    :returns: A tuple of two arrays, the x and y values of the remaining (unique) points.
+
+    :rtype: tuple(np.ndarray, np.ndarray)
+
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    valid = ~(np.isnan(x) | np.isnan(y))
+    x, y = x[valid], y[valid]
+    if x.shape[0] == 0:
+        return x, y
+    if not cell_size:
+        unique = np.unique(np.stack([x, y], axis=1), axis=0)
+        return unique[:, 0], unique[:, 1]
+    cells = np.unique(np.stack([np.floor(x / cell_size), np.floor(y / cell_size)], axis=1).astype(np.int64), axis=0)
+    return (cells[:, 0] + 0.5) * cell_size, (cells[:, 1] + 0.5) * cell_size
+
+
+def tiled_union(geometries, x, y, tile_size):
+    """
+    Computes the union of many (overlapping) geometries tile by tile: the geometries are grouped by the square tile of size
+    :attr:`tile_size` containing their reference point (x, y), the union of every tile is computed separately, and finally the
+    (few, and only partly overlapping) tile unions are merged. This keeps every union operation small, which is much faster than
+    a single union of all geometries when there are many of them.
+
+    :param geopandas.GeoSeries geometries: The geometries.
+
+    :param np.ndarray x: The x values of the reference point of every geometry (for example, the point that was buffered).
+
+    :param np.ndarray y: The y values of the reference point of every geometry.
+
+    :param float tile_size: The size of the tiles, in the units of the coordinates.
+
+    :returns: The union of all geometries.
+
+    """
+    from shapely.ops import unary_union
+    geometries = np.asarray(geometries, dtype=object)
+    if geometries.shape[0] == 0:
+        return unary_union([])
+    tiles = np.stack([np.floor(np.asarray(x) / tile_size), np.floor(np.asarray(y) / tile_size)], axis=1).astype(np.int64)
+    _, tile_numbers = np.unique(tiles, axis=0, return_inverse=True)
+    tile_numbers = tile_numbers.ravel()
+    order = np.argsort(tile_numbers, kind='mergesort')
+    boundaries = np.flatnonzero(np.diff(tile_numbers[order])) + 1
+    tile_unions = [unary_union(list(geometries[positions])) for positions in np.split(order, boundaries)]
+    logger.debug("Merging the unions of %s tiles." % len(tile_unions))
+    return unary_union(tile_unions)
+
+
+def hilbert_index(x, y, bounds=None, order=16):
+    """
+    Computes the distance along a Hilbert curve of every (x, y) point, on a grid of ``2 ** order`` by ``2 ** order`` cells spanning
+    the :attr:`bounds`. Points which are close to each other mostly get close distances, so sorting records by this distance
+    keeps spatially close records together (e.g., in the same row group of a Parquet file). NaN coordinates get distance 0.
+
+    :param np.ndarray x: The x (longitude) values of the coordinates.
+
+    :param np.ndarray y: The y (latitude) values of the coordinates.
+
+    :param tuple bounds: The (minx, miny, maxx, maxy) extent of the grid. By default, the extent of the points.
+
+    :param int order: The order of the Hilbert curve (at most 31).
+
+    :returns: The distance along the Hilbert curve of every point.
+
+    :rtype: np.ndarray
+
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    if x.shape != y.shape:
+        raise AttributeError("Please provide the same number of x and y coordinates.")
+    side = 2 ** order
+    if bounds is None:
+        valid = ~(np.isnan(x) | np.isnan(y))
+        if not valid.any():
+            return np.zeros(x.shape, dtype=np.int64)
+        bounds = (x[valid].min(), y[valid].min(), x[valid].max(), y[valid].max())
+    minx, miny, maxx, maxy = bounds
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cells = [np.nan_to_num((values - low) / (high - low) * side) if high > low else np.zeros_like(values)
+                 for values, low, high in [(x, minx, maxx), (y, miny, maxy)]]
+    col, row = [np.clip(values, 0, side - 1).astype(np.int64) for values in cells]
+    distance = np.zeros(x.shape, dtype=np.int64)
+    # the iterative (x, y) to distance conversion, vectorized over all points
+    s = side // 2
+    while s > 0:
+        rx = (col & s) > 0
+        ry = (row & s) > 0
+        distance += s * s * ((3 * rx.astype(np.int64)) ^ ry.astype(np.int64))
+        # rotate the quadrant, so that the sub-curve is traversed in the right direction
+        flip = rx & ~ry
+        col = np.where(flip, side - 1 - col, col)
+        row = np.where(flip, side - 1 - row, row)
+        col, row = np.where(ry, col, row), np.where(ry, row, col)
+        s //= 2
+    return distance
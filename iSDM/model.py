@@ -6,12 +6,19 @@ A module for preparing all environmental layers used for fitting a model, into a
 
 """
 from enum import Enum
+from collections import OrderedDict
+from collections.abc import MutableMapping
 from iSDM.environment import RasterEnvironmentalLayer, VectorEnvironmentalLayer
+from iSDM.geometry import points_to_pixels, grid_transform
+from iSDM.cache import GridStore
 import pandas as pd
 import numpy as np
 from rasterio.transform import Affine
 import gc
 import logging
+import os
+import timeit
+from concurrent.futures import ThreadPoolExecutor, as_completed
 logger = logging.getLogger('iSDM.model')
 logger.setLevel(logging.DEBUG)
 
@@ -29,6 +36,57 @@ class Evaluation(Enum):
     AUC = 4
 
 
+class StoredLayers(MutableMapping):
+    """
+    StoredLayers
+
+    The layers of a model with ``storage='cells'`` which was saved to (or loaded from) a :class:`iSDM.cache.GridStore`.
+    It behaves as the dictionary of layers of the model, but a stored layer is only read (at the cells of the model) when it is
+    accessed for the first time. Layers added (or replaced) afterwards are kept in memory, and marked as modified, so that saving
+    the model again only writes those.
+
+    :ivar store: The grid store the layers are read from.
+    :vartype store: iSDM.cache.GridStore
+
+    :ivar modified: The names of the layers which are not (yet) stored as they are.
+    :vartype modified: set
+    """
+    def __init__(self, store, cell_ids=None, names_layers=None, layers=None):
+        self.store = store
+        self.cell_ids = cell_ids
+        self._names = list(names_layers) if names_layers is not None else []
+        self._loaded = dict(layers) if layers is not None else {}
+        for name_layer in self._loaded:
+            if name_layer not in self._names:
+                self._names.append(name_layer)
+        self.modified = set()
+
+    def __getitem__(self, name_layer):
+        if name_layer not in self._loaded:
+            if name_layer not in self._names:
+                raise KeyError(name_layer)
+            logger.info("Reading layer %s from %s " % (name_layer, self.store.location))
+            self._loaded[name_layer] = self.store.read_cells(name_layer, self.cell_ids)
+        return self._loaded[name_layer]
+
+    def __setitem__(self, name_layer, column):
+        if name_layer not in self._names:
+            self._names.append(name_layer)
+        self._loaded[name_layer] = column
+        self.modified.add(name_layer)
+
+    def __delitem__(self, name_layer):
+        self._names.remove(name_layer)
+        self._loaded.pop(name_layer, None)
+        self.modified.discard(name_layer)
+
+    def __iter__(self):
+        return iter(list(self._names))
+
+    def __len__(self):
+        return len(self._names)
+
+
 class Model(object):
     """
     Model
@@ -49,10 +107,23 @@ class Model(object):
     :ivar base_dataframe: A base dataframe containing latitude/longitude columns as an index. Further environmental layers added \
     to the model will be merged with this base dataframe. Therefore, it is expected to contain all the necessary latitude/longitude combinations \
     that may show up in any further environmental layers. If raster_data is not provided as a base(see below), then all world coordinates \
-    (at a particular resolution) are taken into account.
+    (at a particular resolution) are taken into account. Only used with ``storage='dataframe'``.
     :vartype base_dataframe: pandas.DataFrame
+
+    :ivar storage: How the model data is stored. With ``'dataframe'`` (default), the data is kept in :attr:`base_dataframe`, indexed by \
+    latitude/longitude. With ``'cells'``, every (global-scale) pixel is identified by an integer cell ID (``row * x_res + col``), and \
+    every environmental layer is kept as one contiguous array, aligned with :attr:`cell_ids`. Adding a layer is then a direct array \
+    assignment instead of a merge, and latitude/longitude are only computed when exporting (see :func:`get_base_dataframe`).
+    :vartype storage: string
+
+    :ivar cell_ids: With ``storage='cells'``, the sorted cell IDs of the pixels in the model. ``None`` means all pixels of the \
+    global-scale raster, in which case they are never materialized.
+    :vartype cell_ids: np.ndarray
+
+    :ivar layers: With ``storage='cells'``, the data of every added environmental layer (one array per layer), by layer name.
+    :vartype layers: collections.OrderedDict
     """
-    def __init__(self, pixel_size, raster_data=None, **kwargs):
+    def __init__(self, pixel_size, raster_data=None, storage='dataframe', **kwargs):
         logger.info("Preparing a base dataframe...")
         x_min, y_min, x_max, y_max = -180, -90, 180, 90  # global
         self.pixel_size = pixel_size
@@ -60,6 +131,25 @@ class Model(object):
         self.y_res = int((y_max - y_min) / self.pixel_size)
         self.base_layer = RasterEnvironmentalLayer()
         self.base_layer.raster_affine = Affine(pixel_size, 0.0, x_min, 0.0, -pixel_size, y_max)
+        if storage not in ('dataframe', 'cells'):
+            raise AttributeError("The storage can only be one of the following: 'dataframe', 'cells'")
+        self.storage = storage
+        if self.storage == 'cells':
+            self.layers = OrderedDict()
+            if raster_data is None:
+                logger.info("Base layer: all %s pixels of the global raster are taken into account." % (self.x_res * self.y_res))
+                self.cell_ids = None
+            else:
+                if raster_data.shape != (self.y_res, self.x_res):
+                    raise AttributeError("The base raster data is not at the proper resolution! Shape: %s " % (raster_data.shape, ))
+                logger.info("Base layer: Computing cell IDs...")
+                burned = raster_data != 0
+                if np.issubdtype(raster_data.dtype, np.floating):
+                    burned &= ~np.isnan(raster_data)
+                self.cell_ids = np.flatnonzero(burned)
+                del burned
+                logger.info("Base layer contains %s pixels." % self.cell_ids.shape[0])
+            return
         logger.info("Base layer: Computing world coordinates...")
         if raster_data is not None:
             all_coordinates = self.base_layer.pixel_to_world_coordinates(raster_data=raster_data)
@@ -84,7 +174,7 @@ class Model(object):
     def fit(self):
         pass
 
-    def add_environmental_layer(self, layer, discard_threshold=None, discard_nodata_value=True):
+    def add_environmental_layer(self, layer, discard_threshold=None, discard_nodata_value=True, resampling=None):
         """
         Adds an environmental layer (Raster or Vector) by converting its values to latitude/longitude decimals, and merging with the
         base dataframe. If the added layer is already raster, the first band is expected to contain all the (pixel) data values.
@@ -99,39 +189,58 @@ class Model(object):
         :param bool discard_nodata_value: Optionally filter out "nodata" pixel values from the raster, when converting the layer \
         pixels to world coordinates.
 
+        :param string resampling: Optionally, a raster layer which is not at the Model resolution (or does not have a global extent) \
+        is first aligned to the Model grid, with this resampling method: ``'nearest'``, ``'mean'``, ``'mode'`` or ``'sum'`` \
+        (see ``RasterEnvironmentalLayer.align_to()``). By default, such a layer is not added.
+
         """
         logger.info("Loading environmental layer from %s " % layer.file_path)
         if isinstance(layer, RasterEnvironmentalLayer):
             layer_reader = layer.load_data()
-            layer_data = layer_reader.read(1)
-            if layer_data.shape != (self.y_res, self.x_res):
-                logger.error("The layer is not at the proper resolution! Layer shape:%s " % (layer_data.shape, ))
+            if (layer_reader.height, layer_reader.width) != (self.y_res, self.x_res) or \
+                    (resampling is not None and not self._on_grid(layer)):
+                if resampling is None:
+                    logger.error("The layer is not at the proper resolution! Layer shape:%s " % ((layer_reader.height, layer_reader.width), ))
+                    return
+                logger.info("Aligning layer %s to the model grid (resampling: %s)" % (layer.name_layer, resampling))
+                layer = layer.align_to(self, resampling=resampling)
+                layer_reader = layer.load_data()
+            nodata = layer_reader.nodata if discard_nodata_value else None
+            # the layer is read in (full-width) strips, so the entire band is never loaded in memory
+            blocks = layer.blocks(1, window_rows=layer.strip_rows())
+            if self.storage == 'cells':
+                self.layers[layer.name_layer] = self._cells_column_from_blocks(blocks, nodata=nodata, discard_threshold=discard_threshold)
+                logger.info("Added layer %s to the model cells." % layer.name_layer)
+                gc.collect()
                 return
             logger.info("Computing world coordinates...")
             if discard_nodata_value:
                 logger.info("Filtering out no_data pixels.")
-                layer_data = np.where(layer_data != layer_reader.nodata, layer_data, np.nan)
             if discard_threshold is not None:
                 logger.info("Discarding values below %s " % discard_threshold)
-                layer_data = np.where(layer_data > discard_threshold, layer_data, np.nan)
-
-            layer_coordinates = layer.pixel_to_world_coordinates(raster_data=layer_data,
-                                                                 filter_no_data_value=discard_nodata_value,
-                                                                 no_data_value=layer_reader.nodata)
+            transform = layer._grid_transform((self.y_res, self.x_res))
+            latitudes, longitudes, values = [], [], []
+            for ((row_start, _), _), block in blocks:
+                kept = np.ones(block.shape, dtype=bool)
+                if np.issubdtype(block.dtype, np.floating):
+                    kept &= ~np.isnan(block)
+                if nodata is not None:
+                    kept &= block != nodata
+                if discard_threshold is not None:
+                    kept &= block > discard_threshold
+                block_latitudes, block_longitudes = transform.mask_to_world(kept, row_start)
+                latitudes.append(block_latitudes)
+                longitudes.append(block_longitudes)
+                values.append(block[kept])
+                del kept
 
             logger.info("Constructing dataframe for %s  ..." % layer.name_layer)
-            # layer_dataframe = pd.DataFrame([layer_coordinates[0], layer_coordinates[1]]).T
-            # layer_dataframe.columns = ['decimallatitude', 'decimallongitude']
             layer_dataframe = pd.DataFrame(columns=['decimallatitude', 'decimallongitude'])
-            layer_dataframe['decimallatitude'] = np.array(layer_coordinates[0])
-            layer_dataframe['decimallongitude'] = np.array(layer_coordinates[1])
-            del layer_coordinates
+            layer_dataframe['decimallatitude'] = np.concatenate(latitudes)
+            layer_dataframe['decimallongitude'] = np.concatenate(longitudes)
+            layer_dataframe[layer.name_layer] = np.concatenate(values)
+            del latitudes, longitudes, values
             gc.collect()
-            flattened_data = layer_data.reshape(np.product(layer_data.shape))
-            # if discard_threshold:
-            #     logger.info("Ignoring values below %s " % discard_threshold)
-            #     flattened_data = flattened_data[flattened_data > discard_threshold]
-            layer_dataframe[layer.name_layer] = flattened_data[~np.isnan(flattened_data)]
             layer_dataframe.set_index(['decimallatitude', 'decimallongitude'], inplace=True, drop=True)
             logger.info("Shape of layer_dataframe: % s " % (layer_dataframe.shape, ))
             logger.info("Finished constructing dataframe for %s ..." % layer.name_layer)
@@ -156,6 +265,16 @@ class Model(object):
                 layer.set_classifier(classifier_column=None)
             raster_data = layer.rasterize(raster_file=layer.get_raster_file(), pixel_size=self.pixel_size, classifier_column=layer.get_classifier())
             logger.info("Raster data has shape: %s " % (raster_data.shape,))
+            if self.storage == 'cells':
+                # a single band (no classifier) is returned as a 2-dimensional array
+                bands = raster_data if raster_data.ndim == 3 else [raster_data]
+                column = np.full(self.number_of_cells(), np.nan, dtype=np.float32)
+                for idx, band in enumerate(bands):
+                    logger.info("Filling in cells for band number %s " % idx)
+                    column[self._cells_values(band) != 0] = idx + 1
+                self.layers[layer.name_layer] = column
+                logger.info("Added layer %s to the model cells." % layer.name_layer)
+                return
             self.base_dataframe[layer.name_layer] = np.nan
             for idx, band in enumerate(raster_data):
                 logger.info("Computing world coordinates for band number %s " % idx)
@@ -176,5 +295,363 @@ class Model(object):
                 del band_dataframe
                 gc.collect()
 
+    def add_raster_stack(self, stack, discard_threshold=None, discard_nodata_value=True):
+        """
+        Adds all layers of a raster stack at once, each as a separate column (named after the layer). The stack is loaded
+        (if not loaded already) and its grid is checked against the Model resolution only once. Instead of converting every
+        layer to world coordinates and merging it with the base dataframe, the latitude/longitude index of the base dataframe is
+        mapped to pixels once, and the values of all layers are gathered from the data cube at those pixels.
+
+        :param RasterStack stack: The stack of (co-registered) raster layers to add to the model.
+
+        :param int discard_threshold: Optional pixel value to use for discarding layer pixels below a certain value, before adding the layers.
+
+        :param bool discard_nodata_value: Optionally filter out the "nodata" pixel values of the stack.
+
+        """
+        if not hasattr(stack, 'data'):
+            stack.load_data()
+        cube = stack.data
+        if cube.shape[1:] != (self.y_res, self.x_res):
+            logger.error("The stack is not at the proper resolution! Layers shape:%s " % (cube.shape[1:], ))
+            return
+        nodata = stack.nodata if discard_nodata_value else None
+        if nodata is not None and np.isnan(nodata):
+            nodata = None   # NaN pixels are missing values anyway
+        columns = self._allocate_columns(len(stack.names_layers), np.result_type(cube.dtype, np.float32))
+        pixels = self._base_pixels() if self.storage == 'dataframe' else None
+        for position, name_layer in enumerate(stack.names_layers):
+            self._fill_column(columns[position], [(((0, self.y_res), (0, self.x_res)), cube[position])], pixels=pixels,
+                              nodata=nodata, discard_threshold=discard_threshold)
+            logger.info("Gathered layer %s " % name_layer)
+        self._add_columns(stack.names_layers, columns)
+
+    def add_environmental_layers(self, layers, discard_threshold=None, discard_nodata_value=True, max_workers=8, resampling=None):
+        """
+        Adds many environmental layers at once, each as a separate column (named after the layer). All raster layers are first
+        opened and checked against the Model resolution, before any data is read. Then they are read concurrently (every layer
+        in full-width strips, in its own thread), directly into the columns of a single array allocated for all of them, which
+        is added to the model in one step. There is no per-layer dataframe and no merge: the latitude/longitude index of the base
+        dataframe is mapped to pixels only once. Vector layers are rasterized and added one by one, as with
+        :func:`add_environmental_layer`.
+
+        :param list layers: The environmental layers to be added to the model.
+
+        :param discard_threshold: Optional pixel value to use for discarding layer pixels below a certain value, before adding the \
+        layers. Either one value for all layers, or a list with a value (or None) per layer.
+
+        :param bool discard_nodata_value: Optionally filter out "nodata" pixel values from the rasters.
+
+        :param int max_workers: The maximum number of layers read at the same time. Default is 8.
+
+        :param string resampling: Optionally, the raster layers which are not on the Model grid are first aligned to it, with \
+        this resampling method (see :func:`add_environmental_layer`). By default, such layers are not accepted.
+
+        """
+        layers = list(layers)
+        if isinstance(discard_threshold, (list, tuple)):
+            if len(discard_threshold) != len(layers):
+                raise AttributeError("Please provide one discard_threshold per layer.")
+            thresholds = list(discard_threshold)
+        else:
+            thresholds = [discard_threshold] * len(layers)
+        raster_layers = [(layer, threshold) for layer, threshold in zip(layers, thresholds) if isinstance(layer, RasterEnvironmentalLayer)]
+        names_layers = [layer.name_layer for layer, _ in raster_layers]
+        if len(set(names_layers)) != len(names_layers):
+            raise AttributeError("The names of the layers need to be unique: %s " % names_layers)
+        readers = []
+        for position, (layer, threshold) in enumerate(raster_layers):
+            logger.info("Loading environmental layer from %s " % layer.file_path)
+            reader = layer.load_data()
+            if (reader.height, reader.width) != (self.y_res, self.x_res) or (resampling is not None and not self._on_grid(layer)):
+                if resampling is None:
+                    raise AttributeError("The layer %s is not at the proper resolution! Layer shape:%s "
+                                         % (layer.name_layer, (reader.height, reader.width)))
+                logger.info("Aligning layer %s to the model grid (resampling: %s)" % (layer.name_layer, resampling))
+                layer = layer.align_to(self, resampling=resampling, max_workers=max_workers)
+                reader = layer.load_data()
+                raster_layers[position] = (layer, threshold)
+            readers.append(reader)
+        if raster_layers:
+            # NaN marks a missing value, so the columns need a floating point type (float32 is enough for integer rasters)
+            columns = self._allocate_columns(len(raster_layers), np.result_type(np.float32, *[reader.dtypes[0] for reader in readers]))
+            pixels = self._base_pixels() if self.storage == 'dataframe' else None
+
+            def add_layer(position):
+                start_time = timeit.default_timer()
+                layer, threshold = raster_layers[position]
+                # every layer has its own dataset, read by one thread only
+                blocks = layer.blocks(1, window_rows=layer.strip_rows())
+                self._fill_column(columns[position], blocks, pixels=pixels, nodata=readers[position].nodata if discard_nodata_value else None,
+                                  discard_threshold=threshold)
+                return timeit.default_timer() - start_time
+
+            with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(raster_layers)))) as executor:
+                futures = {executor.submit(add_layer, position): position for position in range(len(raster_layers))}
+                for done, future in enumerate(as_completed(futures), start=1):
+                    logger.info("Read layer %s (%s/%s) in %.2f seconds." % (names_layers[futures[future]], done, len(raster_layers), future.result()))
+            self._add_columns(names_layers, columns)
+        for layer in layers:
+            if isinstance(layer, VectorEnvironmentalLayer):
+                self.add_environmental_layer(layer, discard_nodata_value=discard_nodata_value)
+
+    def _on_grid(self, layer):
+        # whether a (loaded) raster layer has the same pixels as the model: the same shape and affine transformation
+        return (layer.raster_reader.height, layer.raster_reader.width) == (self.y_res, self.x_res) and \
+            layer.raster_affine.almost_equals(self.base_layer.raster_affine)
+
+    def _allocate_columns(self, number_of_columns, dtype):
+        # one array for all new columns (one row per column, in the order of the cell IDs or of the base dataframe rows)
+        if self.storage == 'cells':
+            return np.empty((number_of_columns, self.number_of_cells()), dtype=dtype)
+        # stored column by column (Fortran order), as the dataframe block it will become
+        return np.full((self.number_of_cells(), number_of_columns), np.nan, dtype=dtype, order='F').T
+
+    def _add_columns(self, names_layers, columns):
+        if self.storage == 'cells':
+            for name_layer, column in zip(names_layers, columns):
+                self.layers[name_layer] = column
+            logger.info("Added layers %s to the model cells." % (names_layers, ))
+        else:
+            logger.info("Adding %s layers to the base dataframe..." % len(names_layers))
+            self.base_dataframe = pd.concat([self.base_dataframe.drop(names_layers, axis=1, errors='ignore'),
+                                             pd.DataFrame(columns.T, index=self.base_dataframe.index, columns=names_layers)], axis=1)
+            logger.info("Shape of base_dataframe: %s " % (self.base_dataframe.shape, ))
+        gc.collect()
+
+    def _fill_column(self, column, blocks, pixels=None, nodata=None, discard_threshold=None):
+        if self.storage == 'cells':
+            return self._cells_column_from_blocks(blocks, nodata=nodata, discard_threshold=discard_threshold, column=column)
+        return self._dataframe_column_from_blocks(blocks, column, pixels, nodata=nodata, discard_threshold=discard_threshold)
+
+    def _base_pixels(self):
+        # the (row, column) pixels of the rows of the base dataframe, ordered by pixel row, with the positions of those rows
+        index = self.base_dataframe.index
+        rows, columns, inside = points_to_pixels(index.get_level_values('decimallongitude').values,
+                                                 index.get_level_values('decimallatitude').values,
+                                                 self.base_layer.raster_affine, (self.y_res, self.x_res), return_inside=True)
+        order = np.argsort(rows, kind='mergesort')
+        return np.flatnonzero(inside)[order], rows[order], columns[order]
+
+    def _dataframe_column_from_blocks(self, blocks, column, pixels, nodata=None, discard_threshold=None):
+        # blocks: (window, data) tuples of full-width strips of a global-scale raster; pixels: as returned by _base_pixels().
+        # The column (NaN-filled) is only written where a kept pixel value is found.
+        positions, rows, columns = pixels
+        for ((row_start, row_stop), _), block in blocks:
+            start, stop = np.searchsorted(rows, [row_start, row_stop])
+            values = block[rows[start:stop] - row_start, columns[start:stop]]
+            kept = np.ones(values.shape, dtype=bool)
+            if np.issubdtype(values.dtype, np.floating):
+                kept &= ~np.isnan(values)
+            if nodata is not None:
+                kept &= values != nodata
+            if discard_threshold is not None:
+                kept &= values > discard_threshold
+            column[positions[start:stop][kept]] = values[kept]
+        return column
+
+    def number_of_cells(self):
+        """
+        :returns: The number of pixels (rows) in the model.
+
+        :rtype: int
+
+        """
+        if self.storage == 'cells':
+            return self.x_res * self.y_res if self.cell_ids is None else self.cell_ids.shape[0]
+        return self.base_dataframe.shape[0]
+
+    def _cells_range(self, row_start, row_stop):
+        # the positions (in the order of the cell IDs) of the model cells in the rows [row_start, row_stop) of the global raster
+        if self.cell_ids is None:
+            return row_start * self.x_res, row_stop * self.x_res
+        start, stop = np.searchsorted(self.cell_ids, [row_start * self.x_res, row_stop * self.x_res])
+        return int(start), int(stop)
+
+    def _cells_values(self, raster_data, row_start=0):
+        # the pixel values of a global-scale raster (or of a full-width strip of it, starting at row_start) at the model cells,
+        # in the order of the cell IDs
+        flattened = raster_data.reshape(-1)
+        if self.cell_ids is None:
+            return flattened
+        start, stop = self._cells_range(row_start, row_start + raster_data.shape[0])
+        return flattened[self.cell_ids[start:stop] - row_start * self.x_res]
+
+    def _cells_column(self, raster_data, nodata=None, discard_threshold=None):
+        return self._cells_column_from_blocks([(((0, raster_data.shape[0]), (0, raster_data.shape[1])), raster_data)],
+                                              nodata=nodata, discard_threshold=discard_threshold)
+
+    def _cells_column_from_blocks(self, blocks, nodata=None, discard_threshold=None, column=None):
+        # blocks: (window, data) tuples of full-width strips of a global-scale raster, as returned by RasterEnvironmentalLayer.blocks().
+        # The values are written into column, if given.
+        for ((row_start, row_stop), _), block in blocks:
+            if column is None:
+                # NaN marks a missing value, so the column needs a floating point type (float32 is enough for integer rasters)
+                column = np.empty(self.number_of_cells(), dtype=np.result_type(block.dtype, np.float32))
+            start, stop = self._cells_range(row_start, row_stop)
+            column[start:stop] = self._cells_values(block, row_start)
+        if nodata is not None:
+            logger.info("Filtering out no_data pixels.")
+            column[column == nodata] = np.nan
+        if discard_threshold is not None:
+            logger.info("Discarding values below %s " % discard_threshold)
+            column[~(column > discard_threshold)] = np.nan
+        return column
+
+    def save(self, location, chunk_shape=(1024, 1024), compress=True, layers=None):
+        """
+        Saves the model to a folder, as a gridded (layer, lat, lon) store (see :class:`iSDM.cache.GridStore`): every layer is
+        stored as a global-scale grid, split into compressed chunks, together with the affine transformation, the coordinate
+        reference system, the pixel size and storage of the model, and its cells. Chunks without any data (no model cells, or
+        only missing values) are not stored. This is much smaller, and much faster to write and read back, than a csv file.
+
+        Saving to a folder which already contains (an earlier save of) the model only writes the given (or changed) layers, and
+        removes the layers which are no longer in the model: the other layers are not rewritten. With ``storage='cells'``, only
+        the layers added after the model was last saved or loaded are changed. With ``storage='dataframe'``, all columns are
+        written, unless :attr:`layers` are given.
+
+        :param string location: The folder to save the model to.
+
+        :param tuple chunk_shape: The (height, width) of the chunks, in pixels. Only used when the folder does not contain a \
+        model yet. Default is (1024, 1024).
+
+        :param bool compress: Whether to compress the chunks. Uncompressed chunks are memory-mapped when read. Only used when \
+        the folder does not contain a model yet. Default is True.
+
+        :param list layers: Only write these layers.
+
+        :returns: None
+
+        """
+        store = GridStore(location, shape=(self.y_res, self.x_res), transform=self.base_layer.raster_affine,
+                          crs={'init': "EPSG:4326"}, chunk_shape=chunk_shape, compress=compress)
+        if store.attributes.get('storage', self.storage) != self.storage:
+            raise AttributeError("The folder %s contains a model with storage='%s'." % (location, store.attributes['storage']))
+        if self.storage == 'cells':
+            cell_ids, names_layers = self.cell_ids, list(self.layers)
+            pixels = None if cell_ids is None else (np.arange(cell_ids.shape[0]), cell_ids // self.x_res, cell_ids % self.x_res)
+            same_store = isinstance(self.layers, StoredLayers) and os.path.abspath(self.layers.store.location) == os.path.abspath(location)
+            changed = self.layers.modified if same_store else names_layers
+        else:
+            names_layers = list(self.base_dataframe.columns)
+            pixels = self._base_pixels()
+            positions, rows, columns = pixels
+            if positions.shape[0] != self.base_dataframe.shape[0]:
+                raise AttributeError("Some rows of the base dataframe are outside the global grid.")
+            # the cells in the order of the base dataframe rows
+            cell_ids = np.empty(positions.shape[0], dtype=np.int64)
+            cell_ids[positions] = rows * self.x_res + columns
+            changed = names_layers
+        if layers is not None:
+            changed = [name_layer for name_layer in names_layers if name_layer in layers]
+        stored_cells = store.read_array('cell_ids')
+        if (stored_cells is None) != (cell_ids is None) or (cell_ids is not None and not np.array_equal(stored_cells, cell_ids)):
+            if store.layers and set(names_layers) - set(changed):
+                # the stored layers are on other cells; they all need to be written again
+                changed = names_layers
+            if cell_ids is None:
+                store.remove_array('cell_ids')
+            else:
+                store.write_array('cell_ids', cell_ids)
+        for name_layer in store.layers:
+            if name_layer not in names_layers:
+                store.remove_layer(name_layer)
+        for name_layer in names_layers:
+            if name_layer in changed:
+                column = self.layers[name_layer] if self.storage == 'cells' else self.base_dataframe[name_layer].values
+                store.write_layer(name_layer, self._layer_strips(column, pixels, store), nodata=np.nan)
+        store.metadata['attributes'].update({'pixel_size': self.pixel_size, 'storage': self.storage, 'layers': names_layers})
+        store._write_metadata()
+        if self.storage == 'cells':
+            if isinstance(self.layers, StoredLayers) and same_store:
+                self.layers.modified.clear()
+            else:
+                self.layers = StoredLayers(store, cell_ids=cell_ids, names_layers=names_layers,
+                                           layers=self.layers._loaded if isinstance(self.layers, StoredLayers) else self.layers)
+        logger.info("Saved the model (%s layers) to %s " % (len(names_layers), location))
+
+    @classmethod
+    def load(cls, location, layers=None):
+        """
+        Loads a model saved with :func:`save`. With ``storage='cells'``, this is instant: the layers are read (chunk by chunk,
+        only at the cells of the model) when they are accessed for the first time. With ``storage='dataframe'``, all (given)
+        layers are read into the base dataframe.
+
+        :param string location: The folder the model was saved to.
+
+        :param list layers: Only load these layers. Default is all layers.
+
+        :returns: The model.
+
+        :rtype: Model
+
+        """
+        store = GridStore(location)
+        attributes = store.attributes
+        names_layers = [name_layer for name_layer in attributes['layers'] if layers is None or name_layer in layers]
+        cell_ids = store.read_array('cell_ids')
+        # no base raster (all pixels) and 'cells' storage: nothing is computed when constructing the model
+        model = cls(pixel_size=attributes['pixel_size'], storage='cells')
+        if attributes['storage'] == 'cells':
+            model.cell_ids = cell_ids
+            model.layers = StoredLayers(store, cell_ids=cell_ids, names_layers=names_layers)
+            return model
+        model.storage = 'dataframe'
+        del model.layers, model.cell_ids
+        model.base_dataframe = pd.DataFrame(index=model._cells_index(cell_ids))
+        if names_layers:
+            columns = model._allocate_columns(len(names_layers),
+                                              np.result_type(*[np.dtype(store.layer_metadata(name_layer)['dtype']) for name_layer in names_layers]))
+            for position, name_layer in enumerate(names_layers):
+                columns[position] = store.read_cells(name_layer, cell_ids)
+                logger.info("Read layer %s " % name_layer)
+            model._add_columns(names_layers, columns)
+        return model
+
+    def _layer_strips(self, column, pixels, store):
+        # the full-width strips (one per row of chunks of the store) of the global-scale grid of a model column (NaN outside
+        # the model cells); pixels: the (positions, rows, columns) of the cells, ordered by row, or None for all pixels
+        for row_start, row_stop in store.chunk_rows():
+            if pixels is None:
+                yield column[row_start * self.x_res:row_stop * self.x_res].reshape(row_stop - row_start, self.x_res)
+                continue
+            positions, rows, columns = pixels
+            start, stop = np.searchsorted(rows, [row_start, row_stop])
+            strip = np.full((row_stop - row_start, self.x_res), np.nan, dtype=np.result_type(column.dtype, np.float32))
+            strip[rows[start:stop] - row_start, columns[start:stop]] = column[positions[start:stop]]
+            yield strip
+
+    def _cells_index(self, cell_ids):
+        # the (decimallatitude, decimallongitude) index of the pixel centers of the cells
+        coordinates = grid_transform(self.base_layer.raster_affine, (self.y_res, self.x_res)).cells_to_world(cell_ids)
+        return pd.MultiIndex.from_arrays([coordinates[0], coordinates[1]], names=['decimallatitude', 'decimallongitude'])
+
+    def get_cell_ids(self):
+        """
+        :returns: The cell IDs (``row * x_res + col``) of all the pixels in the model. Only for ``storage='cells'``.
+
+        :rtype: np.ndarray
+
+        """
+        if self.storage != 'cells':
+            raise AttributeError("Cell IDs are only available with storage='cells'.")
+        return np.arange(self.x_res * self.y_res, dtype=np.int64) if self.cell_ids is None else self.cell_ids
+
     def get_base_dataframe(self):
-        return self.base_dataframe
+        """
+        Returns the model data as a dataframe, with a (decimallatitude, decimallongitude) index and one column per environmental
+        layer. With ``storage='cells'``, the latitude/longitude of the pixel centers are computed from the cell IDs at this point.
+
+        :returns: The base dataframe, with all environmental layers added so far.
+
+        :rtype: pandas.DataFrame
+
+        """
+        if self.storage != 'cells':
+            return self.base_dataframe
+        cell_ids = self.get_cell_ids()
+        logger.info("Computing world coordinates for %s cells..." % cell_ids.shape[0])
+        index = self._cells_index(cell_ids)
+        base_dataframe = pd.DataFrame(OrderedDict(self.layers), index=index)
+        logger.info("Shape of base_dataframe: %s " % (base_dataframe.shape, ))
+        return base_dataframe
@@ -0,0 +1,441 @@
+"""
+A module for running the species-by-species processing pipelines in parallel, on a pool of worker processes.
+
+      .. moduleauthor:: Daniela Remenska <remenska@gmail.com>
+
+"""
+import glob
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import timeit
+import traceback
+import zlib
+import numpy as np
+import pandas as pd
+from iSDM.geometry import grid_transform
+
+logger = logging.getLogger('iSDM.pipeline')
+logger.setLevel(logging.DEBUG)
+
+# Read-only (memory-mapped) views of the shared layers, opened once in every worker process.
+_worker_layers = {}
+# the (JSON) file describing a SpeciesStore, in its folder
+SPECIES_STORE_METADATA_FILE = "species.json"
+
+
+class SharedLayers(object):
+    """
+    SharedLayers
+    A class for sharing large (global) raster arrays, read-only, with the worker processes of a pool. Every array is
+    dumped only once into an uncompressed memory-mapped file, and the workers re-open those files instead of receiving
+    a pickled copy of the data for every task. The operating system page cache is then shared among all workers.
+    Arrays which are already memory-mapped read-only (``numpy.memmap`` with ``mode='r'``) are not copied, the workers simply map
+    the same file.
+
+    :ivar location: The folder where the memory-mapped files are stored.
+    :vartype location: string
+
+    :ivar specifications: For every layer name, a tuple of (file name, dtype, shape, offset) needed to re-open the layer.
+    :vartype specifications: dict
+    """
+    def __init__(self, layers=None, location=None):
+        self.specifications = {}
+        self._temporary = location is None
+        self.location = tempfile.mkdtemp(prefix="isdm_shared_") if location is None else location
+        if layers:
+            for name_layer, data in layers.items():
+                self.add_layer(name_layer, data)
+
+    def add_layer(self, name_layer, data):
+        """
+        Makes a raster array available to the workers, under the name :attr:`name_layer`.
+
+        :param string name_layer: The name under which the workers can access the layer.
+
+        :param np.ndarray data: The raster data. It is not modified.
+
+        :returns: None
+
+        """
+        if not isinstance(data, np.ndarray):
+            raise AttributeError("Please provide the layer %s as a numpy array." % name_layer)
+        # a copy-on-write ('c') or writable mapping may differ from its file, so only read-only mappings are reused
+        if isinstance(data, np.memmap) and data.filename is not None and data.flags['C_CONTIGUOUS'] and data.mode == 'r':
+            logger.info("Layer %s is already memory-mapped from %s " % (name_layer, data.filename))
+            self.specifications[name_layer] = (data.filename, data.dtype.str, data.shape, data.offset)
+            return
+        file_name = os.path.join(self.location, "%s.dat" % name_layer)
+        logger.info("Dumping layer %s with shape %s into %s " % (name_layer, data.shape, file_name))
+        shared = np.memmap(file_name, dtype=data.dtype, mode='w+', shape=data.shape)
+        shared[:] = data
+        shared.flush()
+        del shared
+        self.specifications[name_layer] = (file_name, data.dtype.str, data.shape, 0)
+
+    @classmethod
+    def open_layers(cls, specifications):
+        """
+        Opens (read-only) all the layers described by :attr:`specifications`, as memory-mapped arrays.
+
+        :param dict specifications: See :attr:`SharedLayers.specifications`.
+
+        :returns: A dictionary of layer names and read-only ``numpy.memmap`` arrays.
+
+        :rtype: dict
+
+        """
+        return dict((name_layer, np.memmap(file_name, dtype=np.dtype(dtype), mode='r', shape=tuple(shape), offset=offset))
+                    for name_layer, (file_name, dtype, shape, offset) in specifications.items())
+
+    def cleanup(self):
+        """
+        Removes the memory-mapped files, if they were stored in a temporary folder.
+        """
+        if self._temporary and os.path.isdir(self.location):
+            shutil.rmtree(self.location, ignore_errors=True)
+            logger.debug("Removed shared layers from %s " % self.location)
+
+
+class SpeciesStore(object):
+    """
+    SpeciesStore
+    A class for storing the per-species output of the processing pipelines, such as the presence (1) and pseudo-absence (0)
+    cells of every species, in one folder instead of one csv file per species. The data is a table of (species_id, cell_id,
+    value) records, where the cell ID is the flat index (``row * width + col``) of a pixel in the global grid, and an index
+    (by species) into that table.
+
+    The store is append-only: every writer (process) appends the records of a species to its own segment file, and only then
+    appends one line to its own index file, with the name and ID of the species, and the position of its records in the
+    segment. Many worker processes (see :func:`run_species`) can therefore write to the same store at the same time, without
+    any locking, and an interrupted write never leaves a partial species behind. If a species is written more than once, the
+    last write wins. Readers memory-map the segment files, so reading a species only pages in its own records.
+
+    :ivar location: The folder of the store.
+    :vartype location: string
+
+    :ivar shape: The (height, width) of the global grid the cell IDs refer to.
+    :vartype shape: tuple(int, int)
+    """
+    _lock = threading.Lock()
+
+    def __init__(self, location, shape=None, transform=None, value_dtype=np.int8):
+        if not location:
+            raise AttributeError("Please provide the location of the species store.")
+        self.location = location
+        metadata_file = os.path.join(location, SPECIES_STORE_METADATA_FILE)
+        if os.path.exists(metadata_file):
+            with open(metadata_file) as species_file:
+                self.metadata = json.load(species_file)
+            if shape is not None and tuple(shape) != tuple(self.metadata['shape']):
+                raise AttributeError("The species store %s has shape %s, instead of %s." % (location, tuple(self.metadata['shape']), tuple(shape)))
+        else:
+            if shape is None:
+                raise AttributeError("There is no species store in %s. Please provide the shape of the grid to create one." % location)
+            if not os.path.exists(location):
+                os.makedirs(location)
+            if transform is None:
+                # a global-scale (-180, -90, 180, 90) grid
+                transform = [-180.0, 360.0 / shape[1], 0.0, 90.0, 0.0, -180.0 / shape[0]]
+            self.metadata = {'shape': [int(size) for size in shape],
+                             'transform': list(transform.to_gdal()) if hasattr(transform, 'to_gdal') else list(transform),
+                             'value_dtype': np.dtype(value_dtype).str}
+            temporary_file_name = "%s.%s.%s.tmp" % (metadata_file, os.getpid(), threading.current_thread().ident)
+            with open(temporary_file_name, "w") as species_file:
+                json.dump(self.metadata, species_file)
+            os.replace(temporary_file_name, metadata_file)
+        self.shape = tuple(self.metadata['shape'])
+        self.record_dtype = np.dtype([('species_id', '<i4'), ('cell_id', '<i8'), ('value', self.metadata['value_dtype'])])
+        self._index = None
+
+    def _writer_name(self):
+        # every writer (process on a host) has its own segment and index files
+        return "%s-%s" % (socket.gethostname(), os.getpid())
+
+    def append(self, name_species, cell_ids, values, species_id=None):
+        """
+        Appends (or replaces) the records of a species.
+
+        :param string name_species: The name of the species.
+
+        :param np.ndarray cell_ids: The cell IDs (``row * width + col``) of the records.
+
+        :param values: The values of the records (an array, or a single value for all cells).
+
+        :param int species_id: A numerical ID of the species, stored with every record. Default is derived from the name.
+
+        :returns: None
+
+        """
+        cell_ids = np.asarray(cell_ids, dtype=np.int64)
+        if species_id is None:
+            species_id = zlib.crc32(name_species.encode('utf-8')) & 0x7fffffff
+        records = np.empty(cell_ids.shape[0], dtype=self.record_dtype)
+        records['species_id'] = species_id
+        records['cell_id'] = cell_ids
+        records['value'] = values
+        writer_name = self._writer_name()
+        with self._lock:
+            with open(os.path.join(self.location, writer_name + ".records"), "ab") as segment_file:
+                segment_file.seek(0, os.SEEK_END)
+                offset = segment_file.tell() // self.record_dtype.itemsize
+                if segment_file.tell() % self.record_dtype.itemsize:
+                    # the tail of an interrupted write is skipped
+                    offset += 1
+                    segment_file.write(b"\0" * (self.record_dtype.itemsize - segment_file.tell() % self.record_dtype.itemsize))
+                segment_file.write(records.tobytes())
+                segment_file.flush()
+                os.fsync(segment_file.fileno())
+            entry = {'species': name_species, 'species_id': int(species_id), 'segment': writer_name,
+                     'offset': int(offset), 'count': int(records.shape[0]), 'time': time.time()}
+            with open(os.path.join(self.location, writer_name + ".index"), "a") as index_file:
+                index_file.write(json.dumps(entry) + "\n")
+        self._index = None
+
+    def index(self):
+        """
+        Reads the index of the store, from the index files of all writers.
+
+        :returns: The species_id, segment (writer), offset and count of the records of every species, indexed by species name.
+
+        :rtype: pandas.DataFrame
+
+        """
+        if self._index is None:
+            entries = []
+            for index_file_name in sorted(glob.glob(os.path.join(self.location, "*.index"))):
+                with open(index_file_name) as index_file:
+                    for line in index_file:
+                        try:
+                            entries.append(json.loads(line))
+                        except ValueError:
+                            continue   # a partially written line
+            index = pd.DataFrame(entries, columns=['species', 'species_id', 'segment', 'offset', 'count', 'time'])
+            # the last write of a species wins
+            index = index.sort_values('time', kind='mergesort').drop_duplicates('species', keep='last')
+            self._index = index.set_index('species').sort_index()
+        return self._index
+
+    def species(self):
+        """
+        :returns: The names of all species in the store.
+
+        :rtype: list(string)
+
+        """
+        return self.index().index.tolist()
+
+    def _segment(self, segment):
+        file_name = os.path.join(self.location, segment + ".records")
+        count = os.path.getsize(file_name) // self.record_dtype.itemsize
+        if count == 0:
+            return np.empty(0, dtype=self.record_dtype)
+        return np.memmap(file_name, dtype=self.record_dtype, mode='r', shape=(count, ))
+
+    def read(self, name_species):
+        """
+        Reads the records of one species.
+
+        :param string name_species: The name of the species.
+
+        :returns: A tuple of two arrays: the (sorted) cell IDs, and the values.
+
+        :rtype: tuple(np.ndarray, np.ndarray)
+
+        """
+        index = self.index()
+        if name_species not in index.index:
+            raise KeyError("There is no species %s in the store %s." % (name_species, self.location))
+        entry = index.loc[name_species]
+        records = np.array(self._segment(entry['segment'])[entry['offset']:entry['offset'] + entry['count']])
+        records.sort(order='cell_id', kind='mergesort')
+        return records['cell_id'], records['value']
+
+    def read_all(self, species=None):
+        """
+        Reads the records of all species (or of some species), into flat arrays, grouped by species (in the order of their names).
+
+        :param list species: Only read these species.
+
+        :returns: A tuple of three arrays: the species IDs, the cell IDs and the values.
+
+        :rtype: tuple(np.ndarray, np.ndarray, np.ndarray)
+
+        """
+        index = self.index()
+        if species is not None:
+            index = index[index.index.isin(species)]
+        records = np.empty(int(index['count'].sum()), dtype=self.record_dtype)
+        segments, position = {}, 0
+        for _, entry in index.iterrows():
+            if entry['segment'] not in segments:
+                segments[entry['segment']] = self._segment(entry['segment'])
+            species_records = records[position:position + entry['count']]
+            species_records[:] = segments[entry['segment']][entry['offset']:entry['offset'] + entry['count']]
+            species_records.sort(order='cell_id', kind='mergesort')
+            position += entry['count']
+        return records['species_id'], records['cell_id'], records['value']
+
+    def to_dataframe(self, name_species):
+        """
+        Converts the records of a species to a dataframe indexed by the latitude/longitude of the (centers of the) cells, with
+        one column (named after the species) for the values, as the csv files of the processing pipelines.
+
+        :rtype: pandas.DataFrame
+
+        """
+        from rasterio.transform import Affine
+        cell_ids, values = self.read(name_species)
+        # same convention as RasterEnvironmentalLayer.pixel_to_world_coordinates (pixel centers)
+        latitudes, longitudes = grid_transform(Affine.from_gdal(*self.metadata['transform']), self.shape).cells_to_world(cell_ids)
+        index = pd.MultiIndex.from_arrays([latitudes, longitudes], names=['decimallatitude', 'decimallongitude'])
+        return pd.DataFrame({name_species: values}, index=index)
+
+    def export_csv(self, location, species=None):
+        """
+        Exports the records of every species (or of some species) to a csv file per species, named after the species.
+
+        :param string location: The folder for the csv files.
+
+        :param list species: Only export these species.
+
+        :returns: None
+
+        """
+        if not os.path.exists(location):
+            os.makedirs(location)
+        for name_species in (species if species is not None else self.species()):
+            # the cells are sorted row by row: latitude descending, longitude ascending
+            self.to_dataframe(name_species).to_csv(os.path.join(location, name_species + ".csv"))
+
+
+def _initialize_worker(specifications):
+    global _worker_layers
+    _worker_layers = SharedLayers.open_layers(specifications)
+
+
+def _process_one(task):
+    species_function, name_species, species_kwargs = task
+    start_time = timeit.default_timer()
+    try:
+        result = species_function(name_species, _worker_layers, **species_kwargs)
+        return (name_species, True, result, timeit.default_timer() - start_time)
+    except Exception:
+        # isolate the failure: one broken species should never take the whole run down
+        return (name_species, False, traceback.format_exc(), timeit.default_timer() - start_time)
+
+
+def run_species(species_names,
+                species_function,
+                shared_layers=None,
+                species_arguments=None,
+                processes=None,
+                shared_location=None,
+                species_costs=None):
+    """
+    Runs :attr:`species_function` for every species in :attr:`species_names`, spreading the species over a pool of
+    worker processes. Typically the function rasterizes the species data, samples pseudo-absences and stores the result,
+    i.e., the body of the loop in the ``step1_climate_envelope.py`` and ``step2_finegrained.py`` scripts.
+
+    The (large, global) raster layers in :attr:`shared_layers` are loaded only once: they are stored in memory-mapped files
+    (see :class:`SharedLayers`), and every worker opens them read-only when it starts. They are never pickled per task.
+
+    A failure (exception) while processing one species is logged together with its traceback, and the run continues
+    with the next species.
+
+    :param list species_names: The (binomial) names of the species to process.
+
+    :param species_function: A function called as ``species_function(name_species, layers, **kwargs)``, where ``layers`` is a \
+    dictionary of read-only arrays with the same keys as :attr:`shared_layers`. It must be defined at the module level, so that \
+    it can be sent to the worker processes.
+
+    :param dict shared_layers: Layer names and (global) raster arrays, shared read-only with all workers.
+
+    :param species_arguments: Additional keyword arguments for :attr:`species_function`, per species. Either a dictionary \
+    (name_species -> dict) or a function called with the name of the species, returning a dictionary. These are pickled \
+    per task, so they should be small (for example the rangemap records of one species).
+
+    :param int processes: The number of worker processes. Default is the number of CPUs. With ``processes=1`` all species \
+    are processed in the current process.
+
+    :param string shared_location: Folder where the memory-mapped shared layers are stored. By default a temporary \
+    folder is used, and removed at the end of the run.
+
+    :param dict species_costs: An estimate of the processing cost of every species (name_species -> number), for example the \
+    ``window_pixels`` of the ``IUCNSpecies.species_catalog``. If given, the most costly species are processed first, so that \
+    a few large species do not end up running alone at the end of the run. Species without an estimate are processed last.
+
+    :returns: A tuple of two dictionaries: the first maps each successfully processed species to the value returned by \
+    :attr:`species_function`, the second maps each failed species to its error traceback.
+
+    :rtype: tuple(dict, dict)
+
+    """
+    if not callable(species_function):
+        raise AttributeError("Please provide a species_function to run for every species.")
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+
+    def arguments_for(name_species):
+        if species_arguments is None:
+            return {}
+        if callable(species_arguments):
+            return species_arguments(name_species) or {}
+        return species_arguments.get(name_species, {})
+
+    if species_costs is not None:
+        # a stable sort: species with equal (or no) cost estimates keep their original order
+        species_names = sorted(species_names, key=lambda name_species: -species_costs.get(name_species, float('-inf')))
+
+    results, failures = {}, {}
+
+    def tasks():
+        for name_species in species_names:
+            try:
+                species_kwargs = arguments_for(name_species)
+            except Exception:
+                failures[name_species] = traceback.format_exc()
+                logger.error("Could not prepare the arguments for species %s:\n%s" % (name_species, failures[name_species]))
+                continue
+            yield (species_function, name_species, species_kwargs)
+
+    shared = SharedLayers(shared_layers, location=shared_location)
+    pool = None
+    start_time = timeit.default_timer()
+    try:
+        if processes == 1:
+            logger.info("Processing species in the current process.")
+            _initialize_worker(shared.specifications)
+            outcomes = (_process_one(task) for task in tasks())
+        else:
+            logger.info("Processing species on a pool of %s worker processes." % processes)
+            pool = multiprocessing.Pool(processes, initializer=_initialize_worker, initargs=(shared.specifications,))
+            outcomes = pool.imap_unordered(_process_one, tasks())
+        for name_species, succeeded, outcome, elapsed in outcomes:
+            if succeeded:
+                results[name_species] = outcome
+                logger.info("Finished species %s in %.2f seconds (%s done, %s failed)."
+                            % (name_species, elapsed, len(results), len(failures)))
+            else:
+                failures[name_species] = outcome
+                logger.error("Processing species %s failed after %.2f seconds:\n%s" % (name_species, elapsed, outcome))
+        if pool is not None:
+            pool.close()
+            pool.join()
+    except BaseException:
+        # only stop the workers (with their running tasks) on an error, e.g. KeyboardInterrupt
+        if pool is not None:
+            pool.terminate()
+        raise
+    finally:
+        _worker_layers.clear()
+        shared.cleanup()
+    logger.info("Processed %s species in %.2f seconds, %s failed."
+                % (len(results) + len(failures), timeit.default_timer() - start_time, len(failures)))
+    return results, failures
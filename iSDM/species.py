@@ -7,11 +7,13 @@ A module for all species layers functionality.
 
 from pygbif import species   # http://pygbif.readthedocs.org/en/latest/
 from pygbif import occurrences
+from iSDM.gbif import OccurrenceFetcher, MAX_PAGE_SIZE, MAX_RECORDS
 import copy
 import pandas as pd
 import logging
 import os
 import csv
+import json
 from enum import Enum
 import matplotlib.pyplot as plt
 import numpy as np
@@ -26,6 +28,8 @@ from rasterio.transform import Affine
 import rasterio
 from rasterio import features
 from shapely.prepared import prep
+from iSDM.geometry import points_from_xy, points_to_pixels, points_within, points_in_geometry, count_vertices, make_valid, unique_grid_points, tiled_union, grid_transform
+from iSDM.cache import load_vector, VectorCache
 import pprint
 
 logger = logging.getLogger('iSDM.species')
@@ -66,6 +70,8 @@ class Species(object):
 
     ID = int(0)
     name_species = 'Unknown'
+    # file extension per method of serialization, see save_data() and load_data()
+    FILE_EXTENSIONS = {'pickle': ".pkl", 'msgpack': ".msg", 'parquet': ".parquet", 'feather': ".feather"}
 
     def __init__(self, **kwargs):
 
@@ -87,19 +93,21 @@ class Species(object):
     def save_data(self, full_name=None, dir_name=None, file_name=None, method="pickle"):
         """
         Serializes the loaded species dataset (`pandas <http://pandas.pydata.org/pandas-docs/stable/dsintro.html>`_ or `geopandas <http://geopandas.org/user.html>`_ DataFrame)
-        into a binary `pickle <https://en.wikipedia.org/wiki/Pickle_%28Python%29>`_  (or `msgpack <http://msgpack.org/index.html>`_) file.
+        into a binary `pickle <https://en.wikipedia.org/wiki/Pickle_%28Python%29>`_  (or `msgpack <http://msgpack.org/index.html>`_) file,
+        or into a columnar `Parquet <https://parquet.apache.org/>`_ or `Feather <https://arrow.apache.org/docs/python/feather.html>`_ file.
+        The columnar formats allow loading only some of the columns (and rows) later on, see :func:`load_data`.
 
         :param string full_name: The full path of the file (including the directory and filename in one string),
         where the data will be saved.
 
         :param string dir_name: The directory where the file will be stored. \
-        If :attr:`file_name` is not specified, the default one :attr:`name_species` + ``.pkl`` (or ``.msg``) is given by default.
+        If :attr:`file_name` is not specified, the default one :attr:`name_species` + ``.pkl`` (or ``.msg``, ``.parquet``, ``.feather``) is given by default.
 
         :param string file_name: The name of the file where the data will be saved. \
         If :attr:`dir_name` is not specified, the current working directory is taken by default.
 
         :param string method: The type of serialization to use for the data frame. Default is `pickle`. Another possibility is `msgpack`, as it has shown as 10% more efficient \
-        in terms of time and memory, for the type of data we are dealing with.
+        in terms of time and memory, for the type of data we are dealing with (only with older versions of pandas). The columnar formats are `parquet` and `feather`.
 
         :raises: AttributeError: if the data has not been loaded in the object before. See :func:`load_data` and :func:`find_species_occurrences`
 
@@ -108,7 +116,7 @@ class Species(object):
         """
         if full_name is None:
             if file_name is None:
-                file_name = str(self.name_species) + (".pkl" if method == "pickle" else ".msg")
+                file_name = str(self.name_species) + self.FILE_EXTENSIONS.get(method, ".pkl")
             if dir_name is None:
                 dir_name = os.getcwd()
 
@@ -116,9 +124,21 @@ class Species(object):
 
         try:
             if method == "msgpack":
+                if not hasattr(self.data_full, 'to_msgpack'):
+                    logger.error("This version of pandas does not support msgpack anymore. Please use parquet or feather.")
+                    return
                 self.data_full.to_msgpack(full_name)
             elif method == "pickle":
                 self.data_full.to_pickle(full_name)
+            elif method == "parquet":
+                self.data_full.to_parquet(full_name)
+            elif method == "feather":
+                if isinstance(self.data_full, GeoDataFrame):
+                    self.data_full.to_feather(full_name)
+                else:
+                    # a non-default index is stored as (a) column(s), and restored on loading from the pandas metadata
+                    from pyarrow import feather, Table
+                    feather.write_feather(Table.from_pandas(self.data_full), full_name)
             else:
                 logger.error("Incorrect method of serializing: %s " % method)
                 return
@@ -130,41 +150,143 @@ class Species(object):
         except AttributeError as e:
             logger.error("No data to save. Please load it first. %s " % str(e))
 
-    def load_data(self, file_path=None, method='pickle'):
+    def load_data(self, file_path=None, method=None, columns=None, filters=None, memory_map=False):
         """
         Loads the data from the serialized species file into a pandas DataFrame. If the :attr:`file_path` parameter is not supplied,
         it will try to deduce the file name from the name of the species by default.
+        With the columnar formats (`parquet` and `feather`), only the requested :attr:`columns` are read from the file. With
+        `parquet`, the row :attr:`filters` are also pushed down to the reader, so row groups which cannot match are skipped.
+        For the other formats, the whole file is deserialized first, and the columns and filters are applied afterwards.
 
         :param string file_path: The full path to the file (including the directory and filename in one string), where the data is serialized to.
 
-        :param string method: The type of serialization that was used to serialize the data in the data frame. \
-        Default is `pickle`. Another possibility is "msgpack", as it has shown as 10% more efficient in terms of time and memory, \
-        for the type of data we are dealing with.
+        :param string method: The type of serialization that was used to serialize the data in the data frame: \
+        `pickle`, `msgpack`, `parquet` or `feather`. By default, it is deduced from the extension of the file (and otherwise `pickle`).
+
+        :param list columns: The names of the columns to load. Requested columns which are not in the file are ignored. \
+        Default is all columns.
+
+        :param list filters: Row filters in disjunctive normal form: a list of ``(column, operator, value)`` tuples which must \
+        all hold, or a list of such lists, at least one of which must hold. Operators are ``==``, ``=``, ``!=``, ``<``, ``<=``, \
+        ``>``, ``>=``, ``in`` and ``not in``. For example ``[('year', '>', 1990), ('basisofrecord', 'in', ['OBSERVATION'])]``.
+
+        :param bool memory_map: Whether to memory-map the file while reading it (only for `parquet` and `feather`).
 
         :returns: Data loaded into (geo)pandas Dataframe.
 
         :rtype: geopandas.GeoDataFrame
 
         """
+        if method is None:
+            extension = os.path.splitext(file_path)[1] if file_path else ".pkl"
+            methods = dict((file_extension, name_method) for name_method, file_extension in self.FILE_EXTENSIONS.items())
+            method = methods.get(extension, "pickle")
         if file_path is None:
-            filename = str(self.name_species) + (".pkl" if method == "pickle" else ".msg")
+            filename = str(self.name_species) + self.FILE_EXTENSIONS.get(method, ".pkl")
             file_path = os.path.join(os.getcwd(), filename)
 
         logger.info("Loading data from: %s" % file_path)
 
         try:
             if method == "msgpack":
-                self.data_full = pd.read_msgpack(file_path)
+                if not hasattr(pd, 'read_msgpack'):
+                    logger.error("This version of pandas cannot read msgpack files anymore. Please convert %s to parquet "
+                                 "or feather, with an older version of pandas." % file_path)
+                    return
+                data = pd.read_msgpack(file_path)
             elif method == "pickle":
-                self.data_full = pd.read_pickle(file_path)
+                data = pd.read_pickle(file_path)
+            elif method in ("parquet", "feather"):
+                data = self._load_columnar(file_path, method, columns, filters, memory_map)
+                filters = None if method == "parquet" else filters
             else:
                 logger.error("Unknown method of serializing: %s " % method)
                 return
+            if filters:
+                data = data[self._filters_mask(data, filters)]
+            if columns is not None:
+                data = data[[column for column in data.columns if column in columns or column == getattr(data, '_geometry_column_name', None)]]
+            self.data_full = data
             logger.info("Succesfully loaded previously saved data.")
             return self.data_full
         except IOError as e:
             logger.error("Problem loading data! %s " % str(e))
 
+    @classmethod
+    def _load_columnar(cls, file_path, method, columns=None, filters=None, memory_map=False):
+        try:
+            import pyarrow
+            import pyarrow.parquet as pq
+            from pyarrow import feather
+        except ImportError:
+            raise IOError("Please install pyarrow, for reading %s files." % method)
+        if method == "parquet":
+            schema = pq.read_schema(file_path, memory_map=memory_map)
+        else:
+            with (pyarrow.memory_map(file_path) if memory_map else pyarrow.OSFile(file_path)) as source:
+                schema = pyarrow.ipc.open_file(source).schema
+        if columns is not None:
+            missing_columns = [column for column in columns if column not in schema.names]
+            if missing_columns:
+                logger.debug("Columns not available in %s: %s " % (file_path, missing_columns))
+            # the columns needed for filtering (feather) are read too, and dropped afterwards in load_data()
+            filter_columns = []
+            if filters and method == "feather":
+                filter_columns = [column for conjunction in cls._disjunctive_filters(filters) for column, _, _ in conjunction]
+            # the columns of a stored (non-default) index are read too, to restore the index
+            index_columns = [column for column in (schema.pandas_metadata or {}).get('index_columns', []) if not isinstance(column, dict)]
+            columns = [column for column in schema.names if column in columns or column in filter_columns or column in index_columns]
+        if schema.metadata and b'geo' in schema.metadata:
+            # written from a GeoDataFrame, let geopandas restore the geometries (always with the geometry column)
+            import geopandas
+            if columns is not None:
+                geometry_column = json.loads(schema.metadata[b'geo'].decode("utf-8"))['primary_column']
+                columns = columns + [geometry_column] if geometry_column not in columns else columns
+            if method == "parquet":
+                return geopandas.read_parquet(file_path, columns=columns, filters=filters, memory_map=memory_map)
+            return geopandas.read_feather(file_path, columns=columns, memory_map=memory_map)
+        if method == "parquet":
+            table = pq.read_table(file_path, columns=columns, filters=filters, memory_map=memory_map, use_pandas_metadata=True)
+        else:
+            table = feather.read_table(file_path, columns=columns, memory_map=memory_map)
+        return table.to_pandas()
+
+    @classmethod
+    def _disjunctive_filters(cls, filters):
+        # a single list of (column, operator, value) tuples is one conjunction
+        if filters and isinstance(filters[0], tuple):
+            return [filters]
+        return filters
+
+    @classmethod
+    def _filters_mask(cls, data, filters):
+        mask = np.zeros(data.shape[0], dtype=bool)
+        for conjunction in cls._disjunctive_filters(filters):
+            conjunction_mask = np.ones(data.shape[0], dtype=bool)
+            for column, operator, value in conjunction:
+                values = data[column]
+                if operator in ("=", "=="):
+                    condition = values == value
+                elif operator == "!=":
+                    condition = values != value
+                elif operator == "<":
+                    condition = values < value
+                elif operator == "<=":
+                    condition = values <= value
+                elif operator == ">":
+                    condition = values > value
+                elif operator == ">=":
+                    condition = values >= value
+                elif operator == "in":
+                    condition = values.isin(value)
+                elif operator == "not in":
+                    condition = ~values.isin(value)
+                else:
+                    raise AttributeError("Unsupported filter operator: %s " % operator)
+                conjunction_mask &= np.asarray(condition, dtype=bool)
+            mask |= conjunction_mask
+        return mask
+
     def find_species_occurrences(self, name_species=None, **kwargs):
         raise NotImplementedError("You need to implement this method in a subclass!")
 
@@ -239,20 +361,16 @@ class Species(object):
                 logger.error("Could not open raster file. %s " % str(e))
                 raise AttributeError(e)
 
-        # first get the original Affine transformation matrix
-        T0 = self.raster_affine
-        # convert it to gdal format (it is otherwise flipped)
-        T0 = Affine(*reversed(T0.to_gdal()))
-        logger.debug("Affine transformation T0:\n %s " % (T0,))
-        # shift by 50% to get the pixel center
-        T1 = T0 * Affine.translation(0.5, 0.5)
-        # apply the shift, filtering out no_data_value values
         logger.debug("Raster data shape: %s " % (raster_data.shape,))
-        logger.debug("Affine transformation T1:\n %s " % (T1,))
+        # the pixel centers are looked up in the (cached) latitudes of the rows and longitudes of the columns,
+        # without a floating-point copy of the raster
+        selected = np.ones(raster_data.shape, dtype=bool)
+        if np.issubdtype(raster_data.dtype, np.floating):
+            selected &= ~np.isnan(raster_data)
         if filter_no_data_value:
             logger.info("Filtering out no_data pixels.")
-            raster_data = np.where(raster_data != no_data_value, raster_data, np.nan)
-        coordinates = (T1 * np.where(~np.isnan(raster_data)))
+            selected &= raster_data != no_data_value
+        coordinates = grid_transform(self.raster_affine, raster_data.shape).mask_to_world(selected)
         logger.info("Transformation to world coordinates completed.")
         return coordinates
 
@@ -289,6 +407,130 @@ class Species(object):
         self.raster_reader = src
         return self.raster_reader
 
+    @classmethod
+    def global_window(cls, bounds, pixel_size):
+        """
+        Computes the smallest window of the global-scale raster (-180, -90, 180, 90) at resolution :attr:`pixel_size`, which
+        covers the given :attr:`bounds`. The window is snapped to the pixels of the global raster, so that its pixels line up
+        with the pixels of any other global-scale layer at the same resolution.
+
+        :param tuple bounds: The (x_min, y_min, x_max, y_max) boundaries to cover, in degrees.
+
+        :param float pixel_size: The size of the pixel in degrees.
+
+        :returns: A tuple (row_offset, column_offset, height, width) of the window in the global raster.
+
+        :rtype: tuple(int, int, int, int)
+
+        """
+        row_start, col_start, row_stop, col_stop = cls._global_windows(bounds[0], bounds[1], bounds[2], bounds[3], pixel_size)
+        return (int(row_start), int(col_start), int(row_stop - row_start), int(col_stop - col_start))
+
+    @staticmethod
+    def _global_windows(minx, miny, maxx, maxy, pixel_size):
+        # the (row_start, col_start, row_stop, col_stop) of the global_window() of the given bounds (scalars or arrays).
+        # The stop is the pixel holding the max-lon (min-lat) boundary plus one, so a point lying exactly on the edge
+        # between two pixels is inside the window, in the same pixel as in the global raster.
+        x_min, y_min, x_max, y_max = -180, -90, 180, 90
+        x_res = int((x_max - x_min) / pixel_size)
+        y_res = int((y_max - y_min) / pixel_size)
+        col_start = np.clip(np.floor((minx - x_min) / pixel_size), 0, x_res - 1)
+        col_stop = np.clip(np.floor((maxx - x_min) / pixel_size) + 1, col_start + 1, x_res)
+        row_start = np.clip(np.floor((y_max - maxy) / pixel_size), 0, y_res - 1)
+        row_stop = np.clip(np.floor((y_max - miny) / pixel_size) + 1, row_start + 1, y_res)
+        return row_start, col_start, row_stop, col_stop
+
+    def rasterize_window(self, pixel_size=None, raster_file=None, all_touched=False,
+                         no_data_value=0,
+                         default_value=1,
+                         crs=None):
+        """
+        Rasterize (burn) the species geometries into the pixels of a window of the global-scale raster (-180, -90, 180, 90),
+        instead of the entire global raster. The window is the smallest one that covers the total bounds of the geometries,
+        snapped to the global pixel grid (see :func:`global_window`), so the result lines up with the global raster: pixel
+        ``(row, col)`` of the window is pixel ``(row + row_offset, col + column_offset)`` of the global raster.
+        The global-scale array is never allocated, so the memory needed scales with the range of the species.
+
+        If the geometries are smaller than a pixel (in width or height), ``all_touched=True`` is used directly, since
+        otherwise no pixel center could fall inside them. If the rasterized window is still empty, it is burned once more
+        with ``all_touched=True``, which is cheap on such a small window.
+        The :attr:`raster_affine` is set to the transformation of the window, so :func:`pixel_to_world_coordinates` can be
+        applied directly to the returned data.
+
+        :param float pixel_size: The size of the pixel in degrees, i.e., the resolution to use for rasterizing.
+
+        :param string raster_file: Optional full path to a target GeoTIFF raster file, to store the (window) raster data.
+
+        :param bool all_touched: If true, all pixels touched by geometries, will be burned in. If false, only pixels \
+        whose center is within the polygon or that are selected by *Bresenham's line algorithm*, will be burned in.
+
+        :param int no_data_value: Used as value of the pixels which are not burned in. Default is 0.
+
+        :param int default_value: Used as value of the pixels which are burned in. Default is 1.
+
+        :param dict crs: The Coordinate Reference System to use. Default is "ESPG:4326"
+
+        :returns: A tuple containing the 2-dimensional (window) array, and the (row_offset, column_offset) of the window \
+        in the global-scale raster.
+
+        :rtype: tuple(np.ndarray, tuple(int, int))
+
+        """
+        if not pixel_size:
+            raise AttributeError("Please provide pixel_size.")
+
+        if not hasattr(self, 'data_full'):
+            raise AttributeError("You have not loaded the data.")
+
+        if crs is None:
+            crs = {'init': "EPSG:4326"}
+
+        if self.data_full.shape[0] == 0:
+            raise AttributeError("There are no geometries to rasterize.")
+
+        bounds = self._total_bounds()
+        row_offset, column_offset, y_res, x_res = self.global_window(bounds, pixel_size)
+        transform = Affine.translation(-180 + column_offset * pixel_size, 90 - row_offset * pixel_size) * Affine.scale(pixel_size, -pixel_size)
+        if not all_touched and (bounds[2] - bounds[0] < pixel_size or bounds[3] - bounds[1] < pixel_size):
+            logger.info("Rasterizing a very small area, will use all_touched=True to avoid a blank raster.")
+            all_touched = True
+        result = self._burn(transform, (y_res, x_res), all_touched, no_data_value, default_value)
+        if not all_touched and not (result != no_data_value).any():
+            logger.info("Blank raster, will rasterize the window again with all_touched=True.")
+            result = self._burn(transform, (y_res, x_res), True, no_data_value, default_value)
+
+        if raster_file:
+            with rasterio.open(raster_file, 'w', driver='GTiff', width=x_res, height=y_res,
+                               count=1,
+                               dtype=np.uint8,
+                               nodata=no_data_value,
+                               transform=transform,
+                               crs=crs) as out:
+                out.write(result.astype(np.uint8), indexes=1)
+            logger.info("RASTERIO: Data rasterized into file %s " % raster_file)
+            self.raster_file = raster_file
+        logger.info("RASTERIO: Window: row_offset={0} column_offset={1} x_res={2} y_res={3}".format(row_offset, column_offset, x_res, y_res))
+        self.raster_affine = transform
+        self.raster_window = (row_offset, column_offset, y_res, x_res)
+        return result, (row_offset, column_offset)
+
+    def _total_bounds(self):
+        # (x_min, y_min, x_max, y_max) of all geometries
+        if not isinstance(self.data_full, GeoDataFrame):
+            logger.info("Will convert the latitude/longitude into a GeoDataFrame (with geometry column)")
+            self.geometrize()
+        return self.data_full.geometry.total_bounds
+
+    def _burn(self, transform, out_shape, all_touched, no_data_value, default_value):
+        # burn all geometries into a raster of shape out_shape
+        return features.rasterize(self.data_full.geometry,
+                                  transform=transform,
+                                  out_shape=out_shape,
+                                  all_touched=all_touched,
+                                  fill=no_data_value,
+                                  default_value=default_value
+                                  )
+
     def plot_species_occurrence(self, figsize=(16, 12), projection='merc', facecolor='crimson'):
         """
         Visually plots the species data on a `Basemap <http://matplotlib.org/basemap/api/basemap_api.html#module-mpl_toolkits.basemap>`_.
@@ -372,6 +614,9 @@ class GBIFSpecies(Species):
     :ivar data_full: Data frame containing the full data for the species occurrences.
     :vartype data_full: pandas.DataFrame or geopandas.GeoDataFrame
 
+    :ivar rejected_data: The records left out by the last :func:`overlay` (only with ``keep_rejected=True``).
+    :vartype rejected_data: geopandas.GeoDataFrame
+
     """
 
     def __init__(self, **kwargs):
@@ -379,7 +624,7 @@ class GBIFSpecies(Species):
         self.source = Source.GBIF
         self.observations_type = ObservationsType.PRESENCE_ONLY
 
-    def find_species_occurrences(self, name_species=None, **kwargs):
+    def find_species_occurrences(self, name_species=None, concurrent=False, max_workers=8, **kwargs):
         """
         Finds and loads species occurrence data into pandas DataFrame. The data comes from GBIF backbone API requests,
         based on the name of the species (:attr:`name_species`). If the :attr:`name_species` parameter is not provided, it is attempted
@@ -389,9 +634,15 @@ class GBIFSpecies(Species):
         limited to a maximum of 300 records per page, at the time of writing this. The method below will loop until there are
         no more "next" pages (``endOfRecords`` is reached), and combine all species occurrence (meta-)data in a single data structure.
         The pygbif.occurrences.search(...) returns a list of json structures which are loaded into ``pandas.DataFrame`` for easier manipulation.
+        With :attr:`concurrent` set, the pages are instead fetched concurrently, once the total number of records is known
+        (see :class:`iSDM.gbif.OccurrenceFetcher`). In both cases, records appearing on more than one page are kept only once.
 
         :param string name_species: The taxonomical name of the species to use for querying the `GBIF <http://www.gbif.org/>`_ backbone.
 
+        :param bool concurrent: Whether to fetch the pages of results concurrently. Default is False.
+
+        :param int max_workers: The maximum number of concurrent requests, when :attr:`concurrent` is set. Default is 8.
+
         :returns: Data frame containing all species occurrences (meta-)data.
 
         :rtype: pandas.DataFrame
@@ -410,11 +661,18 @@ class GBIFSpecies(Species):
                 # raise ValueError("No match for the species %s " % self.name_species)
                 # TODO: maybe just return, no error raising...
             self.ID = species_result['usageKey']
-            first_res = occurrences.search(taxonKey=self.ID, limit=100000, **kwargs)
-
         except AttributeError:   # name not provided, assume at least ID is provided and try querying using the ID as a taxonkey.
-            first_res = occurrences.search(taxonKey=self.ID, limit=100000, **kwargs)
+            pass
+
+        if concurrent:
+            fetcher = OccurrenceFetcher(max_workers=max_workers)
+            try:
+                full_results = fetcher.fetch_occurrences(taxonKey=self.ID, **kwargs)
+            finally:
+                fetcher.close()
+            return self._load_occurrences(full_results)
 
+        first_res = occurrences.search(taxonKey=self.ID, limit=MAX_PAGE_SIZE, **kwargs)
         full_results = copy.copy(first_res)
         logger.info("Number of occurrences in GBIF backbone: %s " % full_results['count'])
         # http://lists.gbif.org/pipermail/api-users/2015-February/000135.html
@@ -433,14 +691,21 @@ class GBIFSpecies(Species):
         # size of 300 records per page. Note that for technical reasons we also have a hard limit for any query of 200,000
         # records. You will get an error if the offset + limit exceeds 200,000. To retrieve all records beyond 200,000 you should
         # use our asynchronous download service instead."
+        # The offset advances by the page size, so that consecutive pages do not overlap.
         counter = 1
-        limit = 10000
-        while first_res['endOfRecords'] is False and (300 * counter) + limit < 200000:
-            first_res = occurrences.search(taxonKey=self.ID, offset=300 * counter, limit=limit)
-            logger.debug("Page offset: %s, counter %s. Got %s more records ... " % ((300 * counter), counter, len(first_res['results'])))
+        offset = len(first_res['results']) or MAX_PAGE_SIZE
+        while first_res['endOfRecords'] is False and offset < MAX_RECORDS:
+            # the last page ends exactly at the limit
+            first_res = occurrences.search(taxonKey=self.ID, offset=offset, limit=min(MAX_PAGE_SIZE, MAX_RECORDS - offset), **kwargs)
+            logger.debug("Page offset: %s, counter %s. Got %s more records ... " % (offset, counter, len(first_res['results'])))
             full_results['results'].extend(first_res['results'])
+            offset += MAX_PAGE_SIZE
             counter += 1
 
+        full_results['results'] = OccurrenceFetcher.unique_records(full_results['results'])
+        return self._load_occurrences(full_results)
+
+    def _load_occurrences(self, full_results):
         logger.info("Loading species ... ")
         logger.debug(full_results['count'] == len(full_results['results']))   # match?
         logger.debug("Full results: %s , got: %s " % (full_results['count'], len(full_results['results'])))
@@ -499,14 +764,19 @@ class GBIFSpecies(Species):
         finally:
             f.close()
 
-    def geometrize(self, dropna=True, longitude_col_name='decimallongitude', latitude_col_name='decimallatitude', crs=None):
+    def geometrize(self, dropna=True, longitude_col_name='decimallongitude', latitude_col_name='decimallatitude', crs=None, lazy=False):
         """
         Converts the species data from pandas.DataFrame contents to geopandas.GeoDataFrame format.
         GeoDataFrames inherit basic DataFrames, and provide more functionality on top of pandas.
         The biggest difference in terms of the data layout is the addition of a 'geometry' column which contains
         `Shapely <http://toblerity.org/shapely/shapely.geometry.html>`_ geometries in `geopandas <http://geopandas.org/user.html>`_.
         The ``decimallatitude`` and ``decimallongitude`` columns are converted into shapely Point geometry, one Point for each latitude/longitude
-        record.
+        record. The points are created at once, from the coordinate arrays (see :func:`iSDM.geometry.points_from_xy`).
+
+        With :attr:`lazy` set, no geometries are created at all: the data stays a ``pandas.DataFrame`` with plain (float) coordinate
+        columns, which is much faster and lighter for many records. Operations which only need the coordinates, such as
+        :func:`rasterize` and :func:`rasterize_window`, use them directly. Operations which need real geometries
+        (such as :func:`overlay` and :func:`polygonize`) call :func:`geometrize` when they need them.
 
         :param bool dropna: Whether to drop records with NaN values in the decimallatitude or decimallongitude columns in the conversion process.
 
@@ -517,6 +787,8 @@ class GBIFSpecies(Species):
         :param crs: The Coordinate Reference System of the data. Default is "EPSG:4326".
         :type crs: string or dictionary.
 
+        :param bool lazy: Whether to postpone the creation of the geometries until they are needed. Default is False.
+
         :returns: None
 
         """
@@ -529,41 +801,68 @@ class GBIFSpecies(Species):
         try:
             if crs is None:
                 crs = {'init': "EPSG:4326"}
-            # exclude those points with NaN in coordinates
+            data = self.data_full
+            # exclude those points with NaN in coordinates (in either of them, so the geometries stay aligned with the records)
             if dropna:
-                geometry = [Point(xy) for xy in zip(
-                    self.data_full[longitude_col_name].dropna(),
-                    self.data_full[latitude_col_name].dropna()
-                )]
-                self.data_full = GeoDataFrame(
-                    self.data_full.dropna(
-                        subset=[latitude_col_name, longitude_col_name]),
-                    crs=crs,
-                    geometry=geometry)
-                logger.info("Data geometrized: converted into GeoPandas dataframe.")
-                logger.info("Points with NaN coordinates ignored. ")
+                data = data.dropna(subset=[latitude_col_name, longitude_col_name])
+            self.geometry_columns = (longitude_col_name, latitude_col_name)
+            if lazy:
+                # check that the coordinate columns exist now, rather than when the geometries are needed
+                data[[longitude_col_name, latitude_col_name]]
+                self.data_full = data
+                logger.info("Data geometrized lazily: coordinates kept as plain columns.")
             else:
-                geometry = [Point(xy) for xy in zip(
-                    self.data_full[longitude_col_name],
-                    self.data_full[latitude_col_name]
-                )]
-                self.data_full = GeoDataFrame(self.data_full, crs=crs, geometry=geometry)
+                geometry = points_from_xy(data[longitude_col_name], data[latitude_col_name])
+                self.data_full = GeoDataFrame(data, crs=crs, geometry=geometry)
                 logger.info("Data geometrized: converted into GeoPandas dataframe.")
-        except AttributeError:
+            if dropna:
+                logger.info("Points with NaN coordinates ignored. ")
+        except (AttributeError, KeyError):
             logger.error("No latitude/longitude data to convert into a geometry. Please load the data first.")
 
+    def _coordinates(self):
+        # the (longitude, latitude) arrays of the records, without creating geometries
+        longitude_col_name, latitude_col_name = getattr(self, 'geometry_columns', ('decimallongitude', 'decimallatitude'))
+        if isinstance(self.data_full, GeoDataFrame) and longitude_col_name not in self.data_full.columns:
+            return self.data_full.geometry.x.values, self.data_full.geometry.y.values
+        return (self.data_full[longitude_col_name].values.astype(np.float64),
+                self.data_full[latitude_col_name].values.astype(np.float64))
+
+    def _total_bounds(self):
+        if isinstance(self.data_full, GeoDataFrame):
+            return Species._total_bounds(self)
+        longitudes, latitudes = self._coordinates()
+        return (np.nanmin(longitudes), np.nanmin(latitudes), np.nanmax(longitudes), np.nanmax(latitudes))
+
+    def _burn(self, transform, out_shape, all_touched, no_data_value, default_value):
+        # Points are burned into the pixel containing them (all_touched makes no difference for points), so
+        # the pixels are found directly from the coordinates, without geometries.
+        if isinstance(self.data_full, GeoDataFrame):
+            return Species._burn(self, transform, out_shape, all_touched, no_data_value, default_value)
+        longitudes, latitudes = self._coordinates()
+        rows, columns = points_to_pixels(longitudes, latitudes, transform, out_shape)
+        result = np.full(out_shape, no_data_value,
+                         dtype=np.result_type(np.min_scalar_type(no_data_value), np.min_scalar_type(default_value), np.uint8))
+        result[rows, columns] = default_value
+        return result
+
     def polygonize(self,
                    buffer_distance=1,
                    buffer_resolution=16,
                    simplify_tolerance=0.1,
                    preserve_topology=False,
-                   with_envelope=False):
+                   with_envelope=False,
+                   cell_size=None,
+                   tile_size=None):
         """
-        Helper method: expands each `Shapely <http://toblerity.org/shapely/shapely.geometry.html>`_ Point of the ``geopandas.GeoDataFrame``
-        species data into its *"polygon of influence"* (buffer). If the data is not already in a geopandas format,
-        the :func:`geometrize` method is called first. Further merges the polygons that overlap into a *cascaded union* (multipolygon).
-        The polygon is further simplified, also (optionally) by using an envelope around the buffer. An *envelope* is the smallest
-        rectangular polygon (with sides parallel to the coordinate axes) that contains the buffer geometry.
+        Helper method: expands each point record of the species data into its *"polygon of influence"* (buffer), and
+        merges the polygons that overlap into a union (multipolygon). The polygons are further simplified, also (optionally)
+        by using an envelope around the buffer. An *envelope* is the smallest rectangular polygon (with sides parallel to
+        the coordinate axes) that contains the buffer geometry.
+        For heavily sampled species, most buffers overlap (nearly) identical neighbours, so the records are first collapsed
+        onto the cells of a grid of :attr:`cell_size` (see :func:`iSDM.geometry.unique_grid_points`), and only one buffer per
+        occupied cell is created. The union is then computed tile by tile (see :func:`iSDM.geometry.tiled_union`), and the
+        tiles are merged. The coordinates are read directly from the data, so the data need not be geometrized.
         The original species data is un-altered.
 
         :param int buffer_distance: Unitless distance from the Point geometry, specifying the amount of "influence". Default is 1.
@@ -579,73 +878,137 @@ class GBIFSpecies(Species):
 
         :param bool with_envelope: Whether to use an envelope in the simplification of the geometry. Default is false.
 
-        :returns: Data frame containing all polygons of the simplified geometries.
+        :param float cell_size: The size of the grid cells the records are collapsed onto. A record moves at most half a cell \
+        diagonal, so the buffers are accurate to within that distance. Default is 1/16 of the :attr:`buffer_distance`. \
+        With ``cell_size=0``, only the exact duplicate records are collapsed.
+
+        :param float tile_size: The size of the tiles in which the union is computed. Default is 10 times the :attr:`buffer_distance`.
+
+        :returns: Data frame containing all polygons of the simplified geometries, one polygon per row.
 
         :rtype: geopandas.GeoDataFrame
 
         """
-        if not (isinstance(self.data_full, GeoSeries) or isinstance(self.data_full, GeoDataFrame)):
-            self.geometrize(dropna=True)
-
-        data_polygonized = self.data_full.copy(deep=True)
+        if not isinstance(self.data_full, pd.DataFrame):
+            raise AttributeError("You have not loaded the data.")
+        if cell_size is None:
+            cell_size = buffer_distance / 16.0
+        if tile_size is None:
+            tile_size = buffer_distance * 10.0
+
+        longitudes, latitudes = self._coordinates()
+        longitudes, latitudes = unique_grid_points(longitudes, latitudes, cell_size)
+        logger.debug("Collapsed %s records onto %s unique grid cells." % (self.data_full.shape[0], longitudes.shape[0]))
+
+        data_polygonized = GeoSeries(points_from_xy(longitudes, latitudes)).buffer(
+            buffer_distance,
+            buffer_resolution
+        ).simplify(simplify_tolerance, preserve_topology)
         if with_envelope:
-            data_polygonized = data_polygonized.buffer(
-                buffer_distance,
-                buffer_resolution
-            ).simplify(simplify_tolerance, preserve_topology).envelope
+            data_polygonized = data_polygonized.envelope
             logger.debug("Data polygonized with envelope.")
         else:
-            data_polygonized = data_polygonized.buffer(
-                buffer_distance,
-                buffer_resolution
-            ).simplify(simplify_tolerance, preserve_topology)
             logger.debug("Data polygonized without envelope.")
 
-        # TODO: use GeoSeries.cascaded_union directly? does this always return multipolygon? sometimes just one?
-        # TODO if not self._usable_area.is_valid only then cascaded_union?
-        cascaded_union_multipolygon = shapely.ops.cascaded_union(data_polygonized.geometry)
-        logger.debug("Cascaded union of polygons created.")
+        union = tiled_union(data_polygonized, longitudes, latitudes, tile_size)
+        logger.debug("Union of polygons created.")
 
-        # no .tolist for MultiPolygon unfortunatelly
-        # TODO: this can sometimes create a single polygon (non iterable)
-        df_polygonized = GeoDataFrame(geometry=[pol for pol in cascaded_union_multipolygon])
+        # the union can be a single polygon, a multipolygon, or empty (no records)
+        polygons = [polygon for polygon in getattr(union, 'geoms', [union]) if not polygon.is_empty]
+        df_polygonized = GeoDataFrame(geometry=GeoSeries(polygons), crs=getattr(self.data_full, 'crs', None))
         return df_polygonized
 
-    def overlay(self, species_range_map):
+    def overlay(self, species_range_map, mode='union', keep_rejected=False, pixel_size=None, all_touched=True, range_raster=None):
         """
         Overlays the point records with a species range map. The map can be an instance of IUCNSpecies, or directly
         a GeoSeries datastructure containing `Shapely <http://toblerity.org/shapely/shapely.geometry.html>`_ geometries.
         This overlaying effectively crops the point records to the area within the range map, i.e., drops those
         points that fall outside the union of range polygon(s). If the data is not already in a geopandas format,
         the :func:`geometrize` method is called first.
-        The geometries are first "prepared" (`Prepared Geometries <http://toblerity.org/shapely/manual.html>`_),
-        for faster operations, such as checking if a polygon contains a point.
-        **Careful**, the species data is updated to contain only the filtered-out occurrences. The other records are lost.
+        With ``mode='union'``, the union of all range polygons is computed and "prepared"
+        (`Prepared Geometries <http://toblerity.org/shapely/manual.html>`_), and every point is checked against it.
+        With ``mode='strtree'``, the union is skipped: the individual polygons are stored in a spatial index (STR-tree),
+        which is queried for all points at once (see :func:`iSDM.geometry.points_within`). This is much faster for range maps
+        with many polygons. The result is the same, apart from points lying exactly on a border shared by two polygons.
+        With ``mode='raster'``, no geometries are used at all: the range map is rasterized (only the window covering it, see
+        :func:`rasterize_window`) at :attr:`pixel_size`, and every point is looked up in the pixel containing it. Alternatively,
+        an already rasterized range map can be given as :attr:`range_raster`. The accuracy is bounded by the pixel size:
+        with ``all_touched=True`` (default) every pixel touched by the range is "in range", so no records within the range are
+        lost, but records up to one pixel outside of its border are kept as well. With ``all_touched=False`` only the pixels
+        whose center is within the range count, so records up to half a pixel from the border can end up on either side.
+        **Careful**, the species data is updated to contain only the filtered-out occurrences. The other records are kept
+        only with :attr:`keep_rejected` set.
 
         :param species_range_map: The species range-map geometry to crop point-record occurrences to.
         :type species_range_map: geopandas.GeoSeries or IUCNSpecies
 
-        :returns: None
+        :param string mode: The overlay engine, ``union`` (default), ``strtree`` or ``raster``.
+
+        :param bool keep_rejected: Whether to keep the records outside the range map, in :attr:`rejected_data`. Default is False.
+
+        :param float pixel_size: The pixel size (in degrees) for rasterizing the range map, with ``mode='raster'``.
+
+        :param bool all_touched: Whether to rasterize the range map with all pixels touched by it, with ``mode='raster'``. \
+        Default is True.
+
+        :param tuple range_raster: An already rasterized range map, as a tuple of the raster data (nonzero pixels are "in range") \
+        and its affine transformation, used with ``mode='raster'`` instead of rasterizing the range map.
+
+        :returns: A boolean mask over the records before the overlay, True for the records that were kept. Records without \
+        coordinates (which cannot be overlayed, and are dropped) are False.
+
+        :rtype: np.ndarray
 
         """
         if not (isinstance(species_range_map, GeoSeries) or isinstance(species_range_map, IUCNSpecies)):
             raise AttributeError("Please provide a correct species rangemap input.")
+        if mode not in ('union', 'strtree', 'raster'):
+            raise AttributeError("The overlay mode can only be 'union', 'strtree' or 'raster'.")
+        if mode == 'raster' and range_raster is None and not pixel_size:
+            raise AttributeError("Please provide the pixel_size (or a range_raster) for the raster overlay.")
 
+        # the records which still have coordinates after geometrize(), so that the returned mask lines up with the original records
+        retained = None
         if not isinstance(self.data_full, GeoDataFrame):
             if not isinstance(self.data_full, pd.DataFrame):
                 raise AttributeError("No data to save. Please load it first.")
             else:
-                self.geometrize(dropna=True)
+                if set(['decimallatitude', 'decimallongitude']).issubset(self.data_full.columns):
+                    retained = self.data_full[['decimallatitude', 'decimallongitude']].notnull().all(axis=1).values
+                # the raster lookup only needs the coordinates
+                self.geometrize(dropna=True, lazy=mode == 'raster')
 
+        range_map_geometry = species_range_map if isinstance(species_range_map, GeoSeries) else species_range_map.data_full.geometry
         try:
-            if isinstance(species_range_map, GeoSeries):
-                prepped_range_map_union = prep(species_range_map.unary_union)
-            elif isinstance(species_range_map, IUCNSpecies):
-                prepped_range_map_union = prep(species_range_map.data_full.geometry.unary_union)
-            # self.data_full = self.data_full[self.data_full.geometry.intersects(range_map_union)]
-            self.data_full = self.data_full[self.data_full.geometry.apply(prepped_range_map_union.contains)]
-
-            logger.info("Overlayed species occurrence data with the given range map.")
+            if mode == 'raster':
+                if range_raster is None:
+                    # rasterize_window() sets the raster attributes of the range map, so it is called on a (shallow) copy
+                    range_map = copy.copy(species_range_map)
+                    if isinstance(range_map, GeoSeries):
+                        range_map = IUCNSpecies(name_species="range map")
+                        range_map.set_data(GeoDataFrame(geometry=species_range_map))
+                    range_raster = (range_map.rasterize_window(pixel_size=pixel_size, all_touched=all_touched)[0], range_map.raster_affine)
+                range_data, range_affine = range_raster
+                longitudes, latitudes = self._coordinates()
+                rows, columns, inside = points_to_pixels(longitudes, latitudes, range_affine, range_data.shape, return_inside=True)
+                kept = np.zeros(longitudes.shape[0], dtype=bool)
+                kept[inside] = range_data[rows, columns] != 0
+            elif mode == 'strtree':
+                kept = points_within(self.data_full.geometry, range_map_geometry)
+            else:
+                prepped_range_map_union = prep(range_map_geometry.unary_union)
+                # self.data_full = self.data_full[self.data_full.geometry.intersects(range_map_union)]
+                kept = np.asarray(self.data_full.geometry.apply(prepped_range_map_union.contains), dtype=bool)
+            if keep_rejected:
+                self.rejected_data = self.data_full[~kept]
+            self.data_full = self.data_full[kept]
+
+            logger.info("Overlayed species occurrence data with the given range map (%s of %s records kept)." % (kept.sum(), kept.shape[0]))
+            if retained is not None:
+                mask = np.zeros(retained.shape[0], dtype=bool)
+                mask[retained] = kept
+                return mask
+            return kept
         except ValueError as e:
             logger.error("The rangemap geometries seem to be invalid (possible self-intersections). %s " % str(e))
 
@@ -694,14 +1057,15 @@ class GBIFSpecies(Species):
         if crs is None:
             crs = {'init': "EPSG:4326"}
 
-        if not isinstance(self.data_full, GeoDataFrame):
-            logger.info("Will convert the latitude/longitude into a GeoDataFrame (with geometry column)")
-            self.geometrize()
+        if isinstance(self.data_full, pd.DataFrame) and not isinstance(self.data_full, GeoDataFrame):
+            # point records: the pixels are found directly from the coordinates, no geometries are needed
+            logger.info("Will rasterize the latitude/longitude of the point records directly.")
+            self.geometrize(lazy=True)
 
         # crop to the boundaries of the shape?
         if cropped:
             # cascaded_union_geometry = shapely.ops.cascaded_union(self.data_full.geometry)
-            x_min, y_min, x_max, y_max = self.data_full.geometry.total_bounds
+            x_min, y_min, x_max, y_max = self._total_bounds()
         # else global map
         else:
             x_min, y_min, x_max, y_max = -180, -90, 180, 90
@@ -710,13 +1074,7 @@ class GBIFSpecies(Species):
         y_res = int((y_max - y_min) / pixel_size)
         # translate
         transform = Affine.translation(x_min, y_max) * Affine.scale(pixel_size, -pixel_size)
-        result = features.rasterize(self.data_full.geometry,
-                                    transform=transform,
-                                    out_shape=(y_res, x_res),
-                                    all_touched=all_touched,
-                                    fill=no_data_value,
-                                    default_value=default_value
-                                    )
+        result = self._burn(transform, (y_res, x_res), all_touched, no_data_value, default_value)
 
         if raster_file:
             with rasterio.open(raster_file, 'w', driver='GTiff', width=x_res, height=y_res,
@@ -755,29 +1113,55 @@ class IUCNSpecies(Species):
 
     :ivar raster_reader: file reader for the corresponding rasterized data.
     :vartype raster_reader: rasterio._io.RasterReader
+
+    :ivar raster_window: The (row_offset, column_offset, height, width) of the last window rasterized with \
+    :func:`rasterize_window`, within the global-scale raster.
+    :vartype raster_window: tuple(int, int, int, int)
+
+    :ivar species_index: Per-species (binomial) summary of the data, built with :func:`build_species_index`: \
+    the number of polygons and the bounds (minx, miny, maxx, maxy) of all polygons of every species.
+    :vartype species_index: pandas.DataFrame
+
+    :ivar species_catalog: Per-species (binomial) catalog of the data, built with :func:`build_species_catalog` \
+    (or loaded with :func:`load_species_catalog`): presence-code flags, polygon and vertex counts, bounds, and pixel estimates.
+    :vartype species_catalog: pandas.DataFrame
     """
+    # bump when the columns of the species catalog change, so that older catalog files are rebuilt
+    CATALOG_VERSION = 2
 
     def __init__(self, **kwargs):
         Species.__init__(self, **kwargs)
         self.source = Source.IUCN
         self.observations_type = ObservationsType.PRESENCE_ONLY
 
-    def load_shapefile(self, file_path):
+    def load_shapefile(self, file_path, bbox=None, filters=None, columns=None, cache=False, cache_location=None):
         """
         Loads the data from the provided :attr:`file_path` shapefile into a geopandas.GeoDataFrame.
         A GeoDataFrame is a tablular data structure that contains a column called ``geometry`` which contains a ``geopandas.GeoSeries`` of
         `Shapely <http://toblerity.org/shapely/shapely.geometry.html>`_ geometries. All other meta-data column names are
         converted to a lower-case, for consistency.
+        Loading the ranges of all species may take a while. With :attr:`cache`, the shapefile is converted to a binary
+        cache on first load (see ``iSDM.cache.VectorCache``), which reloads much faster, and is rebuilt whenever the shapefile changes.
 
         :param string file_path: The full path to the shapefile file (including the directory and filename in one string).
 
+        :param tuple bbox: Only load the geometries intersecting this (minx, miny, maxx, maxy) bounding box.
+
+        :param list filters: Only load the records matching these filters, for example ``[('binomial', 'in', names)]`` \
+        for a list of species, or ``[('presence', 'in', [1, 2, 3])]`` for extant areas only. See ``iSDM.cache.VectorCache.read()``.
+
+        :param list columns: Only load these (lower-case) attribute columns. The geometry column is always loaded.
+
+        :param bool cache: Whether to load the data through a binary cache. Default is False.
+
+        :param string cache_location: The folder where the cache is stored. Default is next to the shapefile.
+
         :returns: None
 
         """
         logger.info("Loading data from: %s" % file_path)
-        self.data_full = GeoDataFrame.from_file(file_path)   # shapely.geometry type of objects are used
-        # self.data_full.columns = map(str.lower, self.data_full.columns)   # convert all column headers to lowercase
-        self.data_full.columns = [x.lower() for x in self.data_full.columns]   # python 2, backwards compatible
+        # shapely.geometry type of objects are used, and all column headers are converted to lowercase
+        self.data_full = load_vector(file_path, bbox=bbox, filters=filters, columns=columns, cache=cache, cache_location=cache_location)
 
         logger.info("The shapefile contains data on %d species areas." % self.data_full.shape[0])
         self.shape_file = file_path
@@ -802,7 +1186,10 @@ class IUCNSpecies(Species):
         if not self.name_species:
             raise AttributeError("You have not provided a name for the species.")
 
-        all_data = self.data_full[self.data_full['binomial'] == self.name_species]
+        if self._species_index_is_current():
+            all_data = self.get_species(self.name_species)
+        else:
+            all_data = self.data_full[self.data_full['binomial'] == self.name_species]
 
         if all_data.shape[0] == 0:
             raise ValueError("There is no species with the name '%s' in the shapefile"
@@ -816,6 +1203,230 @@ class IUCNSpecies(Species):
 
         return self.data_full
 
+    def build_species_index(self):
+        """
+        Groups the (previously loaded) data by species (binomial) in one pass, storing the row positions of every species,
+        together with a per-species summary in :attr:`species_index`: the number of polygons, and the bounds of all polygons.
+        Afterwards, the records of a single species can be retrieved with :func:`get_species` or :func:`iter_species`,
+        without scanning the entire data frame again for every species.
+        The index refers to the data as it was when the index was built. It is rebuilt automatically if the data
+        is replaced (for example with :func:`set_data` or :func:`drop_extinct_species`), but not if it is modified in-place.
+
+        :returns: The per-species summary, indexed by binomial.
+
+        :rtype: pandas.DataFrame
+
+        """
+        if not hasattr(self, 'data_full'):
+            raise AttributeError("You have not loaded the data.")
+        if 'binomial' not in self.data_full.columns:
+            raise AttributeError("The data has no 'binomial' column to index the species by.")
+        logger.info("Building an index of the species in the data.")
+        self._species_positions = self.data_full.groupby('binomial').indices
+        bounds = self.data_full.geometry.bounds
+        bounds['binomial'] = self.data_full['binomial'].values
+        grouped = bounds.groupby('binomial')
+        self.species_index = pd.DataFrame({'polygons': grouped.size(),
+                                           'minx': grouped['minx'].min(),
+                                           'miny': grouped['miny'].min(),
+                                           'maxx': grouped['maxx'].max(),
+                                           'maxy': grouped['maxy'].max()},
+                                          columns=['polygons', 'minx', 'miny', 'maxx', 'maxy'])
+        self._species_indexed_data = self.data_full
+        logger.info("Indexed %s species." % self.species_index.shape[0])
+        return self.species_index
+
+    def _species_index_is_current(self):
+        # the index holds row positions, so it is only valid for the very same data frame it was built from
+        return getattr(self, '_species_indexed_data', None) is getattr(self, 'data_full', None) is not None
+
+    def get_species(self, name_species):
+        """
+        Returns the records of a single species (binomial), using the index built by :func:`build_species_index`
+        (which is built first if needed). The data frame is not scanned or copied: if the records of the species are
+        stored contiguously, as is usually the case in IUCN shapefiles, a slice (view) of the data is returned.
+
+        :param string name_species: The binomial name of the species.
+
+        :returns: The records of the species.
+
+        :rtype: geopandas.GeoDataFrame
+
+        """
+        if not self._species_index_is_current():
+            self.build_species_index()
+        if name_species not in self._species_positions:
+            raise ValueError("There is no species with the name '%s' in the shapefile" % name_species)
+        positions = self._species_positions[name_species]
+        if positions[-1] - positions[0] + 1 == positions.shape[0]:
+            return self.data_full.iloc[positions[0]:positions[-1] + 1]
+        return self.data_full.iloc[positions]
+
+    def iter_species(self):
+        """
+        Iterates over all species (binomials) in the data, in alphabetical order, using the index built by
+        :func:`build_species_index` (which is built first if needed).
+
+        :returns: A generator of (binomial, records) tuples, as returned by :func:`get_species`.
+
+        :rtype: generator
+
+        """
+        if not self._species_index_is_current():
+            self.build_species_index()
+        for name_species in self.species_index.index:
+            yield name_species, self.get_species(name_species)
+
+    def build_species_catalog(self, pixel_size=None, presence_column_name='presence'):
+        """
+        Summarizes the (previously loaded) data per species (binomial), in a single vectorized pass over all records, into
+        :attr:`species_catalog`. For every species, the catalog holds:
+
+        - ``polygons`` and ``vertices``: the number of records (polygons) and of their vertices, a measure of the geometric complexity;
+        - ``minx``, ``miny``, ``maxx``, ``maxy``: the bounds of all polygons;
+        - ``all_extinct``: whether all areas have the presence code 5 (extinct), see :func:`drop_extinct_species`;
+        - ``unknown_only``: whether all areas have the (invalid) presence code 0;
+        - with :attr:`pixel_size` only, ``window_pixels``: the number of pixels in the grid-aligned window covering the species \
+          (see :func:`rasterize_window`), and ``range_pixels``: the area of all polygons in pixels, an estimate of the number of \
+          presence pixels. Both are good estimates of the cost of processing the species at that resolution.
+
+        The presence flags are left out if the data has no :attr:`presence_column_name` column.
+        Contrary to :func:`build_species_index`, the catalog does not refer to row positions, so it stays valid for any subset of
+        the data, and can be stored with :func:`save_species_catalog`.
+
+        :param float pixel_size: The size of the pixel in degrees, for the pixel estimates. Default is no pixel estimates.
+
+        :param string presence_column_name: The column name which contains the presence code values. Default is 'presence'.
+
+        :returns: The catalog, indexed by binomial.
+
+        :rtype: pandas.DataFrame
+
+        """
+        if not hasattr(self, 'data_full'):
+            raise AttributeError("You have not loaded the data.")
+        if 'binomial' not in self.data_full.columns:
+            raise AttributeError("The data has no 'binomial' column to catalog the species by.")
+        logger.info("Building a catalog of the species in the data.")
+        geometry = self.data_full.geometry
+        records = geometry.bounds
+        records['binomial'] = self.data_full['binomial'].values
+        records['vertices'] = count_vertices(geometry)
+        records['area'] = geometry.area.values
+        columns = ['polygons', 'vertices', 'minx', 'miny', 'maxx', 'maxy']
+        aggregations = {'vertices': 'sum', 'area': 'sum', 'minx': 'min', 'miny': 'min', 'maxx': 'max', 'maxy': 'max'}
+        if presence_column_name in self.data_full.columns:
+            presence = self.data_full[presence_column_name].values
+            records['all_extinct'] = presence == 5
+            records['unknown_only'] = presence == 0
+            aggregations.update({'all_extinct': 'all', 'unknown_only': 'all'})
+            columns += ['all_extinct', 'unknown_only']
+        grouped = records.groupby('binomial')
+        catalog = grouped.agg(aggregations)
+        catalog['polygons'] = grouped.size()
+        if pixel_size:
+            catalog['window_pixels'] = self._window_pixels(catalog, pixel_size)
+            catalog['range_pixels'] = catalog['area'] / (pixel_size * pixel_size)
+            columns += ['window_pixels', 'range_pixels']
+        self.species_catalog = catalog[columns]
+        self._species_catalog_pixel_size = pixel_size
+        logger.info("Cataloged %s species." % self.species_catalog.shape[0])
+        return self.species_catalog
+
+    @classmethod
+    def _window_pixels(cls, bounds, pixel_size):
+        # the same windows as Species.global_window, for all species at once
+        # species without any (non-empty) geometry have no bounds, and get an empty window
+        valid = np.isfinite(bounds[['minx', 'miny', 'maxx', 'maxy']].values).all(axis=1)
+        minx, miny, maxx, maxy = [np.where(valid, bounds[column].values, 0) for column in ['minx', 'miny', 'maxx', 'maxy']]
+        row_start, col_start, row_stop, col_stop = cls._global_windows(minx, miny, maxx, maxy, pixel_size)
+        return np.where(valid, (row_stop - row_start) * (col_stop - col_start), 0).astype(np.int64)
+
+    def species_catalog_file(self, cache_location=None):
+        """
+        Returns the default location of the species catalog file: next to the shapefile the data was loaded from (or in
+        :attr:`cache_location`), with the same base name as its binary cache (see ``iSDM.cache.VectorCache``).
+
+        :param string cache_location: The folder where the catalog is stored. Default is next to the shapefile.
+
+        :rtype: string
+
+        """
+        if not getattr(self, 'shape_file', None):
+            raise AttributeError("The data was not loaded from a shapefile. Please provide the location of the catalog file.")
+        return VectorCache(self.shape_file, cache_location=cache_location).cache_prefix + ".catalog.pkl"
+
+    def save_species_catalog(self, file_path=None, cache_location=None):
+        """
+        Stores the species catalog (see :func:`build_species_catalog`) in a (pickle) file, together with the signature of the
+        shapefile it was built from, so that :func:`load_species_catalog` can tell whether it is still valid.
+
+        :param string file_path: The full path to the catalog file. Default is :func:`species_catalog_file`.
+
+        :param string cache_location: The folder where the catalog is stored, if no :attr:`file_path` is given. Default is next to the shapefile.
+
+        :returns: None
+
+        """
+        if not hasattr(self, 'species_catalog'):
+            raise AttributeError("You have not built the species catalog.")
+        file_path = file_path or self.species_catalog_file(cache_location)
+        signature = VectorCache(self.shape_file).source_signature() if getattr(self, 'shape_file', None) else None
+        pd.to_pickle({'version': self.CATALOG_VERSION,
+                      'signature': signature,
+                      'pixel_size': self._species_catalog_pixel_size,
+                      'records': int(self.species_catalog['polygons'].sum()),
+                      'catalog': self.species_catalog}, file_path)
+        logger.info("Saved the catalog of %s species to %s " % (self.species_catalog.shape[0], file_path))
+
+    def load_species_catalog(self, pixel_size=None, file_path=None, cache_location=None, rebuild=True):
+        """
+        Loads the species catalog stored with :func:`save_species_catalog` into :attr:`species_catalog`. A stored catalog is only
+        used if it was built from the current shapefile, from the same number of records as the currently loaded data, and at the
+        requested :attr:`pixel_size`. Otherwise, with :attr:`rebuild`, it is built from the loaded data (see :func:`build_species_catalog`)
+        and stored again, so the next run does not need to go through all the geometries.
+
+        :param float pixel_size: The size of the pixel in degrees, for the pixel estimates. Default is no pixel estimates.
+
+        :param string file_path: The full path to the catalog file. Default is :func:`species_catalog_file`.
+
+        :param string cache_location: The folder where the catalog is stored, if no :attr:`file_path` is given. Default is next to the shapefile.
+
+        :param bool rebuild: Whether to (re)build and store the catalog if there is no valid stored catalog. Default is True.
+
+        :returns: The catalog, indexed by binomial, or None if there is no valid stored catalog and :attr:`rebuild` is False.
+
+        :rtype: pandas.DataFrame
+
+        """
+        file_path = file_path or self.species_catalog_file(cache_location)
+        stored = None
+        if os.path.exists(file_path):
+            try:
+                stored = pd.read_pickle(file_path)
+            except Exception as e:
+                logger.error("Could not read the species catalog %s: %s " % (file_path, str(e)))
+        if stored is not None and self._species_catalog_is_valid(stored, pixel_size):
+            self.species_catalog = stored['catalog']
+            self._species_catalog_pixel_size = stored['pixel_size']
+            logger.info("Loaded the catalog of %s species from %s " % (self.species_catalog.shape[0], file_path))
+            return self.species_catalog
+        if not rebuild:
+            return None
+        self.build_species_catalog(pixel_size=pixel_size)
+        try:
+            self.save_species_catalog(file_path=file_path)
+        except (IOError, OSError) as e:
+            logger.error("Could not store the species catalog in %s: %s " % (file_path, str(e)))
+        return self.species_catalog
+
+    def _species_catalog_is_valid(self, stored, pixel_size):
+        if not isinstance(stored, dict) or stored.get('version') != self.CATALOG_VERSION or stored.get('pixel_size') != pixel_size:
+            return False
+        if getattr(self, 'shape_file', None) and stored.get('signature') != VectorCache(self.shape_file).source_signature():
+            return False
+        return not hasattr(self, 'data_full') or stored.get('records') == self.data_full.shape[0]
+
     def save_shapefile(self, full_name=None, driver='ESRI Shapefile', overwrite=False):
         """
         Saves the current geopandas.GeoDataFrame data in a shapefile. The data is expected to have a ``geometry``
@@ -993,61 +1604,80 @@ class IUCNSpecies(Species):
                                      simplify_tolerance=1,
                                      preserve_topology=True,
                                      fast=False,
-                                     count=100):
+                                     count=100,
+                                     random_state=None,
+                                     max_batch_size=1000000):
         """
         Draw random pseudo-absence points from within a buffer around the geometry. First it simplifies the geometry
         with a buffer around the original geometry. Then calculates the difference between this one, and the original
-        geometry, to determine a geometry from which to sample random points. Finally, generates random points one by
-        one and tests if they fall in that difference-geometry, until a :attr:`count` number of points are generated.
-        If the "buffered" geometry is invalid (which could happen), it gradually tries to simplify it by applying a
-        bigger value for the :attr:`simplify_tolerance` parameter, until the geometry becomes valid. The reason is that an
-        operation like difference/intersection is problematic to apply on an invalid geometry.
-        The value is increased by maximum of 100.
+        geometry, to determine a geometry from which to sample random points. Finally, draws random points in batches
+        from the bounding box of that difference-geometry, keeping those which fall in it, until a :attr:`count` number
+        of points are generated. The size of every batch follows from the ratio between the area of the difference-geometry
+        and its bounding box, so that usually one or two batches are enough. The points of a batch are tested all at once,
+        on their coordinates (see :func:`iSDM.geometry.points_in_geometry`).
+        If the "buffered" geometry (or the difference) is invalid, which could happen, it is repaired with ``make_valid``
+        (see :func:`iSDM.geometry.make_valid`), as an operation like difference/intersection is problematic to apply on
+        an invalid geometry.
 
-        A more efficient approach would be to just generate a :attr:`count` number of points from the first step, i.e.,
-        from the buffer. Some points will fall within the original shape, and they can be discarded,
-        so the number of pseudo-absence points will not actually be equal to :attr:`count`.
-        If precision is not an issue, we could provide a :attr:`count` number that is larger but calculated according
-        to the ``original_area/buffered_convex_hull`` ratio.
+        :param float buffer_distance: The width of the buffer around the geometry, in degrees. Default is 2.
 
-        **Update:** Maybe not even necessary, given that shapely's ``prep(..)`` operation speeds up a factor of 100 to 1000!
+        :param int buffer_resolution: The number of segments used to approximate a quarter circle in the buffer. Default is 16.
 
-        """
-        # First simplify (necessary) and apply a buffer around the geometry
-        simplified_buffer = (self.data_full.geometry.buffer(0)
-                             .simplify(simplify_tolerance, preserve_topology)
-                             .buffer(buffer_distance, buffer_resolution))
+        :param float simplify_tolerance: The tolerance for simplifying the geometry before buffering it. Default is 1.
+
+        :param bool preserve_topology: Whether to preserve the topology when simplifying. Default is True.
+
+        :param bool fast: Unused, kept for backwards compatibility.
+
+        :param int count: The number of points to draw. Default is 100.
 
-        # try to "fix" an invalid geometry by gradually simplifying
-        simplify_tolerance_inc = simplify_tolerance
+        :param random_state: The source of randomness: a seeded ``numpy.random.Generator``, or a seed for a new one, \
+        for reproducible draws. Default is a freshly (randomly) seeded generator.
 
-        # assume that there is one geometry record in the dataframe (single species)
-        while not simplified_buffer.iat[0].is_valid and simplify_tolerance_inc < 100:
-            logger.info("Buffered geometry is invalid, trying to simplify it using tolerance = %s" % simplify_tolerance_inc)
-            simplified_buffer = simplified_buffer.simplify(simplify_tolerance_inc, preserve_topology)
-            simplify_tolerance_inc += 1
+        :param int max_batch_size: The largest number of candidate points drawn in one batch, to bound the memory use. Default is 1000000.
+
+        :returns: The random points.
+
+        :rtype: geopandas.GeoSeries
+
+        """
+        if not hasattr(self, 'data_full'):
+            raise AttributeError("You have not loaded the data.")
+        random_state = np.random.default_rng(random_state)
+
+        # the union of all (repaired) rangemap polygons; usually there is one record in the dataframe (single species)
+        original_geometry = make_valid(self.data_full.geometry.buffer(0).unary_union)
+        # First simplify (necessary) and apply a buffer around the geometry
+        simplified_buffer = make_valid(original_geometry.simplify(simplify_tolerance, preserve_topology)
+                                       .buffer(buffer_distance, buffer_resolution))
 
         # Get the difference between the original geometry and the one above, to determine a geometry
         # from which to draw random points.
         logger.info("Buffered geometry valid. Now creating a buffer difference from which to draw random points")
-        buffer_difference = simplified_buffer.geometry.difference(self.data_full.geometry.buffer(0))
-        xmin, ymin, xmax, ymax = buffer_difference.total_bounds
-        random_count = 0
-        pts = []
+        buffer_difference = make_valid(simplified_buffer.difference(original_geometry))
+        if buffer_difference.is_empty or buffer_difference.area == 0:
+            logger.warning("The buffer difference is empty, no pseudo-absence points can be drawn.")
+            self.pseudo_absence_points = GeoSeries([])
+            return self.pseudo_absence_points
+        xmin, ymin, xmax, ymax = buffer_difference.bounds
+        # the fraction of random points in the bounding box that is expected to fall in the buffer difference
+        hit_ratio = min(buffer_difference.area / ((xmax - xmin) * (ymax - ymin)), 1.0)
 
-        # draw pounts until you reach a <count> number of points
         logger.info("Creating random points ... ")
-        prepped_buffer_difference = prep(buffer_difference.iat[0])  # immense speedup with prepared geometries!
-
-        while random_count < count:
-            random_point = Point(xmin + (xmax - xmin) * np.random.random(), ymin + (ymax - ymin) * np.random.random())
-            if prepped_buffer_difference.contains(random_point):
-                pts.append(random_point)
-                random_count += 1
-            else:
-                pass
-
-        geo_pts = GeoSeries(pts)
+        xs, ys = [], []
+        remaining = count
+        while remaining > 0:
+            # slightly more candidates than expected to be needed, so that one batch is usually enough
+            batch_size = int(min(max(np.ceil(1.2 * remaining / hit_ratio), remaining + 16), max_batch_size))
+            x = random_state.uniform(xmin, xmax, batch_size)
+            y = random_state.uniform(ymin, ymax, batch_size)
+            inside = np.flatnonzero(points_in_geometry(x, y, buffer_difference))[:remaining]
+            xs.append(x[inside])
+            ys.append(y[inside])
+            remaining -= inside.shape[0]
+        logger.info("Created %s random points." % count)
+
+        geo_pts = GeoSeries(points_from_xy(np.concatenate(xs), np.concatenate(ys)))
         self.pseudo_absence_points = geo_pts
         return self.pseudo_absence_points
 
@@ -1073,6 +1703,8 @@ class IUCNSpecies(Species):
 
         Species can have both areas (polygons) in which they are extinct (5) AND areas in which they are not.
         Such species are kept, and only species for which all areas are extinct, are filtered-out.
+        The species are looked up in the species catalog (see :func:`build_species_catalog`), which is built first if needed.
+        A catalog loaded with :func:`load_species_catalog` is used as-is, so the records need not be grouped again.
 
         :param string presence_column_name: The column name which contains the presence code values. Default is 'presence'.
 
@@ -1083,34 +1715,20 @@ class IUCNSpecies(Species):
         :returns: None
 
         """
-        logger.info("There are currently %s unique species. \n" % self.data_full.binomial.unique().size)
-
-        # the following creates a pandas series in the form:
-        # Aaptosyax grypus                                     [2.0]
-        # Abbottina binhi                                      [2.0]
-        # Aborichthys elongatus                 [1.0, 1.0, 1.0, 1.0]
-        # Aborichthys garoensis                      [1.0, 1.0, 1.0]
-        # Aborichthys kempi           [1.0, 1.0, 1.0, 1.0, 1.0, 1.0]
-        # Aborichthys tikaderi                                 [1.0]
-        # Abramis brama                                   [1.0, 1.0]
-        # Acantharchus pomotis                       [5.0, 1.0, 1.0]
-        # Acanthobrama centisquama                        [1.0, 1.0]
-        # Acanthobrama lissneri                           [1.0, 1.0]
-        # ...
-        # which means species are grouped by binomial, and the presence columns are aggregated in a list
-        grouped = self.data_full.groupby('binomial')[presence_column_name].apply(lambda x: x.tolist())
-
-        extinct = []
-        for row in grouped.iteritems():
-            if row[1] == [5.0]:  # all areas are extinct
-                extinct.append(row[0])
-            if discard_bad:
-                if row[0] == [0.0]:  # all areas are with invalid value of 0
-                    extinct.append(row[0])
+        catalog = getattr(self, 'species_catalog', None)
+        if catalog is None or 'all_extinct' not in catalog.columns or presence_column_name != 'presence':
+            catalog = self.build_species_catalog(presence_column_name=presence_column_name)
+        if 'all_extinct' not in catalog.columns:
+            raise AttributeError("The data has no '%s' column with presence codes." % presence_column_name)
+        # a loaded catalog may describe more species than there are in the (subset of the) data
+        logger.info("There are currently %s unique species. \n" % self.data_full.binomial.nunique())
+
+        dropped = catalog['all_extinct'] | (catalog['unknown_only'] if discard_bad else False)
+        extinct = catalog.index[dropped.values & catalog.index.isin(self.data_full.binomial.unique())].tolist()
 
         logger.info("Filtering out the following extinct species: %s \n" % extinct)
         self.data_full = self.data_full[~self.data_full.binomial.isin(extinct)]
-        logger.info("There are now %s unique species after dropping out extinct ones." % self.data_full.binomial.unique().size)
+        logger.info("There are now %s unique species after dropping out extinct ones." % self.data_full.binomial.nunique())
 
 
 class MOLSpecies(Species):
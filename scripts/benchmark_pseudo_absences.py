@@ -0,0 +1,170 @@
+"""
+script: benchmark_pseudo_absences.py
+Description: Benchmarks the pseudo-absence sampling of RasterEnvironmentalLayer against the original (reference) implementation,
+             which made one full pass over the global raster per region overlapping with the species presences, and filled
+             the sampled pixels one by one. A synthetic global "ecoregions" raster is generated at every requested resolution,
+             together with a species range spanning a number of regions, a suitable-habitat raster and a bias grid.
+             For a fixed random seed, the sampled pixels of both implementations must be identical; the script exits with
+             an error code otherwise.
+
+Input:
+ - Pixel sizes (resolutions) to benchmark. Default is 0.5 degrees and 30 arcsec.
+ - Number of regions in the synthetic raster, number of pseudo-absences to sample, random seed.
+ - Optionally, skip the (memory-hungry) reference implementation at the finest resolution.
+
+"""
+import argparse
+import gc
+import logging
+import sys
+import timeit
+import numpy as np
+from iSDM.environment import RasterEnvironmentalLayer
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-p', '--pixel-sizes', default="0.5,0.0083333333", help="Comma-separated list of pixel sizes (in degrees) to benchmark.")
+parser.add_argument('-r', '--regions', type=int, default=400, help="Number of distinct regions (pixel values) in the synthetic raster.")
+parser.add_argument('-n', '--number-of-pseudopoints', type=int, default=1000, help="Number of pseudo-absences to sample.")
+parser.add_argument('-s', '--seed', type=int, default=42, help="Random seed used for both implementations.")
+parser.add_argument('--reference-max-pixels', type=float, default=1e9, help="Skip the reference implementation above this many raster pixels.")
+args = parser.parse_args()
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+handler = logging.StreamHandler()
+handler.setFormatter(logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s"))
+logger.addHandler(handler)
+# the sampling itself logs a lot at INFO level
+logging.getLogger('iSDM.environment').setLevel(logging.WARNING)
+
+
+def reference_sample_pseudo_absences(env_raster_data, species_raster_data, suitable_habitat=None, bias_grid=None, nodata=None, number_of_pseudopoints=1000):
+    # The original sample_pseudo_absences() algorithm, kept as-is (apart from not modifying the input) for comparison.
+    env_raster_data = env_raster_data.copy()
+    if nodata is not None:
+        env_raster_data[env_raster_data == nodata] = 0
+    presences_pixels = env_raster_data * species_raster_data
+    unique_regions = np.unique(presences_pixels[presences_pixels != 0])
+    if len(unique_regions) == 0:
+        return (np.zeros_like(presences_pixels), np.zeros_like(presences_pixels))
+    regions = []
+    for region in unique_regions:
+        regions.append(np.where(env_raster_data == region))
+    selected_pixels = np.zeros_like(env_raster_data)
+    for layer in regions:
+        selected_pixels[layer] = env_raster_data[layer]
+    del regions
+    gc.collect()
+    pixels_to_sample_from = selected_pixels - presences_pixels
+    del presences_pixels
+    sampled_pixels = np.zeros_like(selected_pixels)
+    del selected_pixels
+    gc.collect()
+    if suitable_habitat is not None:
+        pixels_to_sample_from = pixels_to_sample_from * suitable_habitat
+    if bias_grid is not None:
+        (x, y) = np.where(pixels_to_sample_from * bias_grid > 0)
+        number_pixels_to_sample_from_bias_grid = x.shape[0]
+        if number_pixels_to_sample_from_bias_grid < number_of_pseudopoints:
+            random_indices = np.arange(0, number_pixels_to_sample_from_bias_grid)
+            for position in random_indices:
+                sampled_pixels[x[position]][y[position]] = pixels_to_sample_from[x[position], y[position]]
+            pixels_to_sample_from = pixels_to_sample_from - sampled_pixels
+            number_of_pseudopoints = number_of_pseudopoints - number_pixels_to_sample_from_bias_grid
+        elif number_pixels_to_sample_from_bias_grid > number_of_pseudopoints:
+            pixels_to_sample_from_bias_grid = np.where(pixels_to_sample_from * bias_grid > 0, bias_grid, 0)
+            flat_indices = np.argpartition(pixels_to_sample_from_bias_grid.ravel(), -number_of_pseudopoints - 1)[-number_of_pseudopoints:]
+            row_indices, col_indices = np.unravel_index(flat_indices, pixels_to_sample_from_bias_grid.shape)
+            sampled_pixels[row_indices, col_indices] = pixels_to_sample_from[row_indices, col_indices]
+            return (pixels_to_sample_from, sampled_pixels)
+    (x, y) = np.where(pixels_to_sample_from > 0)
+    number_pixels_to_sample_from = x.shape[0]
+    if number_pixels_to_sample_from == 0:
+        return (pixels_to_sample_from, sampled_pixels)
+    if number_pixels_to_sample_from < number_of_pseudopoints:
+        random_indices = np.arange(0, number_pixels_to_sample_from)
+    else:
+        random_indices = np.random.choice(number_pixels_to_sample_from, number_of_pseudopoints, replace=False)
+    for position in random_indices:
+        sampled_pixels[x[position]][y[position]] = pixels_to_sample_from[x[position], y[position]]
+    return (pixels_to_sample_from, sampled_pixels)
+
+
+def synthetic_data(pixel_size, number_of_regions, seed):
+    # A global raster of roughly square regions, with the oceans (value 0) covering about a third of the globe,
+    # a species range near the middle of the raster, a suitable habitat covering ~70% and a sparse bias grid.
+    height, width = int(180 / pixel_size), int(360 / pixel_size)
+    random_state = np.random.RandomState(seed)
+    blocks = int(np.ceil(np.sqrt(number_of_regions)))
+    coarse = random_state.permutation(blocks * blocks).astype(np.uint16).reshape(blocks, blocks) % number_of_regions + 1
+    coarse[random_state.rand(blocks, blocks) < 0.33] = 0
+    rows = np.minimum(np.arange(height) * blocks // height, blocks - 1)
+    cols = np.minimum(np.arange(width) * blocks // width, blocks - 1)
+    env_raster_data = coarse[rows[:, np.newaxis], cols[np.newaxis, :]]
+    # The range starts a quarter into the land block closest to the center, and ends halfway the next block, so that it
+    # only covers parts of the blocks (regions) it touches: the rest of these regions is left to sample from.
+    land_blocks = np.argwhere(coarse > 0)
+    block_row, block_col = land_blocks[np.argmin(((land_blocks - blocks / 2.0) ** 2).sum(axis=1))]
+    species_raster_data = np.zeros((height, width), dtype=np.uint8)
+    species_raster_data[int((block_row + 0.25) * height / blocks):int(min(block_row + 1.5, blocks) * height / blocks),
+                        int((block_col + 0.25) * width / blocks):int(min(block_col + 1.5, blocks) * width / blocks)] = 1
+    suitable_habitat = (random_state.randint(0, 10, size=(height, width), dtype=np.uint8) < 7).astype(np.uint8)
+    # unique bias values, so that selecting the "top" pixels has no ties
+    bias_grid = np.zeros(height * width, dtype=np.int32)
+    biased = random_state.choice(height * width, max(1, height * width // 500), replace=False)
+    bias_grid[biased] = random_state.permutation(biased.shape[0]) + 1
+    return env_raster_data, species_raster_data, suitable_habitat, bias_grid.reshape(height, width)
+
+
+def timed(function, seed, **kwargs):
+    np.random.seed(seed)
+    start_time = timeit.default_timer()
+    result = function(**kwargs)
+    return result, timeit.default_timer() - start_time
+
+
+failed = False
+for pixel_size in [float(value) for value in args.pixel_sizes.split(",")]:
+    logger.info("Generating synthetic data at pixel size %s " % pixel_size)
+    env_raster_data, species_raster_data, suitable_habitat, bias_grid = synthetic_data(pixel_size, args.regions, args.seed)
+    logger.info("Raster shape: %s " % (env_raster_data.shape, ))
+    layer = RasterEnvironmentalLayer(name_layer="synthetic_regions")
+    layer.env_raster_data = env_raster_data
+    scenarios = [("regions only", {}),
+                 ("suitable habitat", {'suitable_habitat': suitable_habitat}),
+                 ("habitat and bias grid", {'suitable_habitat': suitable_habitat, 'bias_grid': bias_grid})]
+    for name_scenario, scenario in scenarios:
+        (_, sampled_pixels), dense_time = timed(layer.sample_pseudo_absences, args.seed,
+                                                species_raster_data=species_raster_data,
+                                                number_of_pseudopoints=args.number_of_pseudopoints, **scenario)
+        (_, sampled_cells), sparse_time = timed(layer.sample_pseudo_absences_sparse, args.seed,
+                                                presence_cells=np.flatnonzero(species_raster_data),
+                                                number_of_pseudopoints=args.number_of_pseudopoints, **scenario)
+        identical = np.array_equal(np.flatnonzero(sampled_pixels), sampled_cells)
+        if sampled_cells.shape[0] == 0:
+            # an empty sample would only benchmark (and compare) the trivial path
+            logger.error("pixel size %s, %s: no pseudo-absences were sampled." % (pixel_size, name_scenario))
+            failed = True
+        if env_raster_data.size <= args.reference_max_pixels:
+            (_, reference_pixels), reference_time = timed(reference_sample_pseudo_absences, args.seed,
+                                                          env_raster_data=env_raster_data,
+                                                          species_raster_data=species_raster_data,
+                                                          number_of_pseudopoints=args.number_of_pseudopoints, **scenario)
+            identical = identical and np.array_equal(reference_pixels, sampled_pixels)
+            del reference_pixels
+            logger.info("pixel size %s, %s: reference %.3fs, dense %.3fs (%.1fx), sparse %.3fs (%.1fx), identical samples: %s"
+                        % (pixel_size, name_scenario, reference_time, dense_time, reference_time / dense_time,
+                           sparse_time, reference_time / sparse_time, identical))
+        else:
+            logger.info("pixel size %s, %s: dense %.3fs, sparse %.3fs (reference skipped), identical samples: %s"
+                        % (pixel_size, name_scenario, dense_time, sparse_time, identical))
+        failed = failed or not identical
+        del sampled_pixels, sampled_cells
+        gc.collect()
+    del layer, env_raster_data, species_raster_data, suitable_habitat, bias_grid
+    gc.collect()
+
+if failed:
+    logger.error("The sampled pseudo-absences are empty, or differ from the reference implementation.")
+    sys.exit(1)
+logger.info("All sampled pseudo-absences are identical to the reference implementation.")
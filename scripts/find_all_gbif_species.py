@@ -4,22 +4,24 @@ Description: Scrap all GBIF backend occurrence records, for a (filtered) list of
              and store the data locally in separate files, per species.
 Input:
  - list of species (binomials, loaded from a file)
- - method of serialization (msgpack or pickle)
+ - method of serialization (pickle, msgpack, parquet or feather)
  - folder where to save the data in separate files
 
 This script does the following:
  1. Loads a list of non-extinct binomials (non_extinct_binomials.pkl).
     This list contains all the non-extinct species already selected from the IUCN expert range data,
     by filtering out species which have only extinct regions and nothing more.
- 2. Loops through the list, and queries (using the GBIF API) the GBIF backend for occurrences for each individual binomial.
+ 2. Queries (using the GBIF API) the GBIF backend for occurrences for each individual binomial, with a number of species
+    harvested in parallel (see iSDM.gbif.OccurrenceHarvester).
  3. Saves (serializes) the result of the query, as occurrences records, in a separate file for each binomial (species).
     Each individual file contains GBIF occurrence records for a particular species. All files are stored in the same folder.
     By default the name of the file corresponds to the name of the species.
+    The outcome per species (done, empty, failed) is kept in a manifest.json file in the same folder. When the script is
+    interrupted, or some species failed, running it again only fetches the species which are not done (or empty) yet.
 """
 
-from iSDM.species import GBIFSpecies
+from iSDM.gbif import OccurrenceHarvester
 import logging
-import timeit
 import pickle
 import os
 import errno
@@ -27,16 +29,16 @@ import errno
 import argparse
 
 parser = argparse.ArgumentParser()
-parser.add_argument('-m', '--method-serialization', default="pickle", help='Method of serialization used for the individual GBIF occurrence files. Can be pickle or msgpack.')
+parser.add_argument('-m', '--method-serialization', default="pickle", help='Method of serialization used for the individual GBIF occurrence files. Can be pickle, msgpack, parquet or feather.')
 # parser.add_argument('-s', '--species-location', default='./data/fish/', help="The folder where the species individual GBIF files are located.")
 parser.add_argument('-b', '--binomials-location', default=os.path.join(os.getcwd(), "data", "fish", "non_extinct_binomials.pkl"), help="Full location of the file containing the non-extinct binomials list.")
 parser.add_argument('-o', '--output-location', default=os.path.join(os.getcwd(), "data", "fish"), help="Output location (folder) for storing the serialized individual species GBIF data.")
+parser.add_argument('-n', '--species-workers', default=4, type=int, help="Number of species harvested in parallel. Default is 4.")
+parser.add_argument('-w', '--fetch-workers', default=4, type=int, help="Number of concurrent GBIF API requests per species. Default is 4.")
 args = parser.parse_args()
 
 # input
 method = args.method_serialization  # could also be set to "pickle", which was default but msgpack is slightly better in speed/memory.
-# non_extinct_binomials_file_path = "./data/fish/selection/non_extinct_binomials.pkl"
-# save_data_path = os.path.join(os.getcwd(), "data", "fish")
 
 # logging
 try:
@@ -45,9 +47,9 @@ except OSError as e:
     if e.errno != errno.EEXIST:
         raise
 
-logger = logging.getLogger('iSDM.species')
+logger = logging.getLogger('iSDM')
 logger.setLevel(logging.DEBUG)
-fh = logging.FileHandler(os.path.join(args.output_location, "to_' + method + '.log"))
+fh = logging.FileHandler(os.path.join(args.output_location, "to_" + method + ".log"))
 fh.setLevel(logging.DEBUG)
 ch = logging.StreamHandler()
 ch.setLevel(logging.DEBUG)
@@ -59,32 +61,19 @@ logger.addHandler(ch)
 
 # Load the list of non-extinct binomials that is previously filtered from the IUCN expert range data.
 non_extinct_binomials = pickle.load(open(args.binomials_location, "rb"))
-
-total_time = 0
-# save_data_path = os.path.join(save_data_path, method)
-
-os.makedirs(os.path.join(args.output_location, args.method_serialization), exist_ok=True)
-
 logger.info("size = %s species." % len(non_extinct_binomials))
-# Loop through the list of non-extinct binomials
-for idx, name in enumerate(non_extinct_binomials):
-    next_species = GBIFSpecies(name_species=name)
-    logger.info("Attempting to query for species: %s " % name)
-    logger.info("Species #: %s " % idx)
+
+species_names = []
+for name in non_extinct_binomials:
     if "\'" in name:
         logger.info("Skipping problematic name: %s " % name)
         continue
-    # Query the GBIF backend, and if empty just skip
-    if next_species.find_species_occurrences().empty:
-        logger.info("No data to save on %s " % name)
-    # If there are occcurrence records in GBIF...
-    else:
-        logger.info("Done with GBIF API query, now saving.")
-        start_time = timeit.default_timer()
-        # 3. Save the data
-        next_species.save_data(dir_name=os.path.join(args.output_location, args.method_serialization), method=method)
-        stop_time = timeit.default_timer()
-        logger.info("Serializing with %s took %s seconds." % (method, stop_time - start_time))
-        total_time += stop_time - start_time
+    species_names.append(name)
 
-logger.info("Total serializing time %s seconds for %s. " % (total_time, method))
+harvester = OccurrenceHarvester(os.path.join(args.output_location, args.method_serialization),
+                                method=method,
+                                max_workers=args.species_workers,
+                                fetch_workers=args.fetch_workers)
+outcomes = harvester.harvest(species_names)
+if outcomes['failed'] > 0:
+    logger.warning("%s species failed, run the script again to retry them." % outcomes['failed'])
@@ -5,37 +5,35 @@ Description: Merge all individual files containing occurrence records per specie
              contain the relevant columns, i.e., those deemed important for further analysis. The rest of the metadata is ignored.
              For example, the latitude and longitude (if available) for each occurrence record are relevant.
 Input:
- - method of deserialization (msgpack or pickle, same as the one used for serializing the individual files)
- - folder where the separate files are stored
+ - folder where the separate files are stored (pickle, msgpack, parquet or feather, deduced from the file extension)
  - a list of important columns (loaded from a file)
- - output location (folder) for storing the merged species dataframe file.
+ - output location (folder) for storing the merged species dataset.
 
 This script does the following:
  1. Loops through all files in the folder where occurrences for each individual species are stored, and deserializes (reads)
-    the data in a temporary dataframe.
- 2. Appends the deserialized data in one large file, selecting only the important columns (if available).
+    only the important columns (if available) of one species (all of its files) at a time.
+ 2. Normalizes the data types of the columns, drops duplicate records (same gbifid) within a species, also across the
+    files of a species stored in more than one format, and appends the records of each species as a separate partition
+    (row group) of one merged Parquet dataset (merged.parquet).
+    A small index (merged_index.json) keeps track of the partition of each species, so the records of a single species
+    can be read without scanning the whole merged dataset (see iSDM.gbif.MergedOccurrences).
 """
 
 import logging
 import pickle
 import os
 import errno
-import pandas as pd
 import timeit
 import argparse
+from iSDM.gbif import MergedOccurrences
+from iSDM.species import Species
 
 parser = argparse.ArgumentParser()
-parser.add_argument('-m', '--method-serialization', default="pickle", help='Method of serialization used for the individual GBIF occurrence files. Can be pickle or msgpack.')
 parser.add_argument('-s', '--species-location', default=os.path.join(os.getcwd(), "data", "fish"), help="The folder where the species individual GBIF files are located.")
 parser.add_argument('-i', '--important-columns', default=os.path.join(os.getcwd(), "data", "fish", "important_columns.pkl"), help="Full location of the file containing the important columns list.")
-parser.add_argument('-o', '--output-location', default=os.path.join(os.getcwd(), "data", "fish"), help="Output location (folder) for storing the merged species dataframe file.")
+parser.add_argument('-o', '--output-location', default=os.path.join(os.getcwd(), "data", "fish"), help="Output location (folder) for storing the merged species dataset.")
 args = parser.parse_args()
 
-# input
-method = args.method_serialization  # this method should be the same as the one used to serialize the GBIF occurrence data in files.
-# saved_data_path = './data/fish/selection/'
-# important_columns_file_path = "./data/fish/selection/important_columns.pkl"
-
 # logging
 try:
     os.makedirs(args.output_location)
@@ -49,47 +47,32 @@ formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(messag
 handler.setFormatter(formatter)
 logger.addHandler(handler)
 logger.setLevel(logging.DEBUG)
-fh = logging.FileHandler(os.path.join(args.output_location, "read_' + method + '.log"))
+fh = logging.FileHandler(os.path.join(args.output_location, "merge.log"))
 fh.setLevel(logging.DEBUG)
 fh.setFormatter(formatter)
 logger.addHandler(fh)
 
 
 important_columns = pickle.load(open(args.important_columns, "rb"))
-no_occurrences = []
-# saved_data_path = os.path.join(args.output_location, args.method_serialization)
-total_time = 0
 
-# Loop through each file in the folder
-for idx, my_file in enumerate(os.listdir(args.species_location)):
-    logger.info("Opening %s " % my_file)
-    logger.info("Species #: %s " % idx)
-    start_time = timeit.default_timer()
-    # Open and read data into pandas dataframe
-    if method == "msgpack":
-        df = pd.read_msgpack(os.path.join(args.species_location, my_file))
-    elif method == "pickle":
-        df = pd.read_pickle(os.path.join(args.species_location, my_file))
-    stop_time = timeit.default_timer()
-    logger.info("Reading with %s took %s seconds." % (method, stop_time - start_time))
-    total_time += stop_time - start_time
-    # If the dataframe is not empty
-    if not df.empty:
-        # Make an intersection from the list of important columns and those present in the dataframe
-        common_columns = list(important_columns.intersection(set(df.columns.tolist())))
-        # Append the data from those columns of the intersection, into one big "merged" file.
-        # (beter save the merged file one directory "up" to avoid merging with itself)
-        # (memory usage doesn't grow constantly, individual frames are dumped on disk and memory discarded in each loop)
-        df[common_columns].to_msgpack(os.path.join(args.output_location, "merged.msg"), append=True)
-        logger.info("Columns: %s" % len(common_columns))
-        logger.info(df.info(memory_usage='deep'))
-    elif df.empty:
-        # also keep a list of species with no occurrences available.
-        no_occurrences.append(my_file)
-    del df
+# All species files in the folder (other files, like the harvesting manifest, are skipped). A species can be stored
+# in more than one format (e.g. X.pkl and X.parquet), so all of its files are merged.
+species_files = {}
+for my_file in sorted(os.listdir(args.species_location)):
+    name_species, extension = os.path.splitext(my_file)
+    if extension in Species.FILE_EXTENSIONS.values():
+        species_files.setdefault(name_species, []).append(os.path.join(args.species_location, my_file))
+logger.info("Merging %s species files of %s species from %s "
+            % (sum(len(file_paths) for file_paths in species_files.values()), len(species_files), args.species_location))
 
+start_time = timeit.default_timer()
+merged = MergedOccurrences(args.output_location)
+summary = merged.merge(species_files, important_columns)
+logger.info("Merged %s records of %s species in %s seconds, dropped %s duplicate records."
+            % (summary['records'], summary['species'], timeit.default_timer() - start_time, summary['duplicates']))
+logger.info("Merged dataset stored in %s " % merged.data_file)
 
-logger.info("Total reading time %s seconds for %s. " % (total_time, method))
 # also store a list of all species with 0 occurrences in a file.
+no_occurrences = [os.path.basename(file_path) for name_species in summary['empty'] for file_path in species_files[name_species]]
 pickle.dump(no_occurrences, open(os.path.join(args.output_location, "no_occurrences.pkl"), "wb"))
 logger.info("Stored a list of species with zero occurrences in %s " % os.path.join(args.output_location, "no_occurrences.pkl"))
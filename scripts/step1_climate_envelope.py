@@ -15,7 +15,7 @@ Input:
  - Full location of the folder where the biogeographic realms (terrestrial ecoregions) raster data is stored.
  - Full location of the folder where the temperature raster layers (files) are location.
  - Full location of the folder where the IUCN species shapefiles are located.
- - Output location (folder) for storing the individual dataframes (csv output of the processing)
+ - Output location (folder) for storing the output of the processing (the species store, and optionally a csv file per species)
  - Pixel size (unless the default is used.)
 
 This script does the following:
@@ -27,198 +27,194 @@ This script does the following:
     outside the raster pixels, and samples 1000 pseudo-absence pixels (using the criteria as described above). Both the presences and pseudo-absences
     raster layers' pixels are converted to world coordinates (middle of pixel location) and merged with the "base" dataframe that contains only
     latitude/longitude as index.
- 4. Serializes the constructed dataframe into a csv format.
+ 4. Stores the presences/pseudo-absences of all species in one species store (optionally also exported to csv files).
 
 """
 import logging
 # import timeit
-import pandas as pd
 import numpy as np
-from iSDM.environment import RasterEnvironmentalLayer
+from iSDM.environment import RasterEnvironmentalLayer, MemmapEnvironmentalLayer
 # from iSDM.environment import RealmsLayer
 from iSDM.environment import Source
-from iSDM.environment import ClimateLayer
+from iSDM.environment import RasterStack
 from iSDM.species import IUCNSpecies
 from iSDM.model import Model
+from iSDM.pipeline import run_species, SpeciesStore
 # from iSDM.model import Algorithm
 import os
 import argparse
 import errno
 
-parser = argparse.ArgumentParser()
-parser.add_argument('-r', '--realms-location', default=os.path.join(os.getcwd(), "data", "terrestrial_ecoregions", "terrestrial_ecoregions_30arcmin_final.tif"), help='The full path to the file where the biogeographic realms raster data is located.')
-parser.add_argument('-t', '--temperature-location', default=os.path.join(os.getcwd(), "data", "watertemp"), help="The folder where the temperature raster files are.")
-parser.add_argument('-s', '--species-location', default=os.path.join(os.getcwd(), "data", "fish"), help="The folder where the IUCN species shapefiles are located.")
-parser.add_argument('-o', '--output-location', default=os.path.join(os.getcwd(), "data", "fish"), help="Output location (folder) for storing the output of the processing.")
-parser.add_argument('-p', '--pixel-size', default=0.5, type=float, help="Resolution (in target georeferenced units, i.e., the pixel size). Assumed to be square, so only one value needed.")
-parser.add_argument('--reprocess', action='store_true', help="Reprocess the data, using the already-rasterized individual species rangemaps. Assumes these files are all available.")
-parser.set_defaults(reprocess=False)
-parser.add_argument('--baseframe', action='store_true', help="Whether to compute the base dataframe or skip it. Default is True.")
-parser.set_defaults(baseframe=True)
-args = parser.parse_args()
-
-# 0. logging
-try:
-    os.makedirs(args.output_location)
-except OSError as e:
-    if e.errno != errno.EEXIST:
-        raise
+# the only IUCN attribute columns needed (besides the geometries of the rangemaps)
+IUCN_COLUMNS = ['id_no', 'binomial', 'presence']
 
 logger = logging.getLogger()
-logger.setLevel(logging.DEBUG)
-handler = logging.StreamHandler()
-formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
-handler.setFormatter(formatter)
-logger.addHandler(handler)
-fh = logging.FileHandler(os.path.join(args.output_location, "step1_climate_envelope.log"))
-fh.setLevel(logging.DEBUG)
-fh.setFormatter(formatter)
-logger.addHandler(fh)
-
-pixel_size = args.pixel_size
-if args.baseframe:
-    logger.info("Preparing a Model base dataframe")
-    climate_envelope_model = Model(pixel_size=pixel_size)
-    base_dataframe = climate_envelope_model.get_base_dataframe()
-    # logger.info("Saving base dataframe to csv")
-    # base_dataframe.to_csv(os.path.join(args.output_location, "base.csv"))
-    # 1. Temperature layers
-    logger.info("STEP 1: LOADING Temperature layers.")
-    water_min_layer = ClimateLayer(file_path=os.path.join(args.temperature_location, "min_wt_2000.tif"), name_layer="MinT")
-    climate_envelope_model.add_environmental_layer(water_min_layer, discard_threshold=0)
-    water_max_layer = ClimateLayer(file_path=os.path.join(args.temperature_location, "max_wt_2000.tif"), name_layer="MaxT")
-    climate_envelope_model.add_environmental_layer(water_max_layer, discard_threshold=0)
-    water_mean_layer = ClimateLayer(file_path=os.path.join(args.temperature_location, "mean_wt_2000.tif"), name_layer="MeanT")
-    climate_envelope_model.add_environmental_layer(water_mean_layer, discard_threshold=0)
-    # 1.2 Monthly temperature layers (additional layers can be added the same way)
-    water_mean_monthly_1_layer = ClimateLayer(file_path=os.path.join(args.temperature_location, "tw31_01_2000.tif"), name_layer="MeanT_m1")
-    climate_envelope_model.add_environmental_layer(water_mean_monthly_1_layer, discard_threshold=0)
-    water_mean_monthly_2_layer = ClimateLayer(file_path=os.path.join(args.temperature_location, "tw29_02_2000.tif"), name_layer="MeanT_m2")
-    climate_envelope_model.add_environmental_layer(water_mean_monthly_2_layer, discard_threshold=0)
-    water_mean_monthly_3_layer = ClimateLayer(file_path=os.path.join(args.temperature_location, "tw31_03_2000.tif"), name_layer="MeanT_m3")
-    climate_envelope_model.add_environmental_layer(water_mean_monthly_3_layer, discard_threshold=0)
-    water_mean_monthly_4_layer = ClimateLayer(file_path=os.path.join(args.temperature_location, "tw30_04_2000.tif"), name_layer="MeanT_m4")
-    climate_envelope_model.add_environmental_layer(water_mean_monthly_4_layer, discard_threshold=0)
-    water_mean_monthly_5_layer = ClimateLayer(file_path=os.path.join(args.temperature_location, "tw31_05_2000.tif"), name_layer="MeanT_m5")
-    climate_envelope_model.add_environmental_layer(water_mean_monthly_5_layer, discard_threshold=0)
-    water_mean_monthly_6_layer = ClimateLayer(file_path=os.path.join(args.temperature_location, "tw30_06_2000.tif"), name_layer="MeanT_m6")
-    climate_envelope_model.add_environmental_layer(water_mean_monthly_6_layer, discard_threshold=0)
-    water_mean_monthly_7_layer = ClimateLayer(file_path=os.path.join(args.temperature_location, "tw31_07_2000.tif"), name_layer="MeanT_m7")
-    climate_envelope_model.add_environmental_layer(water_mean_monthly_7_layer, discard_threshold=0)
-    water_mean_monthly_8_layer = ClimateLayer(file_path=os.path.join(args.temperature_location, "tw31_08_2000.tif"), name_layer="MeanT_m8")
-    climate_envelope_model.add_environmental_layer(water_mean_monthly_8_layer, discard_threshold=0)
-    water_mean_monthly_9_layer = ClimateLayer(file_path=os.path.join(args.temperature_location, "tw30_09_2000.tif"), name_layer="MeanT_m9")
-    climate_envelope_model.add_environmental_layer(water_mean_monthly_9_layer, discard_threshold=0)
-    water_mean_monthly_10_layer = ClimateLayer(file_path=os.path.join(args.temperature_location, "tw31_10_2000.tif"), name_layer="MeanT_m10")
-    climate_envelope_model.add_environmental_layer(water_mean_monthly_10_layer, discard_threshold=0)
-    water_mean_monthly_11_layer = ClimateLayer(file_path=os.path.join(args.temperature_location, "tw30_11_2000.tif"), name_layer="MeanT_m11")
-    climate_envelope_model.add_environmental_layer(water_mean_monthly_11_layer, discard_threshold=0)
-    water_mean_monthly_12_layer = ClimateLayer(file_path=os.path.join(args.temperature_location, "tw31_12_2000.tif"), name_layer="MeanT_m12")
-    climate_envelope_model.add_environmental_layer(water_mean_monthly_12_layer, discard_threshold=0)
-
-# 2. Biogeographic realms
-logger.info("STEP 2: LOADING Biogeographical realms layer")
-realms_layer = RasterEnvironmentalLayer(file_path=args.realms_location, source=Source.WWL, name_layer='Realm')
-
-if args.baseframe:
-    climate_envelope_model.add_environmental_layer(realms_layer)
-    logger.info("Saving base_merged to a csv dataframe...")
-    base_merged = climate_envelope_model.get_base_dataframe()
-    base_merged.to_csv(open(os.path.join(args.output_location, "base_merged.csv"), "w"))
-# 3. Load entire IUCN data. (TODO: maybe we can load one by one, if the data grows beyond RAM)
-# download fish data from Google Drive: https://drive.google.com/open?id=0B9cazFzBtPuCSFp3YWE1V2JGdnc
-logger.info("STEP 3: LOADING all species rangemaps.")
-species = IUCNSpecies(name_species='All')
-species.load_shapefile(args.species_location)   # warning, all species data will be loaded, may take a while!!
-# 3.1 Get the list of non-extinct binomials, for looping through individual species
-species_data = species.get_data()
-species.drop_extinct_species()
-non_extinct_species = species.get_data()
-non_extinct_binomials = non_extinct_species.binomial.unique().tolist()
-
-try:
-    os.makedirs(os.path.join(args.output_location, "rasterized"))
-except OSError as e:
-    if e.errno != errno.EEXIST:
-        raise
-try:
-    os.makedirs(os.path.join(args.output_location, "csv"))
-except OSError as e:
-    if e.errno != errno.EEXIST:
-        raise
-
-# rasterized_species = IUCNSpecies(name_species="Temporary name")
+
 
 # 3.2 LOOP/RASTERIZE/STORE_RASTER/SAMPLE_PSEUDO_ABSENCES/STORE_DATAFRAME
-logger.info(">>>>>>>>>>>>>>>>>Looping through species!<<<<<<<<<<<<<<<<")
-for idx, name_species in enumerate(non_extinct_binomials):
-    species.set_data(species_data[species_data.binomial == name_species])
-    species.name_species = name_species
+# Defined at the module level, and with all its settings as arguments, so that the worker processes can run it with any
+# multiprocessing start method (with "spawn", the workers import this module without running the main block below).
+def process_species(name_species, layers, idx=None, species_data=None, species_store=None, output_location=None, pixel_size=0.5,
+                    reprocess=False):
+    species = IUCNSpecies(name_species=name_species)
+    species.set_data(species_data)
     logger.info("ID=%s Processing species: %s " % (idx, name_species))
 
-    if args.reprocess:
+    if reprocess:
         logger.info("%s Reprocessing individual species data, will use existing raster file for species: %s" % (idx, name_species))
-        full_location_raster_file = os.path.join(args.output_location, "rasterized", name_species + ".tif")
+        full_location_raster_file = os.path.join(output_location, "rasterized", name_species + ".tif")
         if not os.path.exists(full_location_raster_file):
             logger.error("%s Raster file does NOT exist for species: %s " % (idx, name_species))
-            continue
-        raster_reader = species.load_raster_data(raster_file=full_location_raster_file)
-        rasterized = species.raster_reader.read(1)
+            return
+        species.load_raster_data(raster_file=full_location_raster_file)
+        rasterized_window = species.raster_reader.read(1)
+        # the raster file can be a (grid-aligned) window of the global raster, or the global raster itself
+        window_offset = (int(round((90 - species.raster_affine.f) / pixel_size)), int(round((species.raster_affine.c + 180) / pixel_size)))
     else:
         logger.info("%s Rasterizing species: %s " % (idx, name_species))
-        rasterized = species.rasterize(raster_file=os.path.join(args.output_location, "rasterized", name_species + ".tif"), pixel_size=pixel_size)
-    # special case with blank map after rasterizing species (could be too small region)
-    # we attempt to rasterize it with all_touched=True which means any pixel touching a geometry will be burned
-    if not (isinstance(rasterized, np.ndarray)) or not (set(np.unique(rasterized)) == set({0, 1})):
-        logger.warning("%s Rasterizing very small area, will use all_touched=True to avoid blank raster for species %s " % (idx, name_species))
-        rasterized = species.rasterize(raster_file=os.path.join(args.output_location, "rasterized", name_species + ".tif"), pixel_size=pixel_size, all_touched=True)
-        if not (isinstance(rasterized, np.ndarray)) or not (set(np.unique(rasterized)) == set({0, 1})):
-            logger.error("%s Rasterizing did not succeed for species %s , (raster is empty)    " % (idx, name_species))
-            continue
+        # only the (grid-aligned) window covering the species range is rasterized; very small ranges are detected
+        # up front and burned with all_touched=True, so there is no need for a second (global) pass.
+        rasterized_window, window_offset = species.rasterize_window(raster_file=os.path.join(output_location, "rasterized", name_species + ".tif"), pixel_size=pixel_size)
+    if not rasterized_window.any():
+        logger.error("%s Rasterizing did not succeed for species %s , (raster is empty)    " % (idx, name_species))
+        return
     logger.info("%s Finished rasterizing species: %s " % (idx, name_species))
 
     logger.info("%s Selecting pseudo-absences for species: %s " % (idx, name_species))
-    selected_layers, pseudo_absences = realms_layer.sample_pseudo_absences(species_raster_data=rasterized,
-                                                                           number_of_pseudopoints=1000)
+    species_realms_layer = RasterEnvironmentalLayer(source=Source.WWL, name_layer='Realm')
+    species_realms_layer.env_raster_data = layers['realms']
+    # sparse sampling: presences/pseudo-absences are flat cell indices, no global-scale maps are needed
+    selected_cells, pseudo_absence_cells = species_realms_layer.sample_pseudo_absences_sparse(species_raster_window=rasterized_window,
+                                                                                              window_offset=window_offset,
+                                                                                              number_of_pseudopoints=1000)
     logger.info("%s Finished selecting pseudo-absences for species: %s " % (idx, name_species))
 
-    logger.info("%s Pixel-to-world coordinates transformation of presences for species: %s " % (idx, name_species))
-    presence_coordinates = species.pixel_to_world_coordinates(raster_data=rasterized)
-    logger.info("%s Finished pixel-to-world coordinates transformation of presences for species: %s " % (idx, name_species))
-    logger.info("%s Constructing a data frame for presences." % idx)
-    presences_dataframe = pd.DataFrame(columns=['decimallatitude', 'decimallongitude'])
-    presences_dataframe['decimallatitude'] = np.array(presence_coordinates[0])
-    presences_dataframe['decimallongitude'] = np.array(presence_coordinates[1])
-    presences_dataframe[species.name_species] = 1   # fill presences with 1's
-    presences_dataframe.set_index(['decimallatitude', 'decimallongitude'], inplace=True, drop=True)
-    logger.info("%s Finished constructing a data frame for presences." % idx)
-    logger.info("%s Shape of presences dataframe: %s " % (idx, presences_dataframe.shape,))
-    # if the pseudo_absences does not contain all zeros
-    if pseudo_absences.any():
-        logger.info("%s Pixel-to-world coordinates transformation of pseudo-absences for species: %s " % (idx, name_species))
-        pseudo_absence_coordinates = species.pixel_to_world_coordinates(raster_data=pseudo_absences)
-        logger.info("%s Finished pixel-to-world coordinates transformation of pseudo-absences for species: %s " % (idx, name_species))
-        logger.info("%s Constructing a data frame for pseudo-absences" % idx)
-        pseudo_absences_dataframe = pd.DataFrame(columns=['decimallatitude', 'decimallongitude'])
-        pseudo_absences_dataframe['decimallatitude'] = np.array(pseudo_absence_coordinates[0])
-        pseudo_absences_dataframe['decimallongitude'] = np.array(pseudo_absence_coordinates[1])
-        pseudo_absences_dataframe[species.name_species] = 0   # fill pseudo-absences with 0
-        pseudo_absences_dataframe.set_index(['decimallatitude', 'decimallongitude'], inplace=True, drop=True)
-        logger.info("%s Finished constructing a data frame for pseudo-absences." % idx)
-        logger.info("%s Shape of pseudo-absences dataframe: %s " % (idx, pseudo_absences_dataframe.shape,))
-        # merge with presences
-        logger.info("%s Merging presences and pseudo-absences..." % idx)
-        merged = pd.merge(presences_dataframe, pseudo_absences_dataframe, how='outer', left_index=True, right_index=True, on=species.name_species)
-        del pseudo_absences_dataframe
-    else:
+    # presences (1) and pseudo-absences (0) as flat cell indices of the global grid, appended to the species store
+    rows, cols = np.nonzero(rasterized_window)
+    presence_cells = (rows + window_offset[0]).astype(np.int64) * layers['realms'].shape[1] + (cols + window_offset[1])
+    logger.info("%s Number of presences: %s " % (idx, presence_cells.shape[0]))
+    if pseudo_absence_cells.shape[0] == 0:
         logger.warning("%s No pseudo absences sampled for species %s " % (idx, name_species))
-        merged = presences_dataframe
-    logger.info("%s Shape of merged dataframe: %s " % (idx, merged.shape,))
-    merged.sortlevel(level=[0, 1], axis=0, ascending=[False, True], inplace=True)
     logger.info("%s Finished processing species: %s " % (idx, name_species))
     logger.info("%s Serializing to storage." % idx)
-    merged.to_csv(open(os.path.join(args.output_location, "csv", name_species + ".csv"), "w"))
+    species_store.append(name_species,
+                         np.concatenate([presence_cells, pseudo_absence_cells]),
+                         np.concatenate([np.ones(presence_cells.shape[0], dtype=np.int8), np.zeros(pseudo_absence_cells.shape[0], dtype=np.int8)]),
+                         species_id=idx)
     logger.info("%s Finished serializing to storage." % idx)
-    del presences_dataframe
-    del merged
-logger.info("DONE!")
+    return presence_cells.shape[0] + pseudo_absence_cells.shape[0]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-r', '--realms-location', default=os.path.join(os.getcwd(), "data", "terrestrial_ecoregions", "terrestrial_ecoregions_30arcmin_final.tif"), help='The full path to the file where the biogeographic realms raster data is located.')
+    parser.add_argument('-t', '--temperature-location', default=os.path.join(os.getcwd(), "data", "watertemp"), help="The folder where the temperature raster files are.")
+    parser.add_argument('-s', '--species-location', default=os.path.join(os.getcwd(), "data", "fish"), help="The folder where the IUCN species shapefiles are located.")
+    parser.add_argument('-o', '--output-location', default=os.path.join(os.getcwd(), "data", "fish"), help="Output location (folder) for storing the output of the processing.")
+    parser.add_argument('-p', '--pixel-size', default=0.5, type=float, help="Resolution (in target georeferenced units, i.e., the pixel size). Assumed to be square, so only one value needed.")
+    parser.add_argument('--reprocess', action='store_true', help="Reprocess the data, using the already-rasterized individual species rangemaps. Assumes these files are all available.")
+    parser.set_defaults(reprocess=False)
+    parser.add_argument('--baseframe', action='store_true', help="Whether to compute the base dataframe or skip it. Default is True.")
+    parser.set_defaults(baseframe=True)
+    parser.add_argument('--cache-location', default=None, help="The folder where the (binary) cache of the IUCN species shapefiles is stored. Default is next to the shapefiles.")
+    parser.add_argument('--raster-cache-location', default=None, help="The folder where the (memory-mapped) cache of the raster layers is stored. Default is next to the raster files.")
+    parser.add_argument('--csv', action='store_true', help="Also export the presences/pseudo-absences of every species to a csv file (in the csv folder of the output location).")
+    parser.add_argument('-n', '--processes', default=1, type=int, help="Number of worker processes used for processing species in parallel. Default is 1.")
+    args = parser.parse_args()
+
+    # 0. logging
+    try:
+        os.makedirs(args.output_location)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    logger.setLevel(logging.DEBUG)
+    handler = logging.StreamHandler()
+    formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    handler.setFormatter(formatter)
+    logger.addHandler(handler)
+    fh = logging.FileHandler(os.path.join(args.output_location, "step1_climate_envelope.log"))
+    fh.setLevel(logging.DEBUG)
+    fh.setFormatter(formatter)
+    logger.addHandler(fh)
+
+    pixel_size = args.pixel_size
+    if args.baseframe:
+        logger.info("Preparing a Model base dataframe")
+        climate_envelope_model = Model(pixel_size=pixel_size)
+        base_dataframe = climate_envelope_model.get_base_dataframe()
+        # logger.info("Saving base dataframe to csv")
+        # base_dataframe.to_csv(os.path.join(args.output_location, "base.csv"))
+        # 1. Temperature layers
+        logger.info("STEP 1: LOADING Temperature layers.")
+        # all temperature layers are on the same grid: they are read concurrently into one data cube, and added at once
+        temperature_files = ["min_wt_2000.tif", "max_wt_2000.tif", "mean_wt_2000.tif",
+                             # 1.2 Monthly temperature layers (additional layers can be added the same way)
+                             "tw31_01_2000.tif", "tw29_02_2000.tif", "tw31_03_2000.tif", "tw30_04_2000.tif",
+                             "tw31_05_2000.tif", "tw30_06_2000.tif", "tw31_07_2000.tif", "tw31_08_2000.tif",
+                             "tw30_09_2000.tif", "tw31_10_2000.tif", "tw30_11_2000.tif", "tw31_12_2000.tif"]
+        temperature_names = ["MinT", "MaxT", "MeanT"] + ["MeanT_m%s" % month for month in range(1, 13)]
+        temperature_stack = RasterStack(file_paths=[os.path.join(args.temperature_location, file_name) for file_name in temperature_files],
+                                        names_layers=temperature_names)
+        temperature_stack.load_data()
+        climate_envelope_model.add_raster_stack(temperature_stack, discard_threshold=0)
+        del temperature_stack
+
+    # 2. Biogeographic realms
+    logger.info("STEP 2: LOADING Biogeographical realms layer")
+    # decompressed only once, into a memory-mapped cache, which later runs open without reading the data
+    realms_layer = MemmapEnvironmentalLayer(file_path=args.realms_location, source=Source.WWL, name_layer='Realm', cache_location=args.raster_cache_location)
+
+    if args.baseframe:
+        climate_envelope_model.add_environmental_layer(realms_layer)
+        logger.info("Saving base_merged to a chunked grid store...")
+        # reopened with Model.load(); adding a layer later only writes that layer
+        climate_envelope_model.save(os.path.join(args.output_location, "base_merged"))
+    # 3. Load entire IUCN data. (TODO: maybe we can load one by one, if the data grows beyond RAM)
+    # download fish data from Google Drive: https://drive.google.com/open?id=0B9cazFzBtPuCSFp3YWE1V2JGdnc
+    logger.info("STEP 3: LOADING all species rangemaps.")
+    species = IUCNSpecies(name_species='All')
+    # warning, all species data will be loaded, may take a while the first time!! Afterwards, it is reloaded from the cache.
+    species.load_shapefile(args.species_location, columns=IUCN_COLUMNS, cache=True, cache_location=args.cache_location)
+    # 3.1 Get the list of non-extinct binomials, for looping through individual species. The per-species catalog is stored
+    # next to the shapefiles, and only rebuilt when they change.
+    species_catalog = species.load_species_catalog(pixel_size=pixel_size, cache_location=args.cache_location)
+    species.drop_extinct_species()
+    non_extinct_binomials = species_catalog.index[~species_catalog.all_extinct.values].tolist()
+    # Group the records by species once, instead of scanning all records for every species in the loop
+    species.build_species_index()
+
+    try:
+        os.makedirs(os.path.join(args.output_location, "rasterized"))
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    # Realms are loaded only once, and shared (read-only, memory-mapped) with all the worker processes.
+    realms_reader = realms_layer.load_data()
+    realms_data = realms_reader.read(1)
+    realms_data[realms_data == realms_reader.nodata] = 0  # cutoff any nodata values
+    # presences/pseudo-absences of all species, in one (append-only) store, written concurrently by the worker processes
+    species_store = SpeciesStore(os.path.join(args.output_location, "species"), shape=realms_data.shape)
+
+    logger.info(">>>>>>>>>>>>>>>>>Looping through species!<<<<<<<<<<<<<<<<")
+    species_positions = dict((name_species, idx) for idx, name_species in enumerate(non_extinct_binomials))
+    processed, failed = run_species(non_extinct_binomials,
+                                    process_species,
+                                    shared_layers={'realms': realms_data},
+                                    species_arguments=lambda name_species: {'idx': species_positions[name_species],
+                                                                            'species_data': species.get_species(name_species),
+                                                                            'species_store': species_store,
+                                                                            'output_location': args.output_location,
+                                                                            'pixel_size': pixel_size,
+                                                                            'reprocess': args.reprocess},
+                                    processes=args.processes,
+                                    # the species with the largest rasterization windows first, for a better load balance
+                                    species_costs=species_catalog.window_pixels.to_dict())
+    if failed:
+        logger.error("Processing failed for %s species: %s " % (len(failed), sorted(failed.keys())))
+    if args.csv:
+        logger.info("Exporting the species data to csv files...")
+        species_store.export_csv(os.path.join(args.output_location, "csv"))
+    logger.info("DONE!")
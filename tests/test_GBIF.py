@@ -1,9 +1,78 @@
 import unittest
-from iSDM.species import GBIFSpecies
+from iSDM.species import GBIFSpecies, IUCNSpecies
+from iSDM.gbif import OccurrenceFetcher, OccurrenceHarvester, MergedOccurrences
 import pandas as pd
 import geopandas as gp
 from shapely.geometry import Point
+from rasterio.transform import Affine
 import numpy as np
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+
+
+class StubGBIFServer(ThreadingMixIn, HTTPServer):
+    """
+    A local stand-in for the GBIF occurrence search API, serving :attr:`count` synthetic records (with overlapping pages
+    when a client asks for them), failing the first request for every offset in :attr:`failing_offsets` with HTTP 503,
+    and keeping track of the requested offsets and the maximum number of concurrent requests.
+    """
+    daemon_threads = True
+
+    def __init__(self, count, failing_offsets=(), delay=0.01):
+        HTTPServer.__init__(self, ("127.0.0.1", 0), StubGBIFHandler)
+        self.count = count
+        self.failing_offsets = set(failing_offsets)
+        self.delay = delay
+        self.requested_offsets = []
+        self.active_requests = 0
+        self.max_active_requests = 0
+        self.lock = threading.Lock()
+
+    @property
+    def api_url(self):
+        return "http://127.0.0.1:%s/" % self.server_address[1]
+
+
+class StubGBIFHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        server = self.server
+        query = parse_qs(urlparse(self.path).query)
+        offset = int(query.get('offset', [0])[0])
+        limit = min(int(query.get('limit', [20])[0]), 300)
+        with server.lock:
+            server.requested_offsets.append(offset)
+            server.active_requests += 1
+            server.max_active_requests = max(server.max_active_requests, server.active_requests)
+            failing = offset in server.failing_offsets
+            server.failing_offsets.discard(offset)
+        try:
+            time.sleep(server.delay)
+            if failing:
+                self.send_response(503)
+                self.end_headers()
+                return
+            results = [{'key': key, 'species': "Stub species"} for key in range(offset, min(offset + limit, server.count))]
+            body = json.dumps({'offset': offset, 'limit': limit, 'count': server.count,
+                               'endOfRecords': offset + limit >= server.count, 'results': results}).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.end_headers()
+            self.wfile.write(body)
+        finally:
+            with server.lock:
+                server.active_requests -= 1
+
+    def log_message(self, *args):
+        pass
+
 
 class TestGBIF(unittest.TestCase):
 
@@ -30,6 +99,37 @@ class TestGBIF(unittest.TestCase):
         self.assertIsInstance(self.test_species2.data_full, pd.DataFrame)
         self.assertIsNotNone(self.test_species2.data_full)
 
+    def test_GBIF_save_load_data_columnar(self):
+        self.test_species2.load_csv("./data/GBIF.csv")
+        data = self.test_species2.data_full
+        columns = ['decimallatitude', 'decimallongitude', 'year', 'basisofrecord', 'nonexistent_column']
+        filters = [('year', '>', 1990), ('basisofrecord', 'in', ['OBSERVATION', 'HUMAN_OBSERVATION'])]
+        expected = data[(data.year > 1990) & data.basisofrecord.isin(['OBSERVATION', 'HUMAN_OBSERVATION'])]
+        location = tempfile.mkdtemp()
+        try:
+            for method in ["parquet", "feather", "pickle"]:
+                self.test_species2.data_full = data
+                self.test_species2.save_data(dir_name=location, method=method)
+                file_path = os.path.join(location, self.test_species2.name_species + GBIFSpecies.FILE_EXTENSIONS[method])
+                loaded = self.test_species2.load_data(file_path, columns=columns, filters=filters, memory_map=True)
+                self.assertEqual(loaded.columns.tolist(), columns[:4])
+                self.assertEqual(loaded.shape[0], expected.shape[0])
+                loaded = self.test_species2.load_data(file_path, filters=[[('year', '<', 1950)], [('year', '>', 2010)]])
+                self.assertEqual(loaded.shape[0], ((data.year < 1950) | (data.year > 2010)).sum())
+                self.assertEqual(loaded.shape[1], data.shape[1])
+            # a (non-default) index is restored
+            for method in ["parquet", "feather"]:
+                self.test_species2.data_full = data.set_index('gbifid')
+                self.test_species2.save_data(dir_name=location, method=method)
+                file_path = os.path.join(location, self.test_species2.name_species + GBIFSpecies.FILE_EXTENSIONS[method])
+                for loaded_columns in [None, ['year']]:
+                    loaded = self.test_species2.load_data(file_path, columns=loaded_columns, memory_map=True)
+                    self.assertEqual(loaded.index.name, 'gbifid')
+                    np.testing.assert_array_equal(loaded.index.values, data.gbifid.values)
+                    self.assertEqual(loaded.shape[1], data.shape[1] - 1 if loaded_columns is None else 1)
+        finally:
+            shutil.rmtree(location)
+
     def test_GBIF_geometrize(self):
         self.test_species.find_species_occurrences()
         self.test_species.geometrize()
@@ -44,6 +144,93 @@ class TestGBIF(unittest.TestCase):
         self.test_species.geometrize(dropna=False)
         self.assertEqual(number_point_records, self.test_species.data_full.shape[0])
 
+    def test_GBIF_geometrize_lazy(self):
+        self.test_species2.load_csv("./data/GBIF.csv")
+        number_point_records = self.test_species2.data_full.dropna(subset=['decimallatitude', 'decimallongitude']).shape[0]
+        self.test_species2.geometrize(lazy=True)
+        self.assertNotIsInstance(self.test_species2.data_full, gp.GeoDataFrame)
+        self.assertEqual(number_point_records, self.test_species2.data_full.shape[0])
+        # rasterizing the coordinates directly gives the same result as rasterizing the point geometries
+        result, offset = self.test_species2.rasterize_window(pixel_size=0.5)
+        self.test_species2.geometrize()
+        self.assertIsInstance(self.test_species2.data_full, gp.GeoDataFrame)
+        self.assertEqual(number_point_records, self.test_species2.data_full.shape[0])
+        self.assertTrue((self.test_species2.data_full.geometry.x == self.test_species2.data_full.decimallongitude).all())
+        result_geometries, offset_geometries = self.test_species2.rasterize_window(pixel_size=0.5)
+        self.assertEqual(offset, offset_geometries)
+        np.testing.assert_array_equal(result, result_geometries)
+
+    def test_GBIF_rasterize_window_pixel_edges(self):
+        # records lying exactly on the max-longitude and min-latitude pixel edges are inside the window
+        pixel_size = 0.5
+        self.test_species2.set_data(pd.DataFrame({'decimallongitude': [10.0, 5.25, 7.3], 'decimallatitude': [3.5, 3.0, 10.0]}))
+        self.test_species2.geometrize(lazy=True)
+        result_lazy, offset_lazy = self.test_species2.rasterize_window(pixel_size=pixel_size)
+        self.test_species2.geometrize()
+        full_result = self.test_species2.rasterize(pixel_size=pixel_size)
+        self.assertEqual(np.sum(full_result), 3)
+        result, (row_offset, column_offset) = self.test_species2.rasterize_window(pixel_size=pixel_size)
+        self.assertEqual((row_offset, column_offset), offset_lazy)
+        np.testing.assert_array_equal(result, result_lazy)
+        np.testing.assert_array_equal(result, full_result[row_offset:row_offset + result.shape[0],
+                                                          column_offset:column_offset + result.shape[1]])
+        self.assertEqual(np.sum(result), np.sum(full_result))
+
+    def test_GBIF_overlay(self):
+        self.test_species2.load_csv("./data/GBIF.csv")
+        self.test_species2.geometrize()
+        data = self.test_species2.data_full
+        range_map = gp.GeoSeries([Point(-85, 38).buffer(5), Point(-80, 42).buffer(3)])
+        with self.assertRaises(AttributeError):
+            self.test_species2.overlay(range_map, mode='nonsense')
+        kept = self.test_species2.overlay(range_map)
+        self.test_species2.set_data(data)
+        kept_strtree = self.test_species2.overlay(range_map, mode='strtree', keep_rejected=True)
+        np.testing.assert_array_equal(kept, kept_strtree)
+        self.assertEqual(self.test_species2.data_full.shape[0], kept.sum())
+        self.assertEqual(self.test_species2.rejected_data.shape[0], data.shape[0] - kept.sum())
+        # the raster lookup (with all pixels touched by the range) keeps at least all records within the range
+        with self.assertRaises(AttributeError):
+            self.test_species2.overlay(range_map, mode='raster')
+        self.test_species2.set_data(data)
+        kept_raster = self.test_species2.overlay(range_map, mode='raster', pixel_size=0.1)
+        self.assertTrue(kept_raster[kept].all())
+        self.assertLess(kept_raster.sum() - kept.sum(), 0.05 * kept.sum())
+        range_raster = np.zeros((180, 360), dtype=np.uint8)
+        self.test_species2.set_data(data)
+        kept_nothing = self.test_species2.overlay(range_map, mode='raster', range_raster=(range_raster, Affine(1, 0, -180, 0, -1, 90)))
+        self.assertFalse(kept_nothing.any())
+        # the mask lines up with the original records, also when records without coordinates are dropped
+        self.test_species2.load_csv("./data/GBIF.csv")
+        records = self.test_species2.data_full.copy()
+        records.loc[records.index[:10], 'decimallatitude'] = np.nan
+        range_species = IUCNSpecies(name_species="range map")
+        range_species.set_data(gp.GeoDataFrame(geometry=range_map))
+        for mode in ['strtree', 'raster']:
+            self.test_species2.set_data(records)
+            kept_records = self.test_species2.overlay(range_species, mode=mode, pixel_size=0.1)
+            self.assertEqual(kept_records.shape[0], records.shape[0])
+            self.assertFalse(kept_records[:10].any())
+            self.assertTrue(self.test_species2.data_full.index.equals(records.index[kept_records]))
+        # the range map itself is left untouched
+        self.assertFalse(hasattr(range_species, 'raster_window'))
+
+    def test_GBIF_polygonize(self):
+        self.test_species2.load_csv("./data/GBIF.csv")
+        data = self.test_species2.get_data().dropna(subset=['decimallatitude', 'decimallongitude'])
+        polygons = self.test_species2.polygonize(buffer_distance=1, simplify_tolerance=0.01)
+        self.assertIsInstance(polygons, gp.GeoDataFrame)
+        self.assertIs(self.test_species2.get_data(), self.test_species2.data_full)
+        buffers = gp.GeoSeries([Point(x, y) for x, y in zip(data.decimallongitude, data.decimallatitude)]).buffer(1).unary_union
+        # collapsing the records onto a grid moves the buffers by at most half a cell diagonal
+        self.assertAlmostEqual(polygons.unary_union.area, buffers.area, delta=0.02 * buffers.area)
+        exact = self.test_species2.polygonize(buffer_distance=1, simplify_tolerance=0.01, cell_size=0, tile_size=3)
+        self.assertAlmostEqual(exact.unary_union.area, buffers.area, delta=0.005 * buffers.area)
+        # a single record results in a single polygon
+        self.test_species2.set_data(data.iloc[:1])
+        single = self.test_species2.polygonize()
+        self.assertEqual(single.shape[0], 1)
+
     def test_GBIF_rasterize(self):
         # with self.assertRaises(AttributeError):
             # self.test_species.rasterize()
@@ -66,5 +253,114 @@ class TestGBIF(unittest.TestCase):
         del self.test_species1
         del self.test_species2
 
+
+class TestOccurrenceFetcher(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StubGBIFServer(count=2050, failing_offsets=[900])
+        self.server_thread = threading.Thread(target=self.server.serve_forever)
+        self.server_thread.daemon = True
+        self.server_thread.start()
+        self.fetcher = OccurrenceFetcher(api_url=self.server.api_url, max_workers=4, backoff_factor=0.01)
+
+    def test_OccurrenceFetcher_plan_offsets(self):
+        with self.assertRaises(AttributeError):
+            OccurrenceFetcher(page_size=1000)
+        self.assertEqual(self.fetcher.plan_offsets(1000), [(0, 300), (300, 300), (600, 300), (900, 300)])
+        self.assertEqual(self.fetcher.plan_offsets(1000, start=300), [(300, 300), (600, 300), (900, 300)])
+        # the pages reach the hard limit of the API exactly, with a last, shorter page
+        pages = self.fetcher.plan_offsets(500000, start=300)
+        self.assertEqual(pages[-1], (199800, 200))
+        self.assertEqual(300 + sum(limit for _, limit in pages), 200000)
+        self.assertTrue(all(offset + limit <= 200000 for offset, limit in pages))
+
+    def test_OccurrenceFetcher_fetch_occurrences(self):
+        full_results = self.fetcher.fetch_occurrences(taxonKey=1)
+        self.assertEqual(full_results['count'], 2050)
+        self.assertEqual([record['key'] for record in full_results['results']], list(range(2050)))
+        # every page was requested once, apart from the retried one
+        self.assertEqual(sorted(self.server.requested_offsets), sorted(list(range(0, 2050, 300)) + [900]))
+        self.assertGreater(self.server.max_active_requests, 1)
+        self.assertLessEqual(self.server.max_active_requests, 4)
+
+    def test_OccurrenceFetcher_retries(self):
+        self.server.failing_offsets = set([0])
+        self.fetcher.retries = 0
+        with self.assertRaises(IOError):
+            self.fetcher.search(offset=0, taxonKey=1)
+
+    def test_OccurrenceFetcher_unique_records(self):
+        records = [{'key': 1}, {'key': 2}, {'key': 1}, {'species': "no key"}]
+        self.assertEqual(OccurrenceFetcher.unique_records(records), [{'key': 1}, {'key': 2}, {'species': "no key"}])
+
+    def tearDown(self):
+        self.fetcher.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class TestOccurrenceHarvester(unittest.TestCase):
+
+    def setUp(self):
+        self.output_location = tempfile.mkdtemp()
+        self.species_names = ["Acrocheilus alutaceus", "Astatotilapia burtoni", "Dorosoma cepedianum", "Some_nonsense"]
+
+    def test_OccurrenceHarvester_pending(self):
+        with self.assertRaises(AttributeError):
+            OccurrenceHarvester(self.output_location, method="csv")
+        harvester = OccurrenceHarvester(self.output_location)
+        self.assertEqual(harvester.pending(self.species_names), self.species_names)
+        # existing data files (from a run without a manifest) are not fetched again
+        open(os.path.join(self.output_location, "Astatotilapia burtoni.pkl"), "w").close()
+        harvester._record("Acrocheilus alutaceus", 'done', "Acrocheilus alutaceus.pkl")
+        harvester._record("Some_nonsense", 'empty')
+        harvester._record("Dorosoma cepedianum", 'failed', "Connection error")
+        self.assertEqual(harvester.pending(self.species_names), ["Dorosoma cepedianum"])
+        # the manifest survives a restart, and failed species are retried
+        harvester = OccurrenceHarvester(self.output_location)
+        self.assertEqual(harvester.manifest['failed'], {"Dorosoma cepedianum": "Connection error"})
+        self.assertEqual(harvester.manifest['empty'], ["Some_nonsense"])
+        self.assertEqual(harvester.pending(self.species_names), ["Dorosoma cepedianum"])
+        harvester._record("Dorosoma cepedianum", 'done', "Dorosoma cepedianum.pkl")
+        self.assertEqual(harvester.manifest['failed'], {})
+        self.assertEqual([file_name for file_name in os.listdir(self.output_location) if file_name.endswith(".tmp")], [])
+
+    def tearDown(self):
+        shutil.rmtree(self.output_location)
+
+
+class TestMergedOccurrences(unittest.TestCase):
+
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        data = pd.read_csv("./data/GBIF.csv", sep="\t")
+        # a species with two (overlapping) re-harvests, another species, and a species without occurrences
+        self.species_files = {}
+        for name_species, species_data in [("Species one", pd.concat([data.iloc[:3000], data.iloc[2500:3000]])),
+                                           ("Species two", data.iloc[3000:]), ("Species empty", data.iloc[:0])]:
+            self.species_files[name_species] = os.path.join(self.location, name_species + ".pkl")
+            species_data.to_pickle(self.species_files[name_species])
+        # "Species one" is also stored in another format, overlapping with the pickle file
+        self.species_files["Species one"] = [self.species_files["Species one"], os.path.join(self.location, "Species one.parquet")]
+        data.iloc[2000:3000][['gbifid', 'decimallatitude', 'decimallongitude', 'year']].to_parquet(self.species_files["Species one"][1])
+        self.data = data
+
+    def test_MergedOccurrences_merge(self):
+        columns = set(['gbifid', 'decimallatitude', 'decimallongitude', 'year', 'basisofrecord', 'nonexistent_column'])
+        summary = MergedOccurrences(self.location).merge(self.species_files, columns)
+        self.assertEqual(summary, {'species': 2, 'records': self.data.shape[0], 'duplicates': 1500, 'empty': ["Species empty"]})
+        merged = MergedOccurrences(self.location)
+        self.assertEqual(merged.species(), ["Species one", "Species two"])
+        self.assertEqual(merged.read_species("Species one", columns=['gbifid']).shape[0], 3000)
+        species_two = merged.read_species("Species two", columns=['gbifid', 'year'])
+        self.assertEqual(species_two.shape, (self.data.shape[0] - 3000, 2))
+        self.assertEqual(species_two.gbifid.dtype, np.int64)
+        self.assertEqual(merged.read().columns.tolist(), sorted(columns))
+        with self.assertRaises(AttributeError):
+            merged.read_species("Species empty")
+
+    def tearDown(self):
+        shutil.rmtree(self.location)
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,6 +1,9 @@
 import unittest
+import os
+import shutil
+import tempfile
 from iSDM.species import IUCNSpecies
-# import pandas as pd
+import pandas as pd
 import geopandas as gp
 from shapely.geometry import MultiPolygon
 from rasterio.transform import Affine
@@ -54,6 +57,23 @@ class TestIUCN(unittest.TestCase):
         result1 = self.test_species.rasterize(pixel_size=0.5, raster_file="./data/fish/tmp.tif", no_data_value=55, default_value=11)
         self.assertEqual(set(np.unique(result1)), {55, 11})
 
+    def test_IUCN_rasterize_window(self):
+        with self.assertRaises(AttributeError):
+            self.test_species.rasterize_window(pixel_size=0.5)
+        pixel_size = 0.5
+        self.test_species.load_shapefile("./data/fish/selection/acrocheilus_alutaceus/acrocheilus_alutaceus.shp")
+        full_result = self.test_species.rasterize(pixel_size=pixel_size)
+        result, (row_offset, column_offset) = self.test_species.rasterize_window(pixel_size=pixel_size)
+        self.assertIsInstance(result, np.ndarray)
+        self.assertEqual(set(np.unique(result)), {0, 1})
+        self.assertLess(result.size, full_result.size)
+        # the window lines up with the global raster
+        self.assertEqual(self.test_species.raster_affine.c, -180 + column_offset * pixel_size)
+        self.assertEqual(self.test_species.raster_affine.f, 90 - row_offset * pixel_size)
+        np.testing.assert_array_equal(result, full_result[row_offset:row_offset + result.shape[0],
+                                                          column_offset:column_offset + result.shape[1]])
+        self.assertEqual(np.sum(result), np.sum(full_result))
+
     def test_IUCN_pixel_to_world_coordinates(self):
         with self.assertRaises(AttributeError):
             self.test_species.pixel_to_world_coordinates()
@@ -74,6 +94,75 @@ class TestIUCN(unittest.TestCase):
         self.test_species.drop_extinct_species()
         self.assertGreaterEqual(original_size, self.test_species.data_full.shape[0])
 
+    def test_IUCN_drop_extinct_species_subset(self):
+        self.test_species.load_shapefile("./data/fish/selection/acrocheilus_alutaceus/acrocheilus_alutaceus.shp")
+        data = self.test_species.get_data()
+        extinct, other = data.copy(), data.copy()
+        extinct['binomial'], extinct['presence'] = "Extinct species", 5
+        other['binomial'] = "Other species"
+        self.test_species.set_data(gp.GeoDataFrame(pd.concat([data, extinct, other], ignore_index=True), crs=data.crs))
+        self.test_species.build_species_catalog()
+        # the catalog describes more species than the (subset of the) data
+        self.test_species.set_data(self.test_species.data_full[self.test_species.data_full.binomial != "Other species"])
+        with self.assertLogs('iSDM.species', level='INFO') as logs:
+            self.test_species.drop_extinct_species()
+        self.assertEqual(self.test_species.data_full.binomial.unique().tolist(), ["Acrocheilus alutaceus"])
+        self.assertIn("There are currently 2 unique species.", "\n".join(logs.output))
+        self.assertIn("There are now 1 unique species after dropping out extinct ones.", "\n".join(logs.output))
+
+    def test_IUCN_species_index(self):
+        with self.assertRaises(AttributeError):
+            self.test_species.build_species_index()
+        self.test_species.load_shapefile("./data/fish/selection/acrocheilus_alutaceus/acrocheilus_alutaceus.shp")
+        data = self.test_species.get_data()
+        index = self.test_species.build_species_index()
+        self.assertEqual(index.index.tolist(), sorted(data.binomial.unique()))
+        self.assertEqual(index.polygons.sum(), data.shape[0])
+        species_data = self.test_species.get_species("Acrocheilus alutaceus")
+        self.assertTrue(species_data.equals(data[data.binomial == "Acrocheilus alutaceus"]))
+        minx, miny, maxx, maxy = species_data.total_bounds
+        self.assertEqual(tuple(index.loc["Acrocheilus alutaceus", ['minx', 'miny', 'maxx', 'maxy']]), (minx, miny, maxx, maxy))
+        self.assertEqual([name for name, _ in self.test_species.iter_species()], index.index.tolist())
+        with self.assertRaises(ValueError):
+            self.test_species.get_species("Some name")
+
+    def test_IUCN_species_catalog(self):
+        with self.assertRaises(AttributeError):
+            self.test_species.build_species_catalog()
+        self.test_species.load_shapefile("./data/fish/selection/acrocheilus_alutaceus/acrocheilus_alutaceus.shp")
+        data = self.test_species.get_data()
+        pixel_size = 0.5
+        catalog = self.test_species.build_species_catalog(pixel_size=pixel_size)
+        self.assertEqual(catalog.index.tolist(), sorted(data.binomial.unique()))
+        self.assertEqual(catalog.polygons.sum(), data.shape[0])
+        entry = catalog.loc["Acrocheilus alutaceus"]
+        self.assertEqual(bool(entry.all_extinct), bool((data.presence == 5).all()))
+        self.assertEqual(tuple(entry[['minx', 'miny', 'maxx', 'maxy']]), tuple(data.total_bounds))
+        self.assertGreater(entry.vertices, entry.polygons)
+        result, _ = self.test_species.rasterize_window(pixel_size=pixel_size)
+        self.assertEqual(entry.window_pixels, result.size)
+        # stored next to the shapefile, and reloaded as long as the shapefile does not change
+        location = tempfile.mkdtemp()
+        try:
+            self.test_species.save_species_catalog(cache_location=location)
+            self.assertTrue(os.path.exists(self.test_species.species_catalog_file(location)))
+            del self.test_species.species_catalog
+            self.assertIsNone(self.test_species.load_species_catalog(cache_location=location, rebuild=False))
+            loaded = self.test_species.load_species_catalog(pixel_size=pixel_size, cache_location=location, rebuild=False)
+            self.assertTrue(loaded.equals(catalog))
+        finally:
+            shutil.rmtree(location)
+
+    def test_IUCN_random_pseudo_absence_points(self):
+        self.test_species.load_shapefile("./data/fish/selection/acrocheilus_alutaceus/acrocheilus_alutaceus.shp")
+        points = self.test_species.random_pseudo_absence_points(count=250, random_state=np.random.default_rng(42))
+        self.assertIsInstance(points, gp.GeoSeries)
+        self.assertEqual(points.shape[0], 250)
+        self.assertFalse(points.within(self.test_species.data_full.geometry.unary_union).any())
+        # the same seed draws the same points
+        again = self.test_species.random_pseudo_absence_points(count=250, random_state=42)
+        self.assertTrue(all(point.equals(other) for point, other in zip(points, again)))
+
     def tearDown(self):
         del self.test_species
 
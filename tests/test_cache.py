@@ -0,0 +1,154 @@
+import unittest
+import os
+import shutil
+import tempfile
+from iSDM.cache import VectorCache, load_vector, RasterCache, MemmapRasterReader, write_memmap_metadata, GridStore
+import geopandas as gp
+import numpy as np
+import rasterio
+from rasterio.transform import Affine
+from shapely.geometry import box
+
+
+class TestVectorCache(unittest.TestCase):
+
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        source = "./data/fish/selection/dorosoma_cepedianum"
+        for file_name in os.listdir(source):
+            shutil.copy(os.path.join(source, file_name), self.location)
+        self.shape_file = os.path.join(self.location, "dorosoma_cepedianum.shp")
+
+    def test_VectorCache_load(self):
+        with self.assertRaises(AttributeError):
+            VectorCache(None)
+        cache = VectorCache(self.shape_file)
+        self.assertFalse(cache.is_valid())
+        data = cache.load()
+        self.assertTrue(cache.is_valid())
+        self.assertIsInstance(data, gp.GeoDataFrame)
+        original = load_vector(self.shape_file)
+        self.assertEqual(data.shape, original.shape)
+        self.assertEqual(list(data.columns), list(original.columns))
+        self.assertTrue(all(cached.equals(geometry) for cached, geometry in zip(data.geometry, original.geometry)))
+        # a changed shapefile invalidates the cache
+        os.utime(self.shape_file, (0, 0))
+        self.assertFalse(cache.is_valid())
+
+    def test_load_vector_filters(self):
+        bbox = (-90, 30, -80, 40)
+        filters = [('presence', '<', 4)]
+        columns = ['binomial', 'presence']
+        original = load_vector(self.shape_file, bbox=bbox, filters=filters, columns=columns)
+        cached = load_vector(self.shape_file, bbox=bbox, filters=filters, columns=columns, cache=True)
+        self.assertTrue(os.path.exists(VectorCache(self.shape_file).cache_file))
+        self.assertEqual(list(cached.columns), columns + ['geometry'])
+        self.assertEqual(cached.shape, original.shape)
+        self.assertTrue((cached.presence < 4).all())
+        self.assertTrue(cached.intersects(box(*bbox)).all())
+
+    def test_VectorCache_spatial_order(self):
+        # many small boxes, in a random order
+        random_state = np.random.RandomState(0)
+        x, y = random_state.uniform(-180, 179, 500), random_state.uniform(-90, 89, 500)
+        boxes = gp.GeoDataFrame({'id': np.arange(500)}, geometry=[box(minx, miny, minx + 1, miny + 1) for minx, miny in zip(x, y)])
+        shape_file = os.path.join(self.location, "boxes.shp")
+        boxes.to_file(shape_file)
+        cache = VectorCache(shape_file)
+        cache.ROW_GROUP_SIZE = 50
+        cache.build()
+        # every row group covers a compact area, so a small bounding box only overlaps a few of them
+        import pyarrow.parquet as pq
+        metadata = pq.ParquetFile(cache.cache_file).metadata
+        bbox = (-20, -10, 20, 10)
+        overlapping = 0
+        for row_group in range(metadata.num_row_groups):
+            statistics = dict((metadata.row_group(row_group).column(column).path_in_schema, metadata.row_group(row_group).column(column).statistics)
+                              for column in range(metadata.num_columns))
+            if statistics['_maxx'].max >= bbox[0] and statistics['_minx'].min <= bbox[2] and \
+                    statistics['_maxy'].max >= bbox[1] and statistics['_miny'].min <= bbox[3]:
+                overlapping += 1
+        self.assertLess(overlapping, metadata.num_row_groups / 2)
+        # the records are read back in their original order
+        data = cache.read()
+        np.testing.assert_array_equal(data['id'].values, np.arange(500))
+        subset = cache.read(bbox=bbox)
+        np.testing.assert_array_equal(subset['id'].values, np.flatnonzero(boxes.intersects(box(*bbox))))
+
+    def test_RasterCache_load(self):
+        with self.assertRaises(AttributeError):
+            RasterCache(None)
+        raster_file = os.path.join(self.location, "max_wt_2000.tif")
+        shutil.copy("./data/watertemp/max_wt_2000.tif", raster_file)
+        cache = RasterCache(raster_file)
+        self.assertFalse(cache.is_valid())
+        reader = cache.load()
+        self.assertTrue(cache.is_valid())
+        self.assertIsInstance(reader, MemmapRasterReader)
+        self.assertEqual(cache.metadata()['checksum'], cache.source_checksum())
+        with rasterio.open(raster_file) as src:
+            band = src.read(1)
+            self.assertEqual((reader.count, reader.height, reader.width, reader.nodata), (src.count, src.height, src.width, src.nodata))
+            self.assertEqual(reader.affine.to_gdal(), src.affine.to_gdal())
+        data = reader.read(1)
+        self.assertIsInstance(data, np.memmap)
+        np.testing.assert_array_equal(data, band)
+        np.testing.assert_array_equal(reader.read(1, window=((10, 20), (30, 50))), band[10:20, 30:50])
+        # copy-on-write: the data can be modified, the cache is not
+        data[0, 0] = data[0, 0] + 1
+        self.assertEqual(cache.load().read(1)[0, 0], band[0, 0])
+        with self.assertRaises(IndexError):
+            reader.read(2)
+        # a changed raster file invalidates the cache
+        os.utime(raster_file, (0, 0))
+        self.assertFalse(cache.is_valid())
+
+    def test_MemmapRasterReader_raw(self):
+        raw_file = os.path.join(self.location, "raw.dat")
+        raw = np.memmap(raw_file, dtype=np.int32, mode='w+', shape=(180, 360))
+        raw[:] = np.arange(180 * 360).reshape(180, 360)
+        raw.flush()
+        write_memmap_metadata(raw_file, np.int32, (180, 360), nodata=-1)
+        reader = MemmapRasterReader(raw_file, mode='r')
+        self.assertEqual((reader.height, reader.width, reader.nodata), (180, 360, -1))
+        self.assertEqual(reader.affine.to_gdal(), (-180.0, 1.0, 0.0, 90.0, 0.0, -1.0))
+        np.testing.assert_array_equal(reader.read(1), raw)
+        with self.assertRaises(ValueError):
+            reader.read(1)[0, 0] = 1
+        del raw
+
+    def test_GridStore(self):
+        location = os.path.join(self.location, "grid")
+        with self.assertRaises(AttributeError):
+            GridStore(location)
+        data = np.full((100, 150), np.nan, dtype=np.float32)
+        data[10:30, 20:90] = np.arange(20 * 70).reshape(20, 70)
+        for compress in [True, False]:
+            store = GridStore(location, shape=(100, 150), transform=Affine(2.4, 0, -180, 0, -1.8, 90), chunk_shape=(16, 32),
+                              compress=compress)
+            store.write_layer("first", data)
+            store.write_layer("second", (strip * 2 for _, strip in GridStore(location).strips("first")))
+            # empty chunks are not stored
+            self.assertEqual(len(os.listdir(os.path.join(location, "first"))), 2 * 3)
+            reopened = GridStore(location)
+            self.assertEqual(reopened.layers, ["first", "second"])
+            self.assertEqual(reopened.transform.to_gdal(), store.transform.to_gdal())
+            np.testing.assert_array_equal(reopened.read("first"), data)
+            np.testing.assert_array_equal(reopened.read("second", window=((5, 40), (60, 100))), data[5:40, 60:100] * 2)
+            cell_ids = np.array([10 * 150 + 20, 29 * 150 + 89, 0, 10 * 150 + 20, 99 * 150 + 149])
+            np.testing.assert_array_equal(reopened.read_cells("first", cell_ids), data.reshape(-1)[cell_ids])
+            np.testing.assert_array_equal(reopened.read_cells("first"), data.reshape(-1))
+            # a layer is rewritten (or removed) without touching the other layers
+            reopened.write_layer("first", data + 1)
+            np.testing.assert_array_equal(GridStore(location).read("first"), data + 1)
+            reopened.remove_layer("second")
+            self.assertEqual(GridStore(location).layers, ["first"])
+            with self.assertRaises(AttributeError):
+                GridStore(location, shape=(10, 10))
+            shutil.rmtree(location)
+
+    def tearDown(self):
+        shutil.rmtree(self.location)
+
+if __name__ == '__main__':
+    unittest.main()
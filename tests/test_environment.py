@@ -2,7 +2,15 @@ import unittest
 from iSDM.environment import ClimateLayer
 from iSDM.environment import RasterEnvironmentalLayer
 from iSDM.environment import Source
+from iSDM.environment import MemmapEnvironmentalLayer
+from iSDM.environment import RasterStack
+from iSDM.environment import VectorEnvironmentalLayer
+from iSDM.model import Model
+import os
+import shutil
+import tempfile
 import geopandas as gp
+import rasterio
 from shapely.geometry import Polygon
 from rasterio.transform import Affine
 import numpy as np
@@ -72,6 +80,191 @@ class TestEnvironment(unittest.TestCase):
         with self.assertRaises(IndexError):
             self.climate_layer.read(2)
 
+    def test_RasterEnvironmentalLayer_read_window(self):
+        self.climate_layer.load_data()
+        band = self.climate_layer.read(1)
+        window = self.climate_layer.read(1, window=((10, 20), (30, 50)))
+        np.testing.assert_array_equal(window, band[10:20, 30:50])
+        data, (row_offset, column_offset) = self.climate_layer.read_bounds((-10, 20, 5.2, 40))
+        self.assertEqual((row_offset, column_offset), (100, 340))
+        np.testing.assert_array_equal(data, band[100:140, 340:371])
+        # the blocks (of the file, or strips of the given height) cover the entire band exactly once
+        for window_rows in [None, 7]:
+            covered = np.zeros(band.shape, dtype=np.int32)
+            for ((row_start, row_stop), (col_start, col_stop)), block in self.climate_layer.blocks(1, window_rows=window_rows):
+                np.testing.assert_array_equal(block, band[row_start:row_stop, col_start:col_stop])
+                covered[row_start:row_stop, col_start:col_stop] += 1
+            self.assertTrue((covered == 1).all())
+        # the coordinates computed strip by strip are the same as with the entire band in memory
+        streamed = self.climate_layer.pixel_to_world_coordinates()
+        in_memory = self.climate_layer.pixel_to_world_coordinates(raster_data=band)
+        np.testing.assert_array_equal(streamed[0], in_memory[0])
+        np.testing.assert_array_equal(streamed[1], in_memory[1])
+
+    def test_MemmapEnvironmentalLayer(self):
+        location = tempfile.mkdtemp()
+        try:
+            memmap_layer = MemmapEnvironmentalLayer(file_path="./data/watertemp/max_wt_2000.tif", cache_location=location, name_layer="MaxT")
+            reader = memmap_layer.load_data()
+            self.assertTrue(reader.name.startswith(location))
+            self.climate_layer.load_data()
+            np.testing.assert_array_equal(memmap_layer.read(1), self.climate_layer.read(1))
+            self.assertEqual(memmap_layer.raster_affine.to_gdal(), self.climate_layer.raster_affine.to_gdal())
+            coordinates = memmap_layer.pixel_to_world_coordinates()
+            np.testing.assert_array_equal(coordinates[0], self.climate_layer.pixel_to_world_coordinates()[0])
+            # usable as any raster layer in a model
+            model = Model(pixel_size=0.5, storage='cells')
+            model.add_environmental_layer(memmap_layer)
+            model.add_environmental_layer(ClimateLayer(file_path="./data/watertemp/max_wt_2000.tif", name_layer="MaxT_tif"))
+            np.testing.assert_array_equal(model.layers["MaxT"], model.layers["MaxT_tif"])
+            # the cache file itself (with its sidecar) can be opened directly, as a raw file with explicit dtype/shape
+            cached = MemmapEnvironmentalLayer(file_path=reader.name, mode='r')
+            np.testing.assert_array_equal(cached.load_data().read(1), self.climate_layer.read(1))
+            raw = MemmapEnvironmentalLayer(file_path=reader.name, dtype=reader.dtype, shape=(reader.height, reader.width))
+            np.testing.assert_array_equal(raw.load_data().read(1), self.climate_layer.read(1))
+            with self.assertRaises(AttributeError):
+                MemmapEnvironmentalLayer(file_path=reader.name, dtype=reader.dtype)
+            memmap_layer.close_dataset()
+        finally:
+            shutil.rmtree(location)
+
+    def test_RasterStack(self):
+        with self.assertRaises(AttributeError):
+            RasterStack(file_paths=[])
+        with self.assertRaises(AttributeError):
+            RasterStack(file_paths=["./data/watertemp/min_wt_2000.tif"], names_layers=["MinT", "MaxT"])
+        file_names = ["min_wt_2000.tif", "max_wt_2000.tif", "mean_wt_2000.tif"]
+        stack = RasterStack(file_paths=["./data/watertemp/%s" % file_name for file_name in file_names], names_layers=["MinT", "MaxT", "MeanT"])
+        cube = stack.load_data(max_workers=2)
+        self.assertEqual(cube.shape, (3, 360, 720))
+        for band_number, file_name in enumerate(file_names, start=1):
+            layer = ClimateLayer(file_path="./data/watertemp/%s" % file_name)
+            layer.load_data()
+            band = layer.read(1)
+            expected = band.astype(cube.dtype)
+            if layer.raster_reader.nodata is not None:
+                expected[band == layer.raster_reader.nodata] = stack.nodata
+            np.testing.assert_array_equal(stack.read(band_number), expected)
+        # the stack is only loaded if all layers are on the same grid
+        location = tempfile.mkdtemp()
+        try:
+            for file_name, shape, transform in [("shifted.tif", (360, 720), Affine(0.5, 0, -179.5, 0, -0.5, 90)),
+                                                ("coarse.tif", (180, 360), Affine(1, 0, -180, 0, -1, 90))]:
+                with rasterio.open(os.path.join(location, file_name), 'w', driver='GTiff', height=shape[0], width=shape[1],
+                                   count=1, dtype=np.float32, crs={'init': "EPSG:4326"}, transform=transform) as out:
+                    out.write(np.zeros(shape, dtype=np.float32), indexes=1)
+                with self.assertRaises(AttributeError):
+                    RasterStack(file_paths=["./data/watertemp/min_wt_2000.tif", os.path.join(location, file_name)]).validate()
+        finally:
+            shutil.rmtree(location)
+        # adding the stack at once gives the same model as adding the layers one by one
+        for storage in ['dataframe', 'cells']:
+            stacked_model = Model(pixel_size=0.5, storage=storage)
+            stacked_model.add_raster_stack(stack, discard_threshold=0)
+            model = Model(pixel_size=0.5, storage=storage)
+            for file_name, name_layer in zip(file_names, stack.names_layers):
+                model.add_environmental_layer(ClimateLayer(file_path="./data/watertemp/%s" % file_name, name_layer=name_layer), discard_threshold=0)
+            np.testing.assert_allclose(stacked_model.get_base_dataframe()[stack.names_layers].values,
+                                       model.get_base_dataframe()[stack.names_layers].values)
+        # the cube can also be stored in a memory-mapped file
+        location = tempfile.mkdtemp()
+        try:
+            memmap_cube = stack.load_data(memmap_file=os.path.join(location, "stack.dat"))
+            self.assertIsInstance(memmap_cube, np.memmap)
+            np.testing.assert_array_equal(memmap_cube, cube)
+            del memmap_cube
+        finally:
+            shutil.rmtree(location)
+
+    def test_Model_add_environmental_layers(self):
+        file_names = ["min_wt_2000.tif", "max_wt_2000.tif", "mean_wt_2000.tif"]
+        for storage in ['dataframe', 'cells']:
+            bulk_model = Model(pixel_size=0.5, raster_data=self.climate_layer.load_data().read(1) > 5, storage=storage)
+            bulk_model.add_environmental_layers([ClimateLayer(file_path="./data/watertemp/%s" % file_name, name_layer=file_name)
+                                                 for file_name in file_names], discard_threshold=[0, None, 0], max_workers=2)
+            model = Model(pixel_size=0.5, raster_data=self.climate_layer.read(1) > 5, storage=storage)
+            for file_name, discard_threshold in zip(file_names, [0, None, 0]):
+                model.add_environmental_layer(ClimateLayer(file_path="./data/watertemp/%s" % file_name, name_layer=file_name),
+                                              discard_threshold=discard_threshold)
+            np.testing.assert_allclose(bulk_model.get_base_dataframe()[file_names].values, model.get_base_dataframe()[file_names].values)
+        with self.assertRaises(AttributeError):
+            Model(pixel_size=1).add_environmental_layers([self.climate_layer])
+        with self.assertRaises(AttributeError):
+            model.add_environmental_layers([self.climate_layer, self.climate_layer])
+        with self.assertRaises(AttributeError):
+            model.add_environmental_layers([self.climate_layer], discard_threshold=[0, 0])
+
+    def test_Model_save_load(self):
+        location = tempfile.mkdtemp()
+        try:
+            for storage in ['dataframe', 'cells']:
+                model_location = os.path.join(location, storage)
+                model = Model(pixel_size=0.5, raster_data=self.climate_layer.load_data().read(1) > 5, storage=storage)
+                model.add_environmental_layers([ClimateLayer(file_path="./data/watertemp/min_wt_2000.tif", name_layer="MinT"),
+                                                ClimateLayer(file_path="./data/watertemp/max_wt_2000.tif", name_layer="MaxT")])
+                model.save(model_location, chunk_shape=(64, 64))
+                loaded = Model.load(model_location)
+                self.assertEqual(loaded.storage, storage)
+                np.testing.assert_array_equal(loaded.get_base_dataframe().index.values, model.get_base_dataframe().index.values)
+                np.testing.assert_array_equal(loaded.get_base_dataframe().values, model.get_base_dataframe().values)
+                # adding a layer to the loaded model, and saving it again, only writes the new layer
+                loaded.add_environmental_layer(ClimateLayer(file_path="./data/watertemp/mean_wt_2000.tif", name_layer="MeanT"))
+                modified_time = os.path.getmtime(os.path.join(model_location, "MinT"))
+                loaded.save(model_location, layers=["MeanT"] if storage == 'dataframe' else None)
+                self.assertEqual(os.path.getmtime(os.path.join(model_location, "MinT")), modified_time)
+                reloaded = Model.load(model_location, layers=["MeanT"])
+                self.assertEqual(list(reloaded.get_base_dataframe().columns), ["MeanT"])
+                np.testing.assert_array_equal(reloaded.get_base_dataframe()["MeanT"].values, loaded.get_base_dataframe()["MeanT"].values)
+        finally:
+            shutil.rmtree(location)
+
+    def test_RasterEnvironmentalLayer_align_to(self):
+        location = tempfile.mkdtemp()
+        try:
+            with self.assertRaises(AttributeError):
+                self.climate_layer.align_to(Model(pixel_size=1), resampling='median')
+            self.climate_layer.load_data()
+            band = self.climate_layer.read(1).astype(np.float64)
+            nodata = self.climate_layer.raster_reader.nodata
+            valid = ~np.isnan(band) if nodata is None else (band != nodata) & ~np.isnan(band)
+            # block aggregation: every pixel at 1 degree is made of 2 x 2 pixels at 0.5 degree
+            aligned_layer = self.climate_layer.align_to(Model(pixel_size=1), resampling='mean', cache_location=location, max_workers=3,
+                                                        tile_pixels=7 * 4 * 360)
+            aligned = aligned_layer.load_data().read(1)
+            self.assertEqual(aligned.shape, (180, 360))
+
+            def blocks(data):
+                return data.reshape(180, 2, 360, 2).sum(axis=(1, 3))
+            counts = blocks(valid)
+            expected = np.where(counts > 0, blocks(np.where(valid, band, 0)) / np.maximum(counts, 1), np.nan)
+            np.testing.assert_allclose(aligned, expected, rtol=1e-5)
+            self.assertEqual(aligned_layer.raster_affine.to_gdal(), Model(pixel_size=1).base_layer.raster_affine.to_gdal())
+            # the aligned raster is cached
+            cached = self.climate_layer.align_to(Model(pixel_size=1), resampling='mean', cache_location=location)
+            self.assertEqual(cached.file_path, aligned_layer.file_path)
+            # the most frequent biome of every 2 x 2 block
+            self.biomes_layer.load_data()
+            biomes = self.biomes_layer.read(1)
+            aligned_biomes = self.biomes_layer.align_to(Model(pixel_size=1), resampling='mode', cache_location=location).load_data().read(1)
+            for row, column in [(30, 40), (100, 200), (150, 300)]:
+                block = biomes[2 * row:2 * row + 2, 2 * column:2 * column + 2].ravel()
+                block = block[block != self.biomes_layer.raster_reader.nodata]
+                if block.shape[0] > 0:
+                    values, counts = np.unique(block, return_counts=True)
+                    self.assertEqual(aligned_biomes[row, column], values[np.argmax(counts)])
+            # not aligned with the raster pixels: warped
+            nearest = self.climate_layer.align_to(Model(pixel_size=0.75), resampling='nearest', cache_location=location).load_data().read(1)
+            rows, columns = (1.5 * np.arange(240) + 0.75).astype(int), (1.5 * np.arange(480) + 0.75).astype(int)
+            np.testing.assert_array_equal(nearest, self.climate_layer.read(1)[rows][:, columns])
+            # a model accepts layers of another resolution, aligned on the fly
+            model = Model(pixel_size=1, storage='cells')
+            model.add_environmental_layer(MemmapEnvironmentalLayer(file_path="./data/rebioms/w001001.adf", name_layer="Biomes",
+                                                                   cache_location=location), resampling='mode')
+            np.testing.assert_array_equal(model.layers["Biomes"], np.where(aligned_biomes == self.biomes_layer.raster_reader.nodata,
+                                                                           np.nan, aligned_biomes).ravel())
+        finally:
+            shutil.rmtree(location)
+
     def test_RasterEnvironmentalLayer_reproject(self):
         self.climate_layer.load_data()
         original_resolution = self.climate_layer.resolution
@@ -105,6 +298,72 @@ class TestEnvironment(unittest.TestCase):
         self.assertEqual(sampled_pixels_1.nonzero()[0].shape[0], 1000)
         self.assertGreater(np.sum(pixels_to_sample_from), np.sum(pixels_to_sample_from_1))
 
+    def test_Model_cells_storage(self):
+        # storage='cells' must give the same base dataframe as storage='dataframe', for raster and vector layers
+        raster_location = tempfile.mkdtemp()
+        try:
+            for raster_data in [None, self.climate_layer.load_data().read(1) > 5]:
+                base_dataframes = {}
+                for storage in ['dataframe', 'cells']:
+                    model = Model(pixel_size=0.5, raster_data=raster_data, storage=storage)
+                    model.add_environmental_layer(ClimateLayer(file_path="./data/watertemp/max_wt_2000.tif", name_layer="MaxT"))
+                    range_layer = VectorEnvironmentalLayer(file_path="./data/fish/selection/acrocheilus_alutaceus/acrocheilus_alutaceus.shp",
+                                                           name_layer="Range")
+                    range_layer.set_raster_file(os.path.join(raster_location, "range_%s.tif" % storage))
+                    range_layer.set_classifier(classifier_column="presence")
+                    model.add_environmental_layer(range_layer)
+                    base_dataframes[storage] = model.get_base_dataframe()
+                dataframe, cells = base_dataframes['dataframe'], base_dataframes['cells']
+                self.assertEqual(dataframe.shape, cells.shape)
+                self.assertEqual(list(dataframe.columns), list(cells.columns))
+                for level in range(2):
+                    np.testing.assert_allclose(dataframe.index.get_level_values(level), cells.index.get_level_values(level))
+                np.testing.assert_array_equal(dataframe.values.astype(np.float64), cells.values.astype(np.float64))
+                self.assertTrue(cells.Range.notnull().any())
+        finally:
+            shutil.rmtree(raster_location)
+
+    def test_RasterEnvironmentalLayer_sample_pseudo_absences_sparse(self):
+        self.biomes_layer.load_data()
+        some_species = np.zeros_like(self.biomes_layer.read(1))
+        some_species[int(some_species.shape[0] / 2):] = 1
+        np.random.seed(1)
+        pixels_to_sample_from, sampled_pixels = self.biomes_layer.sample_pseudo_absences(species_raster_data=some_species)
+        np.random.seed(1)
+        cells_to_sample_from, sampled_cells = self.biomes_layer.sample_pseudo_absences_sparse(presence_cells=np.flatnonzero(some_species))
+        self.assertIsInstance(sampled_cells, np.ndarray)
+        self.assertEqual(sampled_cells.shape[0], 1000)
+        np.testing.assert_array_equal(np.flatnonzero(sampled_pixels), sampled_cells)
+        np.testing.assert_array_equal(np.flatnonzero(pixels_to_sample_from), cells_to_sample_from)
+        # the presences can also be given as a window of the global raster
+        np.random.seed(1)
+        row_offset = int(some_species.shape[0] / 2)
+        cells_to_sample_from_1, sampled_cells_1 = self.biomes_layer.sample_pseudo_absences_sparse(species_raster_window=some_species[row_offset:],
+                                                                                                  window_offset=(row_offset, 0))
+        np.testing.assert_array_equal(sampled_cells, sampled_cells_1)
+        # the same sample, reading the environmental raster in strips instead of loading it
+        streamed_layer = ClimateLayer(file_path="./data/rebioms/w001001.adf")
+        streamed_layer.load_data()
+        np.random.seed(1)
+        cells_to_sample_from_2, sampled_cells_2 = streamed_layer.sample_pseudo_absences_sparse(presence_cells=np.flatnonzero(some_species),
+                                                                                               window_rows=13)
+        self.assertIsNone(getattr(streamed_layer, 'env_raster_data', None))
+        np.testing.assert_array_equal(cells_to_sample_from, cells_to_sample_from_2)
+        np.testing.assert_array_equal(sampled_cells, sampled_cells_2)
+        coordinates = self.biomes_layer.cells_to_world_coordinates(sampled_cells)
+        self.assertIsInstance(coordinates, tuple)
+        self.assertEqual(len(coordinates[0]), 1000)
+
+    def test_RasterEnvironmentalLayer_select_region_cells(self):
+        regions = np.array([3, 7, -2])
+        for dtype in [np.uint8, np.int16, np.int32, np.float32]:
+            env_raster_data = (np.arange(200 * 300) % 11 - 2).astype(dtype)
+            if dtype == np.uint8:
+                env_raster_data = np.abs(env_raster_data.astype(np.int32)).astype(dtype)
+            expected = np.sort(np.concatenate([np.flatnonzero(env_raster_data == region) for region in regions.astype(dtype)]))
+            selected = self.realms._select_region_cells(env_raster_data, regions.astype(dtype), block_size=1000)
+            np.testing.assert_array_equal(selected, expected)
+
     def tearDown(self):
         del self.climate_layer
 
@@ -0,0 +1,116 @@
+import unittest
+from iSDM.geometry import points_from_xy, points_to_pixels, points_within, points_in_geometry, count_vertices, make_valid
+from iSDM.geometry import grid_transform, hilbert_index
+from rasterio.transform import Affine
+from rasterio import features
+from shapely.geometry import Point, MultiPolygon, Polygon, box
+from shapely.ops import unary_union
+import geopandas as gp
+import numpy as np
+
+
+class TestGeometry(unittest.TestCase):
+
+    def setUp(self):
+        random_state = np.random.RandomState(0)
+        self.x = random_state.uniform(-180, 180, 1000)
+        self.y = random_state.uniform(-90, 90, 1000)
+        # some points exactly on the borders between pixels
+        self.x[:10] = np.round(self.x[:10])
+        self.y[:10] = np.round(self.y[:10])
+
+    def test_points_from_xy(self):
+        with self.assertRaises(AttributeError):
+            points_from_xy(self.x, self.y[:10])
+        geometry = points_from_xy(self.x, self.y)
+        self.assertEqual(len(geometry), 1000)
+        self.assertIsInstance(geometry[0], Point)
+        self.assertEqual((geometry[0].x, geometry[0].y), (self.x[0], self.y[0]))
+
+    def test_points_to_pixels(self):
+        for pixel_size in [1, 0.5]:
+            transform = Affine.translation(-180, 90) * Affine.scale(pixel_size, -pixel_size)
+            shape = (int(180 / pixel_size), int(360 / pixel_size))
+            expected = features.rasterize(points_from_xy(self.x, self.y), transform=transform, out_shape=shape, fill=0, default_value=1)
+            rows, columns = points_to_pixels(self.x, self.y, transform, shape)
+            result = np.zeros(shape, dtype=np.uint8)
+            result[rows, columns] = 1
+            np.testing.assert_array_equal(result, expected)
+        # NaN coordinates and points outside the raster map are left out
+        rows, columns = points_to_pixels(np.array([np.nan, 200, 10.5]), np.array([0, 0, 20.5]), transform, shape)
+        self.assertEqual((rows.tolist(), columns.tolist()), ([139], [381]))
+
+    def test_grid_transform(self):
+        transform = Affine.translation(-180, 90) * Affine.scale(0.5, -0.5)
+        shape = (360, 720)
+        grid = grid_transform(transform, shape)
+        self.assertIs(grid_transform(transform, shape), grid)
+        self.assertTrue(grid.separable)
+        # exactly the same coordinates as with the entire affine transformation (of the pixel centers)
+        mask = np.random.RandomState(2).uniform(size=shape) > 0.7
+        T1 = Affine(*reversed(transform.to_gdal())) * Affine.translation(0.5, 0.5)
+        expected = T1 * np.where(mask)
+        coordinates = grid.mask_to_world(mask)
+        np.testing.assert_array_equal(coordinates[0], expected[0])
+        np.testing.assert_array_equal(coordinates[1], expected[1])
+        window_coordinates = grid.mask_to_world(mask[100:150, 200:300], 100, 200)
+        np.testing.assert_array_equal(window_coordinates[0], (T1 * (np.nonzero(mask[100:150, 200:300])[0] + 100, 0))[0])
+        cell_ids = np.flatnonzero(mask)
+        np.testing.assert_array_equal(grid.cells_to_world(cell_ids)[1], expected[1])
+        # and back to pixels: NaN coordinates and points outside the raster map are (-1, -1)
+        np.testing.assert_array_equal(grid.world_to_cells(*coordinates), cell_ids)
+        rows, columns = grid.world_to_pixel(np.array([0, 20.5, np.nan]), np.array([200, 10.5, 0]))
+        self.assertEqual((rows.tolist(), columns.tolist()), ([-1, 139, -1], [-1, 381, -1]))
+        # a rotated grid is not separable, but transformed the same way
+        rotated = grid_transform(transform * Affine.rotation(30), shape)
+        self.assertFalse(rotated.separable)
+        rotated_T1 = Affine(*reversed((transform * Affine.rotation(30)).to_gdal())) * Affine.translation(0.5, 0.5)
+        np.testing.assert_allclose(rotated.mask_to_world(mask)[1], (rotated_T1 * np.where(mask))[1])
+
+    def test_points_within(self):
+        random_state = np.random.RandomState(1)
+        corners = random_state.uniform(-20, 20, (100, 2))
+        polygons = gp.GeoSeries([box(x, y, x + 3, y + 2).buffer(0.3) for x, y in corners])
+        points = gp.GeoSeries(points_from_xy(self.x / 7, self.y / 3.5))
+        within = points_within(points, polygons)
+        self.assertEqual(within.dtype, np.bool_)
+        np.testing.assert_array_equal(within, points.within(unary_union(list(polygons))).values)
+        self.assertFalse(points_within(points, gp.GeoSeries([])).any())
+
+    def test_count_vertices(self):
+        polygon_with_hole = box(0, 0, 10, 10).difference(box(2, 2, 4, 4))
+        geometries = gp.GeoSeries([box(0, 0, 1, 1), polygon_with_hole, MultiPolygon([box(0, 0, 1, 1), box(2, 2, 3, 3)]), Point(1, 1)])
+        self.assertEqual(count_vertices(geometries).tolist(), [5, 10, 10, 1])
+
+    def test_points_in_geometry(self):
+        polygon = box(-50, -30, 50, 30).difference(box(-10, -10, 10, 10))
+        inside = points_in_geometry(self.x, self.y, polygon)
+        self.assertEqual(inside.dtype, np.bool_)
+        np.testing.assert_array_equal(inside, [polygon.contains(Point(x, y)) for x, y in zip(self.x, self.y)])
+
+    def test_make_valid(self):
+        bowtie = Polygon([(0, 0), (2, 2), (2, 0), (0, 2)])
+        self.assertFalse(bowtie.is_valid)
+        repaired = make_valid(bowtie)
+        self.assertTrue(repaired.is_valid)
+        self.assertAlmostEqual(repaired.area, 2)
+        square = box(0, 0, 1, 1)
+        self.assertIs(make_valid(square), square)
+
+    def test_hilbert_index(self):
+        with self.assertRaises(AttributeError):
+            hilbert_index(self.x, self.y[:10])
+        # the centers of all cells of an 8x8 grid: every cell gets its own distance, and the curve only steps to neighbouring cells
+        x, y = np.meshgrid(np.arange(8) + 0.5, np.arange(8) + 0.5)
+        distances = hilbert_index(x.ravel(), y.ravel(), bounds=(0, 0, 8, 8), order=3)
+        np.testing.assert_array_equal(np.sort(distances), np.arange(64))
+        order = np.argsort(distances)
+        steps = np.abs(np.diff(x.ravel()[order])) + np.abs(np.diff(y.ravel()[order]))
+        np.testing.assert_array_equal(steps, 1)
+        distances = hilbert_index(np.append(self.x, np.nan), np.append(self.y, np.nan))
+        self.assertEqual(distances.dtype, np.int64)
+        self.assertEqual(distances[-1], 0)
+        self.assertTrue((distances < 2 ** 32).all())
+
+if __name__ == '__main__':
+    unittest.main()
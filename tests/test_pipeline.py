@@ -0,0 +1,103 @@
+import unittest
+import os
+import shutil
+import tempfile
+from iSDM.pipeline import SharedLayers, run_species, SpeciesStore
+import numpy as np
+
+
+def sum_species_layer(name_species, layers, factor=1):
+    if name_species == "Broken species":
+        raise ValueError("Cannot process %s" % name_species)
+    return int(layers['realms'].sum()) * factor
+
+
+def store_species_cells(name_species, layers, location=None):
+    cells = np.flatnonzero(layers['realms'] % len(name_species) == 0)
+    SpeciesStore(location).append(name_species, cells, 1)
+    return cells.shape[0]
+
+
+class TestPipeline(unittest.TestCase):
+
+    def setUp(self):
+        self.realms = np.arange(12, dtype=np.int32).reshape(3, 4)
+        self.species_names = ["Acrocheilus alutaceus", "Broken species", "Astatotilapia burtoni"]
+
+    def test_SharedLayers_open_layers(self):
+        with self.assertRaises(AttributeError):
+            SharedLayers({'realms': [1, 2, 3]})
+        shared = SharedLayers({'realms': self.realms})
+        layers = SharedLayers.open_layers(shared.specifications)
+        self.assertIsInstance(layers['realms'], np.memmap)
+        np.testing.assert_array_equal(layers['realms'], self.realms)
+        with self.assertRaises(ValueError):
+            layers['realms'][0, 0] = 1
+        del layers
+        shared.cleanup()
+
+    def test_run_species(self):
+        with self.assertRaises(AttributeError):
+            run_species(self.species_names, None)
+        for processes in [1, 2]:
+            results, failures = run_species(self.species_names, sum_species_layer,
+                                            shared_layers={'realms': self.realms},
+                                            species_arguments={"Astatotilapia burtoni": {'factor': 2}},
+                                            processes=processes)
+            self.assertEqual(results, {"Acrocheilus alutaceus": 66, "Astatotilapia burtoni": 132})
+            self.assertEqual(list(failures.keys()), ["Broken species"])
+
+    def test_run_species_costs(self):
+        processed = []
+        species_costs = {"Astatotilapia burtoni": 10, "Acrocheilus alutaceus": 1}
+        run_species(self.species_names, sum_species_layer, shared_layers={'realms': self.realms},
+                    species_arguments=lambda name_species: processed.append(name_species), processes=1,
+                    species_costs=species_costs)
+        self.assertEqual(processed, ["Astatotilapia burtoni", "Acrocheilus alutaceus", "Broken species"])
+
+    def test_SpeciesStore(self):
+        location = tempfile.mkdtemp()
+        try:
+            with self.assertRaises(AttributeError):
+                SpeciesStore(os.path.join(location, "species"))
+            store = SpeciesStore(os.path.join(location, "species"), shape=self.realms.shape)
+            store.append("Acrocheilus alutaceus", [7, 1, 3], [1, 0, 1], species_id=5)
+            store.append("Astatotilapia burtoni", [2], 1)
+            cell_ids, values = store.read("Acrocheilus alutaceus")
+            np.testing.assert_array_equal(cell_ids, [1, 3, 7])
+            np.testing.assert_array_equal(values, [0, 1, 1])
+            # the last write of a species wins
+            store.append("Acrocheilus alutaceus", [4, 0], [0, 1], species_id=5)
+            reopened = SpeciesStore(os.path.join(location, "species"))
+            self.assertEqual(reopened.species(), ["Acrocheilus alutaceus", "Astatotilapia burtoni"])
+            species_ids, cell_ids, values = reopened.read_all()
+            self.assertEqual(species_ids[:2].tolist(), [5, 5])
+            np.testing.assert_array_equal(cell_ids, [0, 4, 2])
+            np.testing.assert_array_equal(values, [1, 0, 1])
+            with self.assertRaises(KeyError):
+                reopened.read("Broken species")
+            dataframe = reopened.to_dataframe("Acrocheilus alutaceus")
+            self.assertEqual(dataframe.index.names, ['decimallatitude', 'decimallongitude'])
+            self.assertEqual(dataframe.index[0], (60.0, -135.0))
+            reopened.export_csv(os.path.join(location, "csv"))
+            self.assertEqual(sorted(os.listdir(os.path.join(location, "csv"))), ["Acrocheilus alutaceus.csv", "Astatotilapia burtoni.csv"])
+            # written concurrently by the worker processes
+            SpeciesStore(os.path.join(location, "concurrent"), shape=self.realms.shape)
+            results, failures = run_species(["Acrocheilus alutaceus", "Astatotilapia burtoni"], store_species_cells,
+                                            shared_layers={'realms': self.realms},
+                                            species_arguments=lambda name_species: {'location': os.path.join(location, "concurrent")},
+                                            processes=2)
+            self.assertFalse(failures)
+            concurrent = SpeciesStore(os.path.join(location, "concurrent"))
+            for name_species, count in results.items():
+                cell_ids, values = concurrent.read(name_species)
+                np.testing.assert_array_equal(cell_ids, np.flatnonzero(self.realms % len(name_species) == 0))
+                self.assertEqual(cell_ids.shape[0], count)
+        finally:
+            shutil.rmtree(location)
+
+    def tearDown(self):
+        del self.realms
+
+if __name__ == '__main__':
+    unittest.main()